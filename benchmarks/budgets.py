@@ -0,0 +1,204 @@
+"""
+Checks the number of Trello/GitLab requests each handler makes against
+its declared budget, using the fake servers of the replay benchmark.
+
+    python -m benchmarks.budgets
+
+Exits with 1 when any scenario exceeds its budget. Scenarios run in
+order against one synthetic world (2 team boards with 10 cards each, one
+of them not hooked yet), later ones rely on the state of earlier ones.
+Jobs enqueued by a handler (e.g. members flushes) are not counted.
+"""
+from __future__ import print_function
+import argparse
+from collections import OrderedDict
+from contextlib import contextmanager
+import sys
+
+from benchmarks import replay
+
+WORLD = [
+    '--team-boards', '2', '--cards', '10', '--projects', '1',
+    '--issues', '10', '--seed', '1'
+]
+
+# maximum number of upstream requests per handler invocation, lower them
+# together with changes that save requests
+BUDGETS = OrderedDict([
+    ('handle_generic_event:new', 16),
+    ('handle_generic_event:update', 8),
+    # from the payload alone, a single item write on the parent card
+    ('handle_check_item', 1),
+    ('handle_update_label', 2),
+    # the GitLab target is linked to 5 team cards
+    ('handle_gitlab_state_change', 5),
+    ('add_okr_label', 7),
+    # 10 cards on the board
+    ('hook_teamboard', 84),
+    # one page of actions per hooked board, whatever the activity
+    ('reconcile_boards', 2),
+    # cards and lists of the 2 team boards, the main and the top board
+    ('resync_diff', 8),
+])
+
+
+class Scenarios(object):
+
+    def __init__(self, trello, gitlab, world):
+        from trelolo import models, worker
+        from trelolo.payloads.gitlab import pick_data
+        self.pick_data = pick_data
+        self.trello = trello
+        self.gitlab = gitlab
+        self.world = world
+        self.models = models
+        self.worker = worker
+        self.client = worker.client
+        self.main_board = world.main_board['id']
+        self.card = world.team_cards[0]
+        self.parent = next(
+            c for c in trello.cards.values()
+            if c['idBoard'] == self.main_board and
+            '#{}'.format(c['name']) == world.card_labels[self.card['id']][
+                'name'
+            ]
+        )
+
+    @contextmanager
+    def count(self, used):
+        self.trello.reset_calls()
+        self.gitlab.reset_calls()
+        yield
+        used['trello'] = sum(self.trello.reset_calls().values())
+        used['gitlab'] = sum(self.gitlab.reset_calls().values())
+
+    def stored_card(self):
+        return self.models.Cards.query.filter_by(
+            card_id=self.card['id']
+        ).first()
+
+    def handle_generic_event_new(self, used):
+        label = self.world.card_labels[self.card['id']]
+        self.card['idLabels'].append(label['id'])
+        with self.count(used):
+            self.client.handle_generic_event(
+                self.main_board, self.card['id'], None
+            )
+
+    def handle_generic_event_update(self, used):
+        cl = self.trello.card_checklists(self.card['id'])[0]
+        for item in cl['checkItems']:
+            item['state'] = 'complete'
+        stored_card = self.stored_card()
+        with self.count(used):
+            self.client.handle_generic_event(
+                self.main_board, self.card['id'], stored_card
+            )
+
+    def handle_check_item(self, used):
+        cl = self.trello.card_checklists(self.card['id'])[0]
+        item = cl['checkItems'][0]
+        item['state'] = 'incomplete'
+        stored_card = self.stored_card()
+        with self.count(used):
+            self.client.handle_check_item(
+                stored_card, cl['id'], item['id'], item['state']
+            )
+
+    def handle_update_label(self, used):
+        label = self.world.card_labels[self.card['id']]
+        old_name = label['name']
+        label['name'] = '{}-renamed'.format(old_name)
+        with self.count(used):
+            self.client.handle_update_label(
+                self.main_board, old_name, label['name']
+            )
+
+    def handle_gitlab_state_change(self, used):
+        tags = set(
+            self.trello.labels[l]['name'] for l in self.card['idLabels']
+        )
+        target = self.world.targets[0]
+        target['labels'] = [t for t in tags if t.startswith('$')]
+        data = self.world.gitlab_event('update', target)['body']
+        self.worker.payload_gitlab_generic_event(self.pick_data(data))
+        with self.count(used):
+            self.client.handle_gitlab_state_change(
+                target['project_id'], target['id'], 'issue', True
+            )
+
+    def add_okr_label(self, used):
+        card = self.client.get_card(self.parent['id'])
+        with self.count(used):
+            self.client.add_okr_label(card, 'OKR:bench', 'green')
+
+    def hook_teamboard(self, used):
+        board = self.world.team_boards[-1]
+        with self.count(used):
+            self.worker.hook_teamboard(board['id'])
+
+    def reconcile_boards(self, used):
+        self.worker.reconcile_boards()
+        for card in self.world.team_cards[:3]:
+            self.world.trello_event('updateCheckItemStateOnCard', card)
+        with self.count(used):
+            self.worker.reconcile_boards()
+
+    def resync_diff(self, used):
+        from trelolo.trelolo.resync import Resync
+        syncer = Resync(self.client, lambda board_id, data: None)
+        team_board_ids = [
+            b.trello_id for b in self.models.Boards.query.filter_by(type=3)
+        ]
+        with self.count(used):
+            syncer.diff(
+                team_board_ids, self.main_board, self.world.top_board['id']
+            )
+
+    def run(self, name):
+        used = {}
+        getattr(self, name.replace(':', '_'))(used)
+        return used
+
+
+def check(budgets, results):
+    failed = []
+    for name, limit in budgets.items():
+        total = sum(results[name].values())
+        if total > limit:
+            failed.append(name)
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--redis', default='redis://localhost:6379/15')
+    parser.add_argument('--database', help='SQLAlchemy database URI')
+    args = parser.parse_args(argv)
+    bench_args = replay.parse_args(
+        WORLD + ['--redis', args.redis] +
+        (['--database', args.database] if args.database else [])
+    )
+    trello, gitlab, world, app = replay.setup(bench_args, unhooked_boards=1)
+    results = OrderedDict()
+    with app.app_context():
+        scenarios = Scenarios(trello, gitlab, world)
+        for name in BUDGETS:
+            results[name] = scenarios.run(name)
+    trello.stop()
+    gitlab.stop()
+
+    failed = check(BUDGETS, results)
+    print('{:<32} {:>7} {:>7} {:>7} {:>7}'.format(
+        'handler', 'trello', 'gitlab', 'total', 'budget'
+    ))
+    for name, used in results.items():
+        print('{:<32} {:>7} {:>7} {:>7} {:>7}{}'.format(
+            name, used['trello'], used['gitlab'], sum(used.values()),
+            BUDGETS[name], '  EXCEEDED' if name in failed else ''
+        ))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
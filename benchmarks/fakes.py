@@ -0,0 +1,677 @@
+"""
+Local stand-ins for the parts of the Trello and GitLab APIs Trelolo uses.
+
+Both servers keep their state in memory and count every request per
+endpoint, so that benchmarks can report upstream calls per job.
+"""
+from collections import Counter
+import itertools
+import logging
+import random
+import re
+import threading
+import time
+
+from flask import Flask, abort, jsonify, request
+from werkzeug.serving import make_server
+
+# same as trelolo.metrics.endpoint_template, importing trelolo here would
+# read its configuration before the benchmark could point it to the fakes
+ID_SEGMENT = re.compile(r'/(?:[0-9a-fA-F]{24,}|\d+)(?=/|$)')
+
+
+def endpoint_template(path):
+    return ID_SEGMENT.sub('/:id', path.rstrip('/'))
+
+
+class FakeServer(object):
+
+    def __init__(self, name):
+        self.app = Flask(name)
+        self.app.url_map.strict_slashes = False
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.server = None
+        self.app.before_request(self.count_call)
+
+    def count_call(self):
+        with self.lock:
+            self.calls[
+                (request.method, endpoint_template(request.path))
+            ] += 1
+
+    def reset_calls(self):
+        with self.lock:
+            calls = self.calls
+            self.calls = Counter()
+        return calls
+
+    def args(self):
+        args = request.args.to_dict()
+        args.update(request.form.to_dict())
+        args.update(request.get_json(force=True, silent=True) or {})
+        return args
+
+    def start(self, host='127.0.0.1', port=0):
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        self.server = make_server(host, port, self.app, threaded=True)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server.server_address[:2])
+
+
+class FakeTrello(FakeServer):
+
+    def __init__(self):
+        super(FakeTrello, self).__init__('fake-trello')
+        self.ids = itertools.count(1)
+        self.boards = {}
+        self.lists = {}
+        self.cards = {}
+        self.labels = {}
+        self.checklists = {}
+        self.members = {}
+        self.webhooks = {}
+        self.actions = []
+        self.register_routes()
+
+    def new_id(self):
+        # like Trello ids, prefixed with the creation time
+        return '{:08x}{:016x}'.format(int(time.time()), next(self.ids))
+
+    # state helpers
+
+    def add_board(self, name):
+        board = {
+            'id': self.new_id(), 'name': name, 'desc': '', 'closed': False
+        }
+        board['url'] = 'https://trello.com/b/{}'.format(board['id'])
+        self.boards[board['id']] = board
+        return board
+
+    def add_list(self, board_id, name, closed=False):
+        lst = {
+            'id': self.new_id(), 'name': name,
+            'idBoard': board_id, 'closed': closed
+        }
+        self.lists[lst['id']] = lst
+        return lst
+
+    def add_label(self, board_id, name, color='green'):
+        label = {
+            'id': self.new_id(), 'name': name,
+            'color': color, 'idBoard': board_id
+        }
+        self.labels[label['id']] = label
+        return label
+
+    def find_label(self, board_id, name):
+        return next(
+            (l for l in self.labels.values()
+             if l['idBoard'] == board_id and l['name'] == name), None
+        )
+
+    def add_member(self, username):
+        member = {
+            'id': self.new_id(), 'username': username,
+            'fullName': username, 'initials': username[:2].upper(),
+            'status': 'active'
+        }
+        self.members[member['id']] = member
+        return member
+
+    def add_card(self, list_id, name, desc='', label_ids=(), member_ids=()):
+        card_id = self.new_id()
+        card = {
+            'id': card_id, 'name': name, 'desc': desc or '',
+            'closed': False, 'idList': list_id,
+            'idBoard': self.lists[list_id]['idBoard'],
+            'idLabels': list(label_ids), 'idMembers': list(member_ids),
+            'idShort': len(self.cards) + 1, 'pos': len(self.cards) + 1,
+            'due': None, 'dateLastActivity': '2017-01-01T00:00:00.000Z',
+            'url': 'https://trello.com/c/{}/{}'.format(card_id[-8:], name),
+            'shortUrl': 'https://trello.com/c/{}'.format(card_id[-8:]),
+            'shortLink': card_id[-8:]
+        }
+        self.cards[card_id] = card
+        return card
+
+    def add_checklist(self, card_id, name='Issues'):
+        checklist = {
+            'id': self.new_id(), 'name': name, 'idCard': card_id,
+            'idBoard': self.cards[card_id]['idBoard'],
+            'pos': len(self.checklists) + 1, 'checkItems': []
+        }
+        self.checklists[checklist['id']] = checklist
+        return checklist
+
+    def add_check_item(self, checklist_id, name, checked=False):
+        checklist = self.checklists[checklist_id]
+        item = {
+            'id': self.new_id(), 'name': name,
+            'state': 'complete' if checked else 'incomplete',
+            'idChecklist': checklist_id, 'pos': len(checklist['checkItems'])
+        }
+        checklist['checkItems'].append(item)
+        return item
+
+    def card_checklists(self, card_id):
+        return sorted(
+            (cl for cl in self.checklists.values()
+             if cl['idCard'] == card_id), key=lambda cl: cl['pos']
+        )
+
+    def find_check_item(self, card_id, item_id):
+        for cl in self.card_checklists(card_id):
+            for item in cl['checkItems']:
+                if item['id'] == item_id:
+                    return cl, item
+        abort(404)
+
+    def card_json(self, card_id):
+        if card_id not in self.cards:
+            abort(404)
+        card = dict(self.cards[card_id])
+        card['labels'] = [
+            self.labels[l] for l in card['idLabels'] if l in self.labels
+        ]
+        card['checkItemStates'] = [
+            {'idCheckItem': item['id'], 'state': item['state']}
+            for cl in self.card_checklists(card_id)
+            for item in cl['checkItems']
+        ]
+        card['badges'] = {'comments': 0, 'attachments': 0}
+        return card
+
+    @staticmethod
+    def pick_fields(card, fields):
+        """
+        Keeps the id and the requested `fields` of a card, as Trello does.
+        """
+        if not fields or fields == 'all':
+            return card
+        return dict(
+            (k, v) for k, v in card.items()
+            if k == 'id' or k in fields.split(',')
+        )
+
+    def get_or_404(self, collection, id):
+        if id not in collection:
+            abort(404)
+        return collection[id]
+
+    def register_routes(self):
+        app = self.app
+
+        @app.route('/1/members/me/boards', methods=['GET'])
+        def list_boards():
+            return jsonify(list(self.boards.values()))
+
+        @app.route('/1/members/<id>', methods=['GET'])
+        def get_member(id):
+            return jsonify(self.get_or_404(self.members, id))
+
+        @app.route('/1/boards/<id>', methods=['GET'])
+        def get_board(id):
+            return jsonify(self.get_or_404(self.boards, id))
+
+        @app.route('/1/boards/<id>/lists', methods=['GET'])
+        def get_board_lists(id):
+            closed = request.args.get('filter') == 'closed'
+            return jsonify([
+                l for l in self.lists.values()
+                if l['idBoard'] == id and l['closed'] == closed
+            ])
+
+        @app.route('/1/boards/<id>/cards', methods=['GET'])
+        @app.route('/1/boards/<id>/cards/<card_filter>', methods=['GET'])
+        def get_board_cards(id, card_filter=None):
+            card_filter = card_filter or request.args.get('filter', 'open')
+            cards = [
+                self.pick_fields(
+                    self.card_json(c['id']), request.args.get('fields')
+                ) for c in self.cards.values()
+                if c['idBoard'] == id and (
+                    card_filter == 'all' or
+                    c['closed'] == (card_filter == 'closed')
+                )
+            ]
+            if request.args.get('checklists') == 'all':
+                for card in cards:
+                    card['checklists'] = self.card_checklists(card['id'])
+            return jsonify(cards)
+
+        @app.route('/1/boards/<id>/labels', methods=['GET'])
+        def get_board_labels(id):
+            return jsonify([
+                l for l in self.labels.values() if l['idBoard'] == id
+            ])
+
+        @app.route('/1/boards/<id>/actions', methods=['GET'])
+        def get_board_actions(id):
+            since = request.args.get('since')
+            before = request.args.get('before')
+            types = request.args.get('filter')
+            types = types.split(',') if types else None
+            limit = int(request.args.get('limit', 50))
+            actions = [
+                a for a in self.actions
+                if a['data'].get('board', {}).get('id') == id and
+                (since is None or a['id'] > since) and
+                (before is None or a['id'] < before) and
+                (types is None or a['type'] in types)
+            ]
+            return jsonify(list(reversed(actions))[:limit])
+
+        @app.route('/1/labels', methods=['POST'])
+        def create_label():
+            args = self.args()
+            return jsonify(self.add_label(
+                args['idBoard'], args['name'], args.get('color')
+            ))
+
+        @app.route('/1/lists/<id>', methods=['GET'])
+        def get_list(id):
+            return jsonify(self.get_or_404(self.lists, id))
+
+        @app.route('/1/cards', methods=['POST'])
+        def create_card():
+            args = self.args()
+            card = self.add_card(
+                args['idList'], args['name'], desc=args.get('desc')
+            )
+            return jsonify(self.card_json(card['id']))
+
+        @app.route('/1/cards/<id>', methods=['GET'])
+        def get_card(id):
+            return jsonify(
+                self.pick_fields(
+                    self.card_json(id), request.args.get('fields')
+                )
+            )
+
+        @app.route('/1/cards/<id>/<attribute>', methods=['PUT'])
+        def set_card_attribute(id, attribute):
+            card = self.get_or_404(self.cards, id)
+            if attribute not in ('desc', 'name', 'closed', 'idList'):
+                abort(400)
+            card[attribute] = self.args()['value']
+            return jsonify(self.card_json(id))
+
+        @app.route('/1/cards/<id>/idLabels', methods=['POST'])
+        def add_card_label(id):
+            card = self.get_or_404(self.cards, id)
+            label_id = self.args()['value']
+            if label_id in card['idLabels']:
+                abort(400)
+            card['idLabels'].append(label_id)
+            return jsonify(card['idLabels'])
+
+        @app.route('/1/cards/<id>/idLabels/<label_id>', methods=['DELETE'])
+        def remove_card_label(id, label_id):
+            card = self.get_or_404(self.cards, id)
+            if label_id not in card['idLabels']:
+                abort(400)
+            card['idLabels'].remove(label_id)
+            return jsonify(card['idLabels'])
+
+        @app.route('/1/cards/<id>/checklists', methods=['GET'])
+        def get_card_checklists(id):
+            self.get_or_404(self.cards, id)
+            return jsonify(self.card_checklists(id))
+
+        @app.route('/1/cards/<id>/checklists', methods=['POST'])
+        def create_card_checklist(id):
+            self.get_or_404(self.cards, id)
+            return jsonify(self.add_checklist(id, self.args()['name']))
+
+        @app.route('/1/checklists/<id>/checkItems', methods=['POST'])
+        def create_check_item(id):
+            self.get_or_404(self.checklists, id)
+            args = self.args()
+            item = self.add_check_item(
+                id, args['name'], args.get('checked') in (True, 'true')
+            )
+            return jsonify(item)
+
+        @app.route(
+            '/1/cards/<id>/checkItem/<item_id>', methods=['PUT', 'DELETE']
+        )
+        @app.route(
+            '/1/cards/<id>/checklist/<checklist_id>/checkItem/<item_id>',
+            methods=['PUT']
+        )
+        def update_check_item(id, item_id, checklist_id=None):
+            cl, item = self.find_check_item(id, item_id)
+            if request.method == 'DELETE':
+                cl['checkItems'].remove(item)
+                return jsonify({})
+            args = self.args()
+            if 'name' in args:
+                item['name'] = args['name']
+            if 'state' in args:
+                item['state'] = args['state']
+            return jsonify(item)
+
+        @app.route(
+            '/1/checklists/<id>/checkItems/<item_id>', methods=['DELETE']
+        )
+        def delete_check_item(id, item_id):
+            cl = self.get_or_404(self.checklists, id)
+            cl['checkItems'] = [
+                i for i in cl['checkItems'] if i['id'] != item_id
+            ]
+            return jsonify({})
+
+        @app.route('/1/tokens/<token>/webhooks', methods=['GET'])
+        def list_webhooks(token):
+            return jsonify(list(self.webhooks.values()))
+
+        @app.route('/1/tokens/<token>/webhooks', methods=['POST'])
+        def create_webhook(token):
+            args = self.args()
+            hook = {
+                'id': self.new_id(), 'description': args.get('description'),
+                'idModel': args['idModel'],
+                'callbackURL': args['callbackURL'], 'active': True
+            }
+            self.webhooks[hook['id']] = hook
+            return jsonify(hook)
+
+        @app.route('/1/webhooks/<id>', methods=['DELETE'])
+        def delete_webhook(id):
+            self.get_or_404(self.webhooks, id)
+            del self.webhooks[id]
+            return jsonify({})
+
+
+class FakeGitLab(FakeServer):
+
+    TARGETS = ('issues', 'merge_requests')
+
+    def __init__(self):
+        super(FakeGitLab, self).__init__('fake-gitlab')
+        self.ids = itertools.count(1)
+        self.projects = {}
+        self.targets = {}
+        self.milestones = {}
+        self.users = {}
+        self.register_routes()
+
+    def add_project(self, name):
+        project = {
+            'id': next(self.ids), 'name': name,
+            'name_with_namespace': 'bench / {}'.format(name)
+        }
+        self.projects[project['id']] = project
+        return project
+
+    def add_user(self, email):
+        user = {'id': next(self.ids), 'email': email}
+        self.users[user['id']] = user
+        return user
+
+    def add_milestone(self, project_id, title):
+        milestone = {
+            'id': next(self.ids), 'title': title, 'project_id': project_id
+        }
+        self.milestones[milestone['id']] = milestone
+        return milestone
+
+    def add_target(self, project_id, title, labels=(), kind='issues',
+                   milestone_id=None, assignee_id=None, description=''):
+        target = {
+            'id': next(self.ids), 'project_id': project_id,
+            'title': title, 'description': description,
+            'labels': list(labels), 'state': 'opened',
+            'milestone_id': milestone_id, 'assignee_id': assignee_id,
+            'kind': kind
+        }
+        target['url'] = 'https://gitlab.example/{}/{}/{}'.format(
+            project_id, kind, target['id']
+        )
+        self.targets[(project_id, kind, target['id'])] = target
+        return target
+
+    def register_routes(self):
+        app = self.app
+
+        def get_target(project_id, kind, id):
+            key = (project_id, kind, id)
+            if kind not in self.TARGETS or key not in self.targets:
+                abort(404)
+            return self.targets[key]
+
+        @app.route(
+            '/api/v3/projects/<int:project_id>/<kind>/<int:id>',
+            methods=['GET']
+        )
+        def show_target(project_id, kind, id):
+            return jsonify(get_target(project_id, kind, id))
+
+        @app.route(
+            '/api/v3/projects/<int:project_id>/<kind>/<int:id>',
+            methods=['PUT']
+        )
+        def update_target(project_id, kind, id):
+            target = get_target(project_id, kind, id)
+            args = self.args()
+            if 'description' in args:
+                target['description'] = args['description']
+            if 'labels' in args:
+                target['labels'] = [
+                    l for l in args['labels'].split(',') if l
+                ]
+            return jsonify(target)
+
+        @app.route(
+            '/api/v3/projects/<int:project_id>/labels', methods=['POST']
+        )
+        def create_label(project_id):
+            return jsonify(self.args())
+
+        @app.route(
+            '/api/v3/projects/<int:project_id>/milestones/<int:id>',
+            methods=['GET']
+        )
+        def show_milestone(project_id, id):
+            if id not in self.milestones:
+                abort(404)
+            return jsonify(self.milestones[id])
+
+        @app.route('/api/v3/projects/<int:project_id>', methods=['GET'])
+        def show_project(project_id):
+            if project_id not in self.projects:
+                abort(404)
+            return jsonify(self.projects[project_id])
+
+        @app.route('/api/v3/users/<int:id>', methods=['GET'])
+        def show_user(id):
+            if id not in self.users:
+                abort(404)
+            return jsonify(self.users[id])
+
+
+class SyntheticWorld(object):
+    """
+    Seeds both fakes with a main board, a top board and team boards whose
+    cards point to parent cards through `#` labels and to GitLab targets
+    through `$` labels.
+    """
+
+    def __init__(self, trello, gitlab, team_boards=3, cards=50,
+                 projects=2, issues=20, members=10, seed=1):
+        self.trello = trello
+        self.gitlab = gitlab
+        self.random = random.Random(seed)
+        self.team_boards = []
+        self.team_cards = []
+        self.card_labels = {}
+        self.targets = []
+        self.tags = ['topic{}'.format(i) for i in range(max(cards // 5, 1))]
+        self.build(team_boards, cards, projects, issues, members)
+
+    def build(self, team_boards, cards, projects, issues, members):
+        trello, gitlab = self.trello, self.gitlab
+        self.main_board = trello.add_board('Main Board')
+        self.top_board = trello.add_board('Top Board')
+        for board in (self.main_board, self.top_board):
+            trello.add_list(board['id'], 'Inbox')
+        main_inbox = next(
+            l for l in trello.lists.values()
+            if l['idBoard'] == self.main_board['id']
+        )
+        for tag in self.tags:
+            trello.add_card(main_inbox['id'], tag, desc='----\nmembers:')
+        self.members = [
+            trello.add_member('member{}'.format(i)) for i in range(members)
+        ]
+        self.users = [
+            gitlab.add_user('member{}@example.com'.format(i))
+            for i in range(members)
+        ]
+        for b in range(team_boards):
+            board = trello.add_board('Team {}'.format(b))
+            self.team_boards.append(board)
+            lists = [
+                trello.add_list(board['id'], name)
+                for name in ('Todo', 'Doing', 'Done')
+            ]
+            labels = {
+                tag: trello.add_label(board['id'], '#{}'.format(tag))
+                for tag in self.tags
+            }
+            gl_labels = {
+                tag: trello.add_label(board['id'], '${}'.format(tag))
+                for tag in self.tags
+            }
+            for c in range(cards):
+                tag = self.random.choice(self.tags)
+                card = trello.add_card(
+                    self.random.choice(lists)['id'],
+                    'Card {}/{}'.format(b, c),
+                    label_ids=[gl_labels[tag]['id']],
+                    member_ids=[self.random.choice(self.members)['id']]
+                )
+                self.card_labels[card['id']] = labels[tag]
+                cl = trello.add_checklist(card['id'], 'Tasks')
+                for i in range(4):
+                    trello.add_check_item(
+                        cl['id'], 'task {}'.format(i),
+                        self.random.random() > .5
+                    )
+                self.team_cards.append(card)
+        for p in range(projects):
+            project = gitlab.add_project('project{}'.format(p))
+            for i in range(issues):
+                target = gitlab.add_target(
+                    project['id'], 'Issue {}/{}'.format(p, i),
+                    labels=['${}'.format(self.random.choice(self.tags))],
+                    assignee_id=self.random.choice(self.users)['id'],
+                    description='Synthetic issue {}'.format(i)
+                )
+                self.targets.append(target)
+
+    def emails(self):
+        return [
+            (m['username'], '{}@example.com'.format(m['username']))
+            for m in self.members
+        ]
+
+    def trello_event(self, action, card, **data):
+        board = self.trello.boards[card['idBoard']]
+        payload = {
+            'action': {
+                'id': self.trello.new_id(),
+                'type': action,
+                'data': dict({
+                    'card': {'id': card['id'], 'name': card['name']},
+                    'board': {'id': board['id'], 'name': board['name']}
+                }, **data)
+            }
+        }
+        self.trello.actions.append(payload['action'])
+        return {'route': '/callback/trello/teamboard', 'body': payload}
+
+    def gitlab_event(self, action, target):
+        target['state'] = 'closed' if action == 'close' else 'opened'
+        return {
+            'route': '/callback/gitlab',
+            'body': {
+                'object_kind': 'issue',
+                'object_attributes': {
+                    'action': action,
+                    'id': target['id'],
+                    'title': target['title'],
+                    'url': target['url'],
+                    'milestone_id': target['milestone_id'],
+                    'description': target['description'],
+                    'state': target['state'],
+                    'assignee_id': target['assignee_id'],
+                    'project_id': target['project_id']
+                }
+            }
+        }
+
+    def events(self, count):
+        """
+        Generates a webhook stream: labelling cards first, then a mix of
+        check item changes, member changes and GitLab updates.
+        """
+        trello = self.trello
+        for card in self.team_cards:
+            if count <= 0:
+                return
+            label = self.card_labels[card['id']]
+            card['idLabels'].append(label['id'])
+            yield self.trello_event(
+                'addLabelToCard', card,
+                label={
+                    'id': label['id'], 'name': label['name'],
+                    'color': label['color']
+                }
+            )
+            count -= 1
+        while count > 0:
+            kind = self.random.random()
+            if kind < .5:
+                card = self.random.choice(self.team_cards)
+                cl = trello.card_checklists(card['id'])[0]
+                item = self.random.choice(cl['checkItems'])
+                item['state'] = 'incomplete' \
+                    if item['state'] == 'complete' else 'complete'
+                yield self.trello_event(
+                    'updateCheckItemStateOnCard', card,
+                    checklist={'id': cl['id'], 'name': cl['name']},
+                    checkItem={
+                        'id': item['id'], 'name': item['name'],
+                        'state': item['state']
+                    }
+                )
+            elif kind < .65:
+                card = self.random.choice(self.team_cards)
+                member = self.random.choice(self.members)
+                if member['id'] not in card['idMembers']:
+                    card['idMembers'].append(member['id'])
+                yield self.trello_event(
+                    'addMemberToCard', card, idMember=member['id']
+                )
+            elif kind < .9:
+                yield self.gitlab_event(
+                    'update', self.random.choice(self.targets)
+                )
+            else:
+                yield self.gitlab_event(
+                    self.random.choice(('close', 'reopen')),
+                    self.random.choice(self.targets)
+                )
+            count -= 1
@@ -0,0 +1,286 @@
+"""
+Replays a webhook stream through the Trelolo blueprints and RQ handlers
+against local fake Trello and GitLab servers.
+
+    python -m benchmarks.replay --synthetic 500 --team-boards 5 --cards 100
+    python -m benchmarks.replay --events recorded.jsonl
+
+Recorded streams are JSON lines of {"route": ..., "body": ...}. The fakes
+are seeded with synthetic boards either way, so recorded events should
+refer to ids of a previous --dump-events run.
+
+Redis is required (--redis, a dedicated database is used and its queues
+are emptied), the database defaults to a temporary sqlite file.
+"""
+from __future__ import print_function
+import argparse
+from collections import OrderedDict
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+QUEUES = ('high', 'default', 'low')
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--events', help='recorded webhook stream (jsonl)')
+    parser.add_argument('--synthetic', type=int, default=200,
+                        help='number of synthetic events to replay')
+    parser.add_argument('--dump-events',
+                        help='write the replayed stream to this file')
+    parser.add_argument('--team-boards', type=int, default=3)
+    parser.add_argument('--cards', type=int, default=50,
+                        help='cards per team board')
+    parser.add_argument('--projects', type=int, default=2)
+    parser.add_argument('--issues', type=int, default=20,
+                        help='issues per GitLab project')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--redis', default='redis://localhost:6379/15')
+    parser.add_argument('--database', help='SQLAlchemy database URI')
+    parser.add_argument('--intake', choices=('queue', 'inbox', 'redis'),
+                        default='queue', help='WEBHOOK_INTAKE mode')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as JSON')
+    parser.add_argument('--verbose', action='store_true',
+                        help='keep the trelolo log output')
+    return parser.parse_args(argv)
+
+
+def configure_environment(args, trello, gitlab, world):
+    """
+    Trelolo reads its configuration on import, so this has to run before
+    anything from the trelolo package (except the fakes) is imported.
+    """
+    database = args.database or 'sqlite:///{}'.format(
+        os.path.join(tempfile.mkdtemp(), 'trelolo-bench.db')
+    )
+    os.environ.update({
+        'TRELLO_API_URL': '{}/1'.format(trello.url),
+        'GITLAB_URL': gitlab.url,
+        'GITLAB_TOKEN': 'bench',
+        'TRELOLO_API_KEY': 'bench',
+        'TRELOLO_TOKEN': 'bench',
+        'TRELOLO_MAIN_BOARD': world.main_board['id'],
+        'TRELOLO_TOP_BOARD': world.top_board['id'],
+        'WEBHOOK_URL': 'http://trelolo.bench/callback',
+        'REDIS': args.redis,
+        'SQLALCHEMY_DATABASE_URI': database,
+        'MEMBERS_WRITE_WINDOW': '0',
+        'JOB_TRACE_THRESHOLD': '-1',
+        'WEBHOOK_INTAKE': args.intake
+    })
+
+
+def load_events(args, world):
+    if args.events:
+        with open(args.events) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    return list(world.events(args.synthetic))
+
+
+def event_type(event):
+    body = event['body']
+    if 'object_attributes' in body:
+        return 'gitlab:{}'.format(body['object_attributes']['action'])
+    return 'trello:{}'.format(body['action']['type'])
+
+
+def job_type(job):
+    from trelolo.payloads import envelope
+    name = job.func_name.split('.')[-1]
+    data = {}
+    for arg in job.args:
+        try:
+            data = envelope.unpack(arg)
+            break
+        except (TypeError, ValueError, KeyError):
+            continue
+    if 'action' in data:
+        return '{}:{}'.format(name, data['action'])
+    return name
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.latencies = OrderedDict()
+        self.calls = OrderedDict()
+
+    def add(self, key, latency, calls):
+        self.latencies.setdefault(key, []).append(latency)
+        self.calls.setdefault(key, []).append(calls)
+
+    def report(self):
+        rows = OrderedDict()
+        for key in sorted(self.latencies):
+            latencies, calls = self.latencies[key], self.calls[key]
+            rows[key] = OrderedDict([
+                ('count', len(latencies)),
+                ('p50_ms', round(percentile(latencies, 50) * 1000, 2)),
+                ('p99_ms', round(percentile(latencies, 99) * 1000, 2)),
+                ('calls_mean', round(sum(calls) / float(len(calls)), 2)),
+                ('calls_max', max(calls))
+            ])
+        return rows
+
+
+def drain(queues, scheduler, trello, gitlab, stats):
+    """
+    Runs queued jobs in the order of the worker until all queues are
+    empty.
+    """
+    from trelolo.worker import client
+    jobs = 0
+    while True:
+        client.members_writer.enqueue_due()
+        result = scheduler.next_job(queues)
+        if result is None:
+            return jobs
+        job = result[0]
+        trello.reset_calls()
+        gitlab.reset_calls()
+        start = time.time()
+        job.perform()
+        latency = time.time() - start
+        calls = sum(trello.reset_calls().values()) + \
+            sum(gitlab.reset_calls().values())
+        stats.add(job_type(job), latency, calls)
+        stats.add('all', latency, calls)
+        jobs += 1
+
+
+def setup(args, unhooked_boards=0):
+    """
+    Starts the fakes, points trelolo at them and seeds the database with
+    all but the last `unhooked_boards` team boards. Returns the fakes, the
+    synthetic world and the app.
+    """
+    from benchmarks.fakes import FakeGitLab, FakeTrello, SyntheticWorld
+
+    trello = FakeTrello().start()
+    gitlab = FakeGitLab().start()
+    world = SyntheticWorld(
+        trello, gitlab, team_boards=args.team_boards, cards=args.cards,
+        projects=args.projects, issues=args.issues, seed=args.seed
+    )
+    configure_environment(args, trello, gitlab, world)
+
+    from rq import Queue
+    from trelolo import create_app, fair, models
+    from trelolo.extensions import db, rq
+
+    if not args.verbose:
+        logging.getLogger('trelolo').setLevel(logging.WARNING)
+    app = create_app()
+    for name in QUEUES + tuple(
+        n.decode('utf-8') for n in rq.smembers(fair.ACTIVE_KEY)
+    ):
+        Queue(name, connection=rq).empty()
+    rq.delete(fair.ACTIVE_KEY)
+
+    hooked = world.team_boards[:len(world.team_boards) - unhooked_boards]
+    with app.app_context():
+        db.create_all()
+        for username, email in world.emails():
+            db.session.add(models.Emails(username=username, email=email))
+        for board in hooked:
+            db.session.add(models.Boards(
+                trello_id=board['id'], name=board['name'], type=3,
+                hook_id='', hook_url=''
+            ))
+        db.session.commit()
+    return trello, gitlab, world, app
+
+
+def run(args):
+    trello, gitlab, world, app = setup(args)
+
+    from rq import Queue
+    from trelolo.extensions import rq
+    from trelolo import fair
+    from trelolo.payloads import inbox
+    queues = [Queue(name, connection=rq) for name in QUEUES]
+    scheduler = fair.Scheduler(rq)
+
+    with app.app_context():
+        events = load_events(args, world)
+        if args.dump_events:
+            with open(args.dump_events, 'w') as f:
+                for event in events:
+                    f.write(json.dumps(event) + '\n')
+
+        http = app.test_client()
+        ingest = Stats()
+        jobs = Stats()
+        trello.reset_calls()
+        gitlab.reset_calls()
+        started = time.time()
+        for event in events:
+            start = time.time()
+            http.post(
+                event['route'], data=json.dumps(event['body']),
+                content_type='application/json'
+            )
+            ingest.add(event_type(event), time.time() - start, 0)
+            ingest.add('all', time.time() - start, 0)
+        ingested = time.time() - started
+        while inbox.drain():
+            pass
+        while rq.llen(inbox.STREAM_KEY):
+            inbox.consume()
+        count = drain(queues, scheduler, trello, gitlab, jobs)
+        elapsed = time.time() - started
+
+    trello.stop()
+    gitlab.stop()
+    return OrderedDict([
+        ('events', len(events)),
+        ('jobs', count),
+        ('ingest_seconds', round(ingested, 3)),
+        ('total_seconds', round(elapsed, 3)),
+        ('events_per_second', round(len(events) / elapsed, 2)
+         if elapsed else 0),
+        ('ingest', ingest.report()),
+        ('jobs_by_type', jobs.report())
+    ])
+
+
+def print_report(report):
+    print('events: {events}, jobs: {jobs}, ingest: {ingest_seconds}s, '
+          'total: {total_seconds}s, throughput: {events_per_second} '
+          'events/s'.format(**report))
+    for title, key in (('ingest', 'ingest'), ('jobs', 'jobs_by_type')):
+        print('\n{:<52} {:>6} {:>9} {:>9} {:>10} {:>9}'.format(
+            title, 'count', 'p50 ms', 'p99 ms', 'calls avg', 'calls max'
+        ))
+        for name, row in report[key].items():
+            print('{:<52} {count:>6} {p50_ms:>9} {p99_ms:>9} '
+                  '{calls_mean:>10} {calls_max:>9}'.format(name, **row))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,19 @@
 #!/usr/bin/env python
 from __future__ import print_function, unicode_literals
-from flask_migrate import Migrate, MigrateCommand
+from datetime import datetime
+import time
+import schedule
+from flask_migrate import MigrateCommand
 from flask_script import Manager, Shell, Server
-from rq import Worker, Queue, Connection
-from trelolo import create_app
-from trelolo.extensions import db, rq
-from trelolo.worker import unhook_all
+from rq import Queue, Connection
+from trelolo import create_app, fair, metrics, models
+from trelolo.extensions import queue, rq
+from trelolo.payloads import envelope, inbox
+from trelolo.trelolo.resync import Resync, describe
+from trelolo.worker import (
+    client, collect_garbage, payload_generic_event, reconcile_boards,
+    unhook_all
+)
 
 
 def _make_context():
@@ -16,7 +24,6 @@ def _make_context():
 
 
 app = create_app()
-migrate = Migrate(app, db)
 
 manager = Manager(app)
 manager.add_command('shell', Shell(make_context=_make_context))
@@ -27,24 +34,118 @@ manager.add_command(
 )
 manager.add_command('db', MigrateCommand)
 
-with app.app_context():
-    q = Queue(
-        connection=rq,
-        default_timeout=app.config.get('QUEUE_TIMEOUT')
-    )
-
 
 @manager.command
 def unhookall():
-    q.enqueue(unhook_all)
+    metrics.enqueue(queue, unhook_all)
+
+
+@manager.command
+def serve():
+    from trelolo.server import Server as WSGIServer
+    WSGIServer(app).run()
 
 
 @manager.command
 def work():
+    if app.config['WORKER_METRICS_PORT']:
+        metrics.start_worker_exporter(app.config['WORKER_METRICS_PORT'])
     with Connection(rq):
-        worker = Worker(map(Queue, ['high', 'default', 'low']))
+        scheduler = fair.Scheduler(
+            rq, fair.parse_weights(app.config['FAIR_WEIGHTS'])
+        )
+        worker = fair.FairWorker(
+            map(Queue, ['high', 'default', 'low']), scheduler,
+            # enqueues the flush jobs of elapsed members windows
+            ticks=[client.members_writer.enqueue_due]
+        )
         worker.work()
 
 
+@manager.command
+def drain():
+    while True:
+        with app.app_context():
+            drained = inbox.drain()
+        if not drained:
+            time.sleep(app.config['INBOX_POLL_INTERVAL'])
+
+
+@manager.command
+def ingest():
+    while True:
+        with app.app_context():
+            inbox.consume()
+
+
+@manager.command
+def scheduler():
+    schedule.every(app.config['RECONCILE_INTERVAL']).minutes.do(
+        metrics.enqueue, queue, reconcile_boards
+    )
+    if app.config['GC_INTERVAL']:
+        schedule.every(app.config['GC_INTERVAL']).hours.do(
+            metrics.enqueue, Queue(
+                'low', connection=rq,
+                default_timeout=app.config['QUEUE_TIMEOUT']
+            ), collect_garbage
+        )
+    while True:
+        schedule.run_pending()
+        time.sleep(1)
+
+
+@manager.option('-n', '--dry-run', dest='dry_run', action='store_true',
+                default=False, help='only print the planned changes')
+@manager.option('-w', '--workers', dest='workers', type=int, default=8,
+                help='parallel Trello requests')
+def resync(dry_run=False, workers=8):
+    def enqueue(parent_board_id, data):
+        metrics.enqueue(
+            queue, payload_generic_event, parent_board_id,
+            envelope.pack(data, envelope.TRELLO_FIELDS)
+        )
+    with app.app_context():
+        syncer = Resync(client, enqueue, workers)
+        changes = syncer.diff(
+            [b.trello_id for b in models.Boards.query.filter_by(type=3)],
+            app.config['TRELOLO_MAIN_BOARD'], app.config['TRELOLO_TOP_BOARD']
+        )
+        for change in changes:
+            print(describe(change))
+        print('{} changes planned'.format(len(changes)))
+        if not dry_run and changes:
+            failed = syncer.apply(changes)
+            print('applied, {} item writes failed'.format(failed))
+
+
+@manager.option('-n', '--dry-run', dest='dry_run', action='store_true',
+                default=False, help='only print what would be removed')
+def gc(dry_run=False):
+    with app.app_context():
+        report = collect_garbage(dry_run)
+    print('{} cards, {} issues and {} hooks {}'.format(
+        report['cards'], report['issues'], report['hooks'],
+        'to remove' if dry_run else
+        'removed, {} items and {} hooks failed'.format(
+            report['failed_items'], report['failed_hooks']
+        )
+    ))
+
+
+@manager.option('since', help='first received_at (YYYY-MM-DDTHH:MM:SS)')
+@manager.option('-u', '--until', dest='until', default=None)
+@manager.option('-r', '--route', dest='route', default=None)
+@manager.option('-k', '--key', dest='key', default=None)
+def replay(since, until=None, route=None, key=None):
+    def parse(value):
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+    with app.app_context():
+        count = inbox.replay(
+            parse(since), parse(until) if until else None, route, key
+        )
+    print('{} events will be dispatched again by the drainer'.format(count))
+
+
 if __name__ == "__main__":
     manager.run()
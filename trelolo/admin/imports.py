@@ -0,0 +1,104 @@
+import codecs
+import csv
+import logging
+import re
+import uuid
+
+from sqlalchemy import select
+
+from ..extensions import db
+from trelolo import models
+
+log = logging.getLogger(__name__)
+
+CHUNK = 1000
+MAX_LENGTH = 45
+EMAIL = re.compile(r'^[^@\s]+@[^@\s]+$')
+
+
+def validate(row):
+    if len(row) < 2:
+        return 'expected username,email'
+    username, email = row[0].strip(), row[1].strip()
+    if not username:
+        return 'missing username'
+    if not EMAIL.match(email):
+        return 'invalid email {}'.format(email)
+    if len(username) > MAX_LENGTH or len(email) > MAX_LENGTH:
+        return 'longer than {} characters'.format(MAX_LENGTH)
+    return None
+
+
+def stage(stream, batch):
+    """
+    Loads valid rows of the CSV stream into the staging table in chunks,
+    returns the number of staged rows and (line, error) of invalid rows.
+    """
+    staged = 0
+    errors = []
+    chunk = []
+    insert = models.EmailsImport.__table__.insert()
+    lines = codecs.iterdecode(stream, 'utf-8')
+    for line, row in enumerate(csv.reader(lines), 1):
+        if not row:
+            continue
+        error = validate(row)
+        if error is not None:
+            errors.append((line, error))
+            continue
+        chunk.append({
+            'batch': batch,
+            'username': row[0].strip(),
+            'email': row[1].strip()
+        })
+        if len(chunk) >= CHUNK:
+            db.session.execute(insert, chunk)
+            db.session.commit()
+            staged += len(chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(insert, chunk)
+        db.session.commit()
+        staged += len(chunk)
+    return staged, errors
+
+
+def swap(batch):
+    """
+    Replaces the emails table with the staged batch in one transaction,
+    readers see either the old or the new emails.
+    """
+    staging = models.EmailsImport.__table__
+    emails = models.Emails.__table__
+    db.session.execute(emails.delete())
+    db.session.execute(emails.insert().from_select(
+        ['username', 'email'],
+        select([staging.c.username, staging.c.email]).where(
+            staging.c.batch == batch
+        ).order_by(staging.c.id)
+    ))
+    db.session.execute(staging.delete().where(staging.c.batch == batch))
+    db.session.commit()
+
+
+def import_emails(stream):
+    """
+    Streams an uploaded username,email CSV into the emails table. Invalid
+    rows are skipped and reported; nothing is replaced when no row is
+    valid. Returns the number of imported rows and the row errors.
+    """
+    batch = uuid.uuid4().hex
+    staging = models.EmailsImport.__table__
+    try:
+        staged, errors = stage(stream, batch)
+        if staged:
+            swap(batch)
+    except Exception:
+        db.session.rollback()
+        db.session.execute(staging.delete().where(staging.c.batch == batch))
+        db.session.commit()
+        raise
+    log.info('imported {} emails, {} invalid rows'.format(
+        staged, len(errors)
+    ))
+    return staged, errors
@@ -1,22 +1,23 @@
-import csv
-import io
 from functools import wraps
+import hashlib
+import json
+import logging
 from flask import (
-    Blueprint, current_app, flash, jsonify,
-    render_template, redirect, request, Response, url_for
+    Blueprint, abort, current_app, flash, jsonify, make_response,
+    render_template, redirect, request, Response, session,
+    stream_with_context, url_for
 )
-from rq import Queue
 
 from ..config import Config
-from ..extensions import db, rq
-from trelolo import models
+from ..extensions import queue
+from trelolo import metrics, models, progress, tracing
 from trelolo import worker
+from . import imports
 
+log = logging.getLogger(__name__)
 
-q = Queue(
-    connection=rq,
-    default_timeout=Config.QUEUE_TIMEOUT
-)
+# flashed messages are kept in the session cookie
+MAX_REPORTED_ERRORS = 20
 
 
 def check_auth(username, password):
@@ -47,11 +48,61 @@ bp = Blueprint('admin_page', __name__,
 @bp.route('/config/job/<id>', methods=['GET', 'POST'])
 def show_job_state(id):
     state = True
+    job_progress = None
     if id:
-        job = q.fetch_job(id)
+        job = queue.fetch_job(id)
         if job:
-            state = q.fetch_job(id).is_finished
-    return jsonify(state=state)
+            state = job.is_finished
+            job_progress = job.meta.get('progress')
+    return jsonify(state=state, progress=job_progress)
+
+
+@bp.route('/config/job/<id>/events', methods=['GET'])
+@requires_auth
+def stream_job_progress(id):
+    job = queue.fetch_job(id)
+    if job is None:
+        abort(404)
+    return Response(
+        stream_with_context(progress.stream(job)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+def fetch_job_meta(id, key):
+    job = queue.fetch_job(id)
+    if job is None or key not in job.meta:
+        abort(404)
+    return job.meta[key]
+
+
+def as_download(response, filename):
+    if request.args.get('download'):
+        response.headers['Content-Disposition'] = \
+            'attachment; filename={}'.format(filename)
+    return response
+
+
+@bp.route('/config/job/<id>/trace', methods=['GET'])
+@requires_auth
+def show_job_trace(id):
+    trace = fetch_job_meta(id, 'trace')
+    if request.args.get('format') == 'folded':
+        return as_download(
+            Response(tracing.to_folded(trace), mimetype='text/plain'),
+            '{}.folded'.format(id)
+        )
+    return as_download(jsonify(trace), '{}.json'.format(id))
+
+
+@bp.route('/config/job/<id>/profile', methods=['GET'])
+@requires_auth
+def show_job_profile(id):
+    return as_download(
+        Response(fetch_job_meta(id, 'profile'), mimetype='text/plain'),
+        '{}.prof.txt'.format(id)
+    )
 
 
 @bp.route('/config/upload', methods=['POST'])
@@ -60,18 +111,22 @@ def upload():
     if request.method == 'POST':
         file = request.files['file']
         try:
-            db.session.query(models.Emails).delete()
-            stream = io.StringIO(
-                file.stream.read().decode("UTF8"), newline=None
-            )
-            csv_input = csv.reader(stream)
-            for row in csv_input:
-                email = models.Emails(username=row[0], email=row[1])
-                db.session.add(email)
-            db.session.commit()
-            flash('Emails have been imported')
-        except:
-            flash('Something went wrong')
+            imported, errors = imports.import_emails(file.stream)
+        except Exception as e:
+            log.exception('emails import failed')
+            flash('Something went wrong: {}'.format(str(e)))
+            return redirect(url_for('admin_page.show_config'))
+        if imported:
+            worker.client.email_cache.refresh()
+            flash('{} emails have been imported'.format(imported))
+        else:
+            flash('No valid rows, emails have not been changed')
+        for line, error in errors[:MAX_REPORTED_ERRORS]:
+            flash('line {}: {}'.format(line, error))
+        if len(errors) > MAX_REPORTED_ERRORS:
+            flash('... and {} more invalid rows'.format(
+                len(errors) - MAX_REPORTED_ERRORS
+            ))
         return redirect(url_for('admin_page.show_config'))
 
 
@@ -88,15 +143,34 @@ def show_config():
         if board_id:
             if int(checked):
                 if board_id not in ids:
-                    job = q.enqueue(worker.hook_teamboard, board_id)
+                    job = metrics.enqueue(
+                        queue, worker.hook_teamboard, board_id
+                    )
             else:
                 if board_id in ids:
-                    job = q.enqueue(worker.unhook_teamboard, board_id)
+                    job = metrics.enqueue(
+                        queue, worker.unhook_teamboard, board_id
+                    )
         job_id = job.id if job else None
         return jsonify(job_id=job_id)
-    return render_template('config.html',
-                           inuse=[Config.TRELOLO_TOP_BOARD,
-                                  Config.TRELOLO_MAIN_BOARD],
-                           checked_boards=ids,
-                           stored_board_hooks=hooks,
-                           boards=worker.client.list_boards())
+    if request.args.get('refresh'):
+        worker.catalogue.get(refresh=True)
+        return redirect(url_for('admin_page.show_config'))
+    catalogue = worker.catalogue.get()
+    inuse = [Config.TRELOLO_TOP_BOARD, Config.TRELOLO_MAIN_BOARD]
+    etag = hashlib.sha1(json.dumps(
+        [catalogue, sorted(hooks.items()), inuse]
+    ).encode('utf-8')).hexdigest()
+    # flashed messages are only shown once
+    if etag in request.if_none_match and not session.get('_flashes'):
+        return Response(status=304, headers={'ETag': '"{}"'.format(etag)})
+    response = make_response(render_template(
+        'config.html',
+        inuse=inuse,
+        checked_boards=ids,
+        stored_board_hooks=hooks,
+        boards=json.loads(catalogue)
+    ))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
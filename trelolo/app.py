@@ -2,13 +2,13 @@ from flask import Flask
 import logging
 from .config import Config
 from .admin import views
+from . import metrics
 from .extensions import db, migrate, sentry
 from .payloads import gitlab, trello
 
 
-BLUEPRINTS = (gitlab, trello, views)
+BLUEPRINTS = (gitlab, trello, views, metrics)
 
-app = Flask(__name__)
 __all__ = ['create_app']
 
 
@@ -8,6 +8,7 @@ class Config(object):
     TRELOLO_TOKEN = env.get('TRELOLO_TOKEN')
     TRELOLO_MAIN_BOARD = env.get('TRELOLO_MAIN_BOARD')
     TRELOLO_TOP_BOARD = env.get('TRELOLO_TOP_BOARD')
+    TRELLO_API_URL = env.get('TRELLO_API_URL', 'https://api.trello.com/1')
     GITLAB_URL = env.get('GITLAB_URL')
     GITLAB_TOKEN = env.get('GITLAB_TOKEN')
     SQLALCHEMY_DATABASE_URI = env.get(
@@ -17,9 +18,60 @@ class Config(object):
     REDIS = env.get('REDIS', 'redis://redis:6379')
     FLASK_HOST = env.get('FLASK_HOST', '0.0.0.0')
     FLASK_PORT = int(env.get('FLASK_PORT', '5000'))
+    SERVE_WORKERS = int(env.get('SERVE_WORKERS', '0'))
+    SERVE_THREADS = int(env.get('SERVE_THREADS', '4'))
+    SERVE_KEEPALIVE = int(env.get('SERVE_KEEPALIVE', '5'))
+    SERVE_TIMEOUT = int(env.get('SERVE_TIMEOUT', '30'))
+    SERVE_GRACEFUL_TIMEOUT = int(env.get('SERVE_GRACEFUL_TIMEOUT', '30'))
+    SERVE_ACCESS_LOG = env.get('SERVE_ACCESS_LOG', '0') == '1'
     ADMIN_USER = env.get('ADMIN_USER', '')
     ADMIN_PASSWORD = env.get('ADMIN_PASSWORD', '')
     QUEUE_TIMEOUT = int(env.get('QUEUE_TIMEOUT', '7200'))
+    WORKER_METRICS_PORT = int(env.get('WORKER_METRICS_PORT', '9200'))
+    # progress streams open at once per web process, and their seconds
+    PROGRESS_STREAMS = int(env.get('PROGRESS_STREAMS', '1'))
+    PROGRESS_STREAM_TIMEOUT = int(env.get('PROGRESS_STREAM_TIMEOUT', '20'))
+    JOB_TRACE_THRESHOLD = float(env.get('JOB_TRACE_THRESHOLD', '1'))
+    JOB_PROFILE_THRESHOLD = float(env.get('JOB_PROFILE_THRESHOLD', '0'))
+    ASYNC_CONNECTIONS = int(env.get('ASYNC_CONNECTIONS', '32'))
+    MUTATION_WORKERS = int(env.get('MUTATION_WORKERS', '8'))
+    MUTATION_RATE = float(env.get('MUTATION_RATE', '0'))
+    MUTATIONS_DRY_RUN = env.get('MUTATIONS_DRY_RUN', '0') == '1'
+    HOOKS_DELETE_WORKERS = int(env.get('HOOKS_DELETE_WORKERS', '8'))
+    HOOKS_DELETE_RATE = float(env.get('HOOKS_DELETE_RATE', '9'))
+    BOARDS_CACHE_TTL = int(env.get('BOARDS_CACHE_TTL', '300'))
+    MEMBERS_WRITE_WINDOW = float(env.get('MEMBERS_WRITE_WINDOW', '2'))
+    # `queue` enqueues jobs in the request, `inbox` stores the webhook in
+    # the database and `redis` pushes it to a redis list
+    WEBHOOK_INTAKE = env.get('WEBHOOK_INTAKE', 'queue')
+    INBOX_BATCH_SIZE = int(env.get('INBOX_BATCH_SIZE', '100'))
+    # minutes between reconciliations from board actions
+    RECONCILE_INTERVAL = int(env.get('RECONCILE_INTERVAL', '15'))
+    INBOX_POLL_INTERVAL = float(env.get('INBOX_POLL_INTERVAL', '1'))
+    # hours between garbage collections, 0 disables them
+    GC_INTERVAL = int(env.get('GC_INTERVAL', '24'))
+    # seconds a hook of an unknown model is spared, it may be being linked
+    GC_HOOK_GRACE = int(env.get('GC_HOOK_GRACE', '3600'))
+    # waiting webhook jobs from which events only mark cards dirty, 0
+    # disables it, and down to which the intake turns back to normal
+    INTAKE_PRESSURE_DEPTH = int(env.get('INTAKE_PRESSURE_DEPTH', '5000'))
+    INTAKE_RELIEF_DEPTH = int(env.get('INTAKE_RELIEF_DEPTH', '1000'))
+    INTAKE_PRESSURE_INTERVAL = float(
+        env.get('INTAKE_PRESSURE_INTERVAL', '5')
+    )
+    # webhook jobs in a queue per team board and GitLab project
+    FAIR_QUEUES = env.get('FAIR_QUEUES', '1') == '1'
+    # e.g. `board:<id>=2,gitlab:<project id>=0.5`, 1 by default
+    FAIR_WEIGHTS = env.get('FAIR_WEIGHTS', '')
+
+    # `text` or `json`
+    LOG_FORMAT = env.get('LOG_FORMAT', 'text')
+    LOG_LEVEL = env.get('LOG_LEVEL', 'INFO')
+    # records per second and logger below WARNING, 0 does not sample
+    LOG_RATE = float(env.get('LOG_RATE', '50'))
+    LOG_BURST = int(env.get('LOG_BURST', '200'))
+    LOG_MAX_LENGTH = int(env.get('LOG_MAX_LENGTH', '2000'))
+    LOG_QUEUE_SIZE = int(env.get('LOG_QUEUE_SIZE', '10000'))
 
     # TODO: find a better way (maybe?)
     e = env.get('environment', 'default')
@@ -1,6 +1,7 @@
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
 import redis
+from rq import Queue
 from redis.connection import ConnectionPool
 from raven.contrib.flask import Sentry
 
@@ -14,3 +15,8 @@ sentry = Sentry()
 rq = redis.Redis(
     connection_pool=ConnectionPool.from_url(Config.REDIS)
 )
+
+queue = Queue(
+    connection=rq,
+    default_timeout=Config.QUEUE_TIMEOUT
+)
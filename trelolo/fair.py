@@ -0,0 +1,246 @@
+"""
+Fair scheduling of webhook jobs.
+
+Webhook jobs are queued per team board or GitLab project, in sub-queues
+named `fair:board:<id>` and `fair:gitlab:<project id>`, instead of all in
+`default`. The worker serves `high` first, then takes turns between
+`default` and the sub-queues with jobs (deficit round robin, every turn
+allows as many jobs as the weight of the queue) and serves `low` last.
+A board flooding its sub-queue only delays its own jobs.
+
+Sub-queues with jobs are listed in the ACTIVE_KEY set and leave it when
+the worker finds them empty, so they also leave the queue gauges.
+"""
+from collections import deque
+import logging
+
+from rq import Queue, Worker
+from rq.exceptions import DequeueTimeout
+from rq.worker import WorkerStatus
+
+from trelolo.config import Config
+from trelolo.extensions import queue, rq
+from trelolo import logs, metrics
+
+log = logging.getLogger(__name__)
+
+PREFIX = 'fair:'
+ACTIVE_KEY = 'trelolo:fair:queues'
+# queues which take turns with the sub-queues
+SHARED = ('default',)
+
+
+def board_tenant(board_id):
+    return 'board:{}'.format(board_id) if board_id else None
+
+
+def gitlab_tenant(project_id):
+    return 'gitlab:{}'.format(project_id) if project_id else None
+
+
+def get_queue(tenant):
+    return Queue(
+        PREFIX + tenant, connection=rq, default_timeout=Config.QUEUE_TIMEOUT
+    )
+
+
+def enqueue(f, args, tenant=None):
+    """
+    Enqueues a webhook job in the sub-queue of `tenant`, in `default`
+    when there is none or fair queues are off.
+    """
+    if tenant is None or not Config.FAIR_QUEUES:
+        return metrics.enqueue(queue, f, *args)
+    sub_queue = get_queue(tenant)
+    job = metrics.enqueue(sub_queue, f, *args)
+    # only after the push, see `Scheduler.retire`
+    rq.sadd(ACTIVE_KEY, sub_queue.name)
+    return job
+
+
+def parse_weights(value):
+    """
+    Parses `board:<id>=2,gitlab:<project id>=0.5` into a dict of queue
+    names and weights.
+    """
+    weights = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        tenant, weight = item.rsplit('=', 1)
+        tenant = tenant.strip()
+        name = tenant if tenant in SHARED else PREFIX + tenant
+        weights[name] = float(weight)
+    return weights
+
+
+class Scheduler(object):
+    """
+    Deficit round robin over the shared queues and the active sub-queues,
+    a job costs 1.
+    """
+
+    def __init__(self, connection, weights=None):
+        self.connection = connection
+        self.weights = weights or {}
+        self.ring = deque(SHARED)
+        self.deficit = {}
+
+    def weight(self, name):
+        return self.weights.get(name, 1)
+
+    def refresh(self):
+        active = set(
+            n.decode('utf-8') if isinstance(n, bytes) else n
+            for n in self.connection.smembers(ACTIVE_KEY)
+        )
+        for name in sorted(active - set(self.ring)):
+            self.ring.append(name)
+
+    def retire(self, name):
+        """
+        Removes an empty sub-queue from the active ones. Enqueueing adds
+        it again after pushing the job, so checking the length after the
+        removal catches a job pushed meanwhile, whose queue is listed
+        again.
+        """
+        sub_queue = Queue(name, connection=self.connection)
+        pipe = self.connection.pipeline()
+        pipe.srem(ACTIVE_KEY, name)
+        pipe.srem(Queue.redis_queues_keys, sub_queue.key)
+        pipe.execute()
+        if sub_queue.count:
+            pipe = self.connection.pipeline()
+            pipe.sadd(ACTIVE_KEY, name)
+            pipe.sadd(Queue.redis_queues_keys, sub_queue.key)
+            pipe.execute()
+            return False
+        self.deficit.pop(name, None)
+        return True
+
+    def dequeue(self):
+        """
+        Returns (job, queue) of the next turn, None when all are empty.
+        """
+        self.refresh()
+        visits = len(self.ring)
+        while visits and self.ring:
+            name = self.ring[0]
+            deficit = self.deficit.get(name, 0)
+            if deficit < 1:
+                deficit += self.weight(name)
+            if deficit < 1:
+                # weights below 1 get a turn every few rounds
+                self.deficit[name] = deficit
+                self.ring.rotate(-1)
+                visits -= 1
+                continue
+            current = Queue(name, connection=self.connection)
+            job = current.dequeue()
+            if job is None:
+                self.deficit[name] = 0
+                visits -= 1
+                if name in SHARED:
+                    self.ring.rotate(-1)
+                elif self.retire(name):
+                    self.ring.popleft()
+                else:
+                    self.ring.rotate(-1)
+                continue
+            self.deficit[name] = deficit - 1
+            if self.deficit[name] < 1:
+                self.ring.rotate(-1)
+            return job, current
+        return None
+
+    def next_job(self, queues):
+        """
+        Returns (job, queue) of the first of `queues` with a job, the
+        shared ones served in turns with the sub-queues.
+        """
+        shared = False
+        for current in queues:
+            if current.name in SHARED:
+                if shared:
+                    continue
+                shared = True
+                result = self.dequeue()
+                if result is not None:
+                    return result
+                continue
+            job = current.dequeue()
+            if job is not None:
+                return job, current
+        return None
+
+    def listened(self, queues):
+        """
+        The queues to wait on when all are empty.
+        """
+        self.refresh()
+        names = [q.name for q in queues]
+        return list(queues) + [
+            Queue(n, connection=self.connection)
+            for n in self.ring if n not in names
+        ]
+
+
+class FairWorker(Worker):
+    """
+    RQ worker taking its jobs from a `Scheduler`. The `ticks` are called
+    before every dequeue, at least every `poll_interval` seconds while
+    the worker is idle.
+    """
+
+    def __init__(self, queues, scheduler, poll_interval=1, ticks=(),
+                 **kwargs):
+        super(FairWorker, self).__init__(queues, **kwargs)
+        self.scheduler = scheduler
+        self.poll_interval = poll_interval
+        self.ticks = ticks
+
+    def tick(self):
+        for f in self.ticks:
+            try:
+                f()
+            except Exception as e:
+                self.log.warning('{} failed: {}'.format(
+                    getattr(f, '__name__', f), str(e)
+                ))
+
+    def perform_job(self, *args, **kwargs):
+        try:
+            return super(FairWorker, self).perform_job(*args, **kwargs)
+        finally:
+            # the work horse exits right after the job, without atexit
+            logs.flush()
+
+    def dequeue_job_and_maintain_ttl(self, timeout):
+        result = None
+        self.set_state(WorkerStatus.IDLE)
+        self.procline('Listening on {}'.format(','.join(self.queue_names())))
+        while True:
+            self.heartbeat()
+            self.tick()
+            result = self.scheduler.next_job(self.queues)
+            # timeout is None in burst mode
+            if result is not None or timeout is None:
+                break
+            try:
+                # waits briefly, new sub-queues are only seen by refreshing
+                result = self.queue_class.dequeue_any(
+                    self.scheduler.listened(self.queues),
+                    max(1, int(min(timeout, self.poll_interval))),
+                    connection=self.connection
+                )
+                if result is not None:
+                    break
+            except DequeueTimeout:
+                pass
+        self.heartbeat()
+        if result is not None:
+            job, current = result
+            self.log.info('{}: {} ({})'.format(
+                current.name, job.description, job.id
+            ))
+        return result
@@ -0,0 +1,166 @@
+"""
+Logging of the trelolo loggers.
+
+Logging a record only puts it in a bounded queue, a listener thread
+formats the records and writes them to stderr. A full queue drops
+records instead of blocking. Records below WARNING are sampled per
+logger (LOG_RATE per second, bursts of LOG_BURST) and messages are cut
+at LOG_MAX_LENGTH characters. The next record let through tells how many
+were dropped. With LOG_FORMAT=json every record is a JSON line.
+
+RQ forks a work horse per job: the listener starts again in it, and the
+worker waits for the queue to be written before the horse exits.
+"""
+import atexit
+from collections import OrderedDict
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import os
+import queue
+import sys
+import threading
+
+from rainbow_logging_handler import RainbowLoggingHandler
+
+from trelolo.config import Config
+from trelolo.trelolo.helpers import RateLimiter
+
+TEXT_FORMAT = "%(asctime)s %(name)s %(funcName)s():%(lineno)d\t%(message)s"
+
+
+class Sampler(logging.Filter):
+    """
+    Lets through up to `rate` records per second of every logger below
+    WARNING, and counts the others.
+    """
+
+    def __init__(self, rate, burst=None):
+        super(Sampler, self).__init__()
+        self.rate = rate
+        self.burst = burst
+        self.limiters = {}
+        self.dropped = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        with self.lock:
+            limiter = self.limiters.get(record.name)
+            if limiter is None:
+                limiter = self.limiters[record.name] = RateLimiter(
+                    self.rate, self.burst
+                )
+            if not limiter.acquire():
+                self.dropped[record.name] = \
+                    self.dropped.get(record.name, 0) + 1
+                return False
+            record.dropped = self.dropped.pop(record.name, 0)
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = OrderedDict([
+            ('time', self.formatTime(record)),
+            ('level', record.levelname),
+            ('logger', record.name),
+            ('pid', record.process),
+            ('message', record.getMessage())
+        ])
+        if getattr(record, 'dropped', 0):
+            entry['dropped'] = record.dropped
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class AsyncHandler(QueueHandler):
+    """
+    Queues the records for a listener thread writing them with
+    `handlers`.
+    """
+
+    def __init__(self, handlers, size=10000, max_length=2000):
+        super(AsyncHandler, self).__init__(queue.Queue(size))
+        self.targets = handlers
+        self.max_length = max_length
+        self.listener = None
+        self.pid = None
+        self.dropped = 0
+
+    def start(self):
+        if self.listener is not None and self.pid == os.getpid():
+            return
+        # a forked process gets a copy of the queue but not the thread
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.listener = QueueListener(
+            self.queue, *self.targets, respect_handler_level=True
+        )
+        self.listener.start()
+        self.pid = os.getpid()
+
+    def prepare(self, record):
+        # formatting is left to the listener
+        message = record.getMessage()
+        if len(message) > self.max_length:
+            message = '{}... ({} characters)'.format(
+                message[:self.max_length], len(message)
+            )
+        dropped = getattr(record, 'dropped', 0) + self.dropped
+        self.dropped = 0
+        if dropped and not isinstance(self.targets[0].formatter,
+                                      JSONFormatter):
+            message = '{} ({} records dropped)'.format(message, dropped)
+        record.msg = message
+        record.args = None
+        record.dropped = dropped
+        return record
+
+    def enqueue(self, record):
+        self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """
+        Waits until the listener wrote the queued records.
+        """
+        if self.listener is not None and self.pid == os.getpid():
+            self.queue.join()
+
+
+def get_target(log_format):
+    if log_format == 'json':
+        target = logging.StreamHandler(sys.stderr)
+        target.setFormatter(JSONFormatter())
+    else:
+        target = RainbowLoggingHandler(sys.stderr)
+        target.setFormatter(logging.Formatter(TEXT_FORMAT))
+    return target
+
+
+def setup(logger):
+    if Config.LOG_FORMAT == 'json':
+        # the JSON lines leave out the caller, so don't look it up
+        logging._srcfile = None
+    handler = AsyncHandler(
+        [get_target(Config.LOG_FORMAT)], Config.LOG_QUEUE_SIZE,
+        Config.LOG_MAX_LENGTH
+    )
+    if Config.LOG_RATE > 0:
+        handler.addFilter(Sampler(Config.LOG_RATE, Config.LOG_BURST))
+    logger.setLevel(Config.LOG_LEVEL)
+    logger.addHandler(handler)
+    atexit.register(flush)
+    return handler
+
+
+def flush():
+    for handler in logging.getLogger('trelolo').handlers:
+        if isinstance(handler, AsyncHandler):
+            handler.flush()
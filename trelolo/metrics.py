@@ -0,0 +1,208 @@
+from datetime import datetime
+from functools import wraps
+import logging
+import os
+import re
+import threading
+import time
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+from flask import Blueprint, Response, request
+from prometheus_client import (
+    CollectorRegistry, Counter, Histogram, REGISTRY,
+    CONTENT_TYPE_LATEST, generate_latest, make_wsgi_app, multiprocess
+)
+from prometheus_client.core import GaugeMetricFamily
+from rq import Queue
+
+from .extensions import rq
+
+log = logging.getLogger(__name__)
+
+MULTIPROC_DIR_ENV = 'prometheus_multiproc_dir'
+
+WEBHOOK_REQUESTS = Counter(
+    'trelolo_webhook_requests_total',
+    'Webhook requests received',
+    ['route', 'status']
+)
+WEBHOOK_LATENCY = Histogram(
+    'trelolo_webhook_latency_seconds',
+    'Time spent answering a webhook request',
+    ['route']
+)
+ENQUEUE_LATENCY = Histogram(
+    'trelolo_enqueue_latency_seconds',
+    'Time spent enqueueing a job',
+    ['queue', 'handler']
+)
+JOB_DURATION = Histogram(
+    'trelolo_job_duration_seconds',
+    'Time spent running a job handler',
+    ['handler', 'status']
+)
+UPSTREAM_REQUESTS = Counter(
+    'trelolo_upstream_requests_total',
+    'Requests sent to the Trello and GitLab APIs',
+    ['service', 'method', 'endpoint', 'status']
+)
+UPSTREAM_LATENCY = Histogram(
+    'trelolo_upstream_latency_seconds',
+    'Latency of requests sent to the Trello and GitLab APIs',
+    ['service', 'method', 'endpoint']
+)
+
+ID_SEGMENT = re.compile(r'/(?:[0-9a-fA-F]{24,}|\d+)(?=/|$)')
+# the Trello token is part of the webhook paths
+TOKEN_SEGMENT = re.compile(r'/tokens/[^/]+')
+
+
+def endpoint_template(path):
+    """
+    Turns a request path into a low cardinality label,
+    e.g. /cards/58a1.../checkItem/58b2... -> /cards/:id/checkItem/:id
+    """
+    path = path.split('?')[0].rstrip('/')
+    if not path.startswith('/'):
+        path = '/' + path
+    path = TOKEN_SEGMENT.sub('/tokens/:token', path)
+    return ID_SEGMENT.sub('/:id', path)
+
+
+def observe_upstream(service, method, path, status, duration):
+    endpoint = endpoint_template(path)
+    UPSTREAM_REQUESTS.labels(service, method, endpoint, str(status)).inc()
+    UPSTREAM_LATENCY.labels(service, method, endpoint).observe(duration)
+
+
+def observe_webhook(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        start = time.time()
+        status = 500
+        try:
+            response = f(*args, **kwargs)
+            status = getattr(response, 'status_code', 200)
+            return response
+        finally:
+            route = request.url_rule.rule if request.url_rule else 'unknown'
+            WEBHOOK_REQUESTS.labels(route, str(status)).inc()
+            WEBHOOK_LATENCY.labels(route).observe(time.time() - start)
+    return decorated
+
+
+def enqueue(queue, f, *args, **kwargs):
+    start = time.time()
+    try:
+        return queue.enqueue(f, *args, **kwargs)
+    finally:
+        ENQUEUE_LATENCY.labels(
+            queue.name, getattr(f, '__name__', str(f))
+        ).observe(time.time() - start)
+
+
+def observe_job(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        start = time.time()
+        status = 'failed'
+        try:
+            result = f(*args, **kwargs)
+            status = 'finished'
+            return result
+        finally:
+            JOB_DURATION.labels(f.__name__, status).observe(
+                time.time() - start
+            )
+    return decorated
+
+
+class QueueCollector(object):
+    """
+    Reports depth and lag (age of the oldest job) of every RQ queue
+    at scrape time.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def collect(self):
+        depth = GaugeMetricFamily(
+            'trelolo_queue_depth', 'Jobs waiting in a queue',
+            labels=['queue']
+        )
+        lag = GaugeMetricFamily(
+            'trelolo_queue_lag_seconds', 'Age of the oldest queued job',
+            labels=['queue']
+        )
+        now = datetime.utcnow()
+        for queue in Queue.all(connection=self.connection):
+            depth.add_metric([queue.name], queue.count)
+            oldest = next(iter(queue.get_jobs(0, 1)), None)
+            age = 0
+            if oldest is not None and oldest.enqueued_at:
+                age = (now - oldest.enqueued_at).total_seconds()
+            lag.add_metric([queue.name], max(age, 0))
+        yield depth
+        yield lag
+
+
+def get_registry():
+    if MULTIPROC_DIR_ENV in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def render(with_queues=True):
+    output = generate_latest(get_registry())
+    if with_queues:
+        registry = CollectorRegistry()
+        registry.register(QueueCollector(rq))
+        output += generate_latest(registry)
+    return output
+
+
+def mark_process_dead(pid):
+    """
+    Drops the live gauges of an exited web or worker process.
+    """
+    if MULTIPROC_DIR_ENV in os.environ:
+        multiprocess.mark_process_dead(pid)
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_worker_exporter(port, addr=''):
+    """
+    Serves job and upstream metrics of the worker and its work horses.
+    Work horses are forked per job, so the multiprocess mode has to be
+    enabled for their samples to survive.
+    """
+    if MULTIPROC_DIR_ENV not in os.environ:
+        log.warning(
+            '{} is not set, metrics of forked jobs will be lost'.format(
+                MULTIPROC_DIR_ENV
+            )
+        )
+    server = make_server(
+        addr, port, make_wsgi_app(get_registry()),
+        handler_class=_QuietHandler
+    )
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    log.info('serving worker metrics on port {}'.format(port))
+    return server
+
+
+bp = Blueprint('metrics', __name__)
+
+
+@bp.route('/metrics', methods=['GET'])
+def show_metrics():
+    return Response(render(), content_type=CONTENT_TYPE_LATEST)
@@ -1,37 +1,67 @@
+from datetime import datetime
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
 from .extensions import db
 
+BULK_CHUNK = 500
+
 
 class Emails(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.Unicode(45), nullable=False, index=True)
+    email = db.Column(db.Unicode(45), nullable=False)
+
+
+class EmailsImport(db.Model):
+    """
+    Staging rows of an emails upload, see `admin.imports`.
+    """
+    __tablename__ = 'emails_import'
+    id = db.Column(db.Integer, primary_key=True)
+    batch = db.Column(db.Unicode(32), nullable=False, index=True)
     username = db.Column(db.Unicode(45), nullable=False)
     email = db.Column(db.Unicode(45), nullable=False)
 
 
 class Boards(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    trello_id = db.Column(db.Unicode(45), nullable=False)
+    trello_id = db.Column(db.Unicode(45), nullable=False, unique=True)
     name = db.Column(db.Unicode(100), nullable=False)
     type = db.Column(db.Integer, default=3, nullable=False)
     hook_id = db.Column(db.Unicode(45), nullable=False)
     hook_url = db.Column(db.Unicode(400), nullable=False)
+    # id of the last board action seen by the reconciliation
+    actions_since = db.Column(db.Unicode(45))
 
 
 class Cards(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    card_id = db.Column(db.Unicode(45), nullable=False, index=True)
+    # one check item per child card
+    card_id = db.Column(
+        db.Unicode(45), nullable=False, unique=True, index=True
+    )
     board_id = db.Column(db.Unicode(45), nullable=False, index=True)
     parent_card_id = db.Column(db.Unicode(45), nullable=False, index=True)
     item_id = db.Column(db.Unicode(45), nullable=False, index=True)
     item_name = db.Column(db.Unicode(400), nullable=False)
     checked = db.Column(db.Boolean, default=False, nullable=False)
-    label = db.Column(db.Unicode(100), nullable=False)
+    label = db.Column(db.Unicode(100), nullable=False, index=True)
     hook_id = db.Column(db.Unicode(45), nullable=False)
     hook_url = db.Column(db.Unicode(400))
 
 
 class Issues(db.Model):
+    # one check item per GitLab target and parent card, also serves the
+    # lookups by (issue_id, target_type) with or without project_id
+    __table_args__ = (
+        db.UniqueConstraint(
+            'issue_id', 'target_type', 'parent_card_id',
+            name='uq_issues_target_card'
+        ),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    issue_id = db.Column(db.Unicode(45), nullable=False, index=True)
+    issue_id = db.Column(db.Unicode(45), nullable=False)
     project_id = db.Column(db.Unicode(45), nullable=False, index=True)
     parent_card_id = db.Column(db.Unicode(45), nullable=False, index=True)
     item_id = db.Column(db.Unicode(45), nullable=False, index=True)
@@ -42,3 +72,89 @@ class Issues(db.Model):
     hook_url = db.Column(db.Unicode(400), nullable=False)
     checked = db.Column(db.Boolean, default=False, nullable=False)
     target_type = db.Column(db.Unicode(10), default='issue', nullable=False)
+
+
+class WebhookEvents(db.Model):
+    """
+    Append-only inbox of raw webhook bodies, see `payloads.inbox`.
+    """
+    id = db.Column(
+        db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True
+    )
+    route = db.Column(db.Unicode(20), nullable=False)
+    body = db.Column(db.UnicodeText, nullable=False)
+    received_at = db.Column(
+        db.DateTime, default=datetime.utcnow, nullable=False, index=True
+    )
+    # set by the drainer, `card:<id>` or `<type>:<project>:<id>`
+    key = db.Column(db.Unicode(100), index=True)
+    processed_at = db.Column(db.DateTime, index=True)
+    error = db.Column(db.Unicode(400))
+
+
+def chunks(values, size=BULK_CHUNK):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def upsert(model, rows, keys, update=True):
+    """
+    Inserts the rows (dicts of column values) or updates the existing rows
+    matching them on the unique `keys` columns, without committing. Uses
+    INSERT .. ON CONFLICT on postgres and a lookup elsewhere. Without
+    `update` existing rows are left alone and the number of inserted rows
+    is returned.
+    """
+    rows = list(rows)
+    if not rows:
+        return 0
+    if db.session.bind.dialect.name == 'postgresql':
+        inserted = 0
+        for chunk in chunks(rows):
+            stmt = pg_insert(model.__table__).values(chunk)
+            if not update:
+                stmt = stmt.on_conflict_do_nothing(index_elements=keys)
+                inserted += db.session.execute(stmt).rowcount
+                continue
+            stmt = stmt.on_conflict_do_update(
+                index_elements=keys,
+                set_=dict(
+                    (c, stmt.excluded[c]) for c in chunk[0] if c not in keys
+                )
+            )
+            db.session.execute(stmt)
+        return len(rows) if update else inserted
+    columns = [getattr(model, k) for k in keys]
+    existing = {}
+    for chunk in chunks(rows):
+        query = db.session.query(model.id, *columns)
+        for column in columns:
+            query = query.filter(
+                column.in_(set(r[column.key] for r in chunk))
+            )
+        existing.update((tuple(found[1:]), found[0]) for found in query)
+    inserts, updates = [], []
+    for row in rows:
+        id = existing.get(tuple(row[k] for k in keys))
+        if id is None:
+            inserts.append(row)
+        else:
+            updates.append(dict(row, id=id))
+    db.session.bulk_insert_mappings(model, inserts)
+    if not update:
+        return len(inserts)
+    db.session.bulk_update_mappings(model, updates)
+    return len(rows)
+
+
+def delete_rows(model, column, values):
+    """
+    Deletes the rows whose `column` is in `values` without committing.
+    """
+    deleted = 0
+    for chunk in chunks(set(values)):
+        deleted += model.query.filter(column.in_(chunk)).delete(
+            synchronize_session=False
+        )
+    return deleted
@@ -0,0 +1,107 @@
+"""
+Backpressure of the webhook intake.
+
+When more than INTAKE_PRESSURE_DEPTH webhook jobs wait in `default` and
+the fair queues, the intake is under pressure: events which only resync
+a card no longer become one job each but mark the card dirty. Marking a
+card which is dirty already does nothing, the single job of the marker
+resyncs the card once for all its events. Once the queues are down to
+INTAKE_RELIEF_DEPTH the intake goes back to a job per event.
+
+The state is shared by all processes through redis, every process looks
+at the queues at most every INTAKE_PRESSURE_INTERVAL seconds.
+"""
+import logging
+import time
+
+from rq import Queue
+
+from trelolo.config import Config
+from trelolo.extensions import rq
+from trelolo import fair
+
+log = logging.getLogger(__name__)
+
+PRESSURE_KEY = 'trelolo:intake:pressure'
+# job keys of markers end with it, e.g. card:<id>:dirty
+MARKER_SUFFIX = ':dirty'
+MARKER_KEY = 'trelolo:dirty:{}'
+# a marker whose job got lost only swallows events that long
+MARKER_TTL = 3600
+
+state = {'checked': 0, 'pressure': False}
+
+
+def depth():
+    """
+    Returns the number of webhook jobs waiting.
+    """
+    names = list(fair.SHARED) + [
+        n.decode('utf-8') for n in rq.smembers(fair.ACTIVE_KEY)
+    ]
+    pipe = rq.pipeline()
+    for name in names:
+        pipe.llen(Queue(name, connection=rq).key)
+    return sum(pipe.execute())
+
+
+def check():
+    waiting = depth()
+    if waiting >= Config.INTAKE_PRESSURE_DEPTH:
+        if rq.set(PRESSURE_KEY, waiting, nx=True):
+            log.warning(
+                'intake under pressure, {} jobs waiting'.format(waiting)
+            )
+        return True
+    if waiting <= Config.INTAKE_RELIEF_DEPTH:
+        if rq.delete(PRESSURE_KEY):
+            log.warning(
+                'intake relieved, {} jobs waiting'.format(waiting)
+            )
+        return False
+    return rq.exists(PRESSURE_KEY)
+
+
+def is_active():
+    """
+    Tells whether the intake is under pressure, checking the queues at
+    most every INTAKE_PRESSURE_INTERVAL seconds.
+    """
+    if Config.INTAKE_PRESSURE_DEPTH <= 0:
+        return False
+    now = time.time()
+    if now - state['checked'] >= Config.INTAKE_PRESSURE_INTERVAL:
+        state['checked'] = now
+        state['pressure'] = bool(check())
+    return state['pressure']
+
+
+def marker(key):
+    return key + MARKER_SUFFIX
+
+
+def is_marker(key):
+    return key is not None and key.endswith(MARKER_SUFFIX)
+
+
+def mark(f, args, key, tenant):
+    """
+    Enqueues the job of a marker unless the marker is set already.
+    Returns the job, None when it was pending.
+    """
+    name = MARKER_KEY.format(key[:-len(MARKER_SUFFIX)])
+    if not rq.set(name, 1, nx=True, ex=MARKER_TTL):
+        return None
+    try:
+        return fair.enqueue(f, args, tenant)
+    except Exception:
+        rq.delete(name)
+        raise
+
+
+def clear(key):
+    """
+    Removes a marker when its job starts, events arriving meanwhile set
+    it again.
+    """
+    rq.delete(MARKER_KEY.format(key))
@@ -0,0 +1,64 @@
+"""
+Compact job payloads.
+
+Webhook jobs get the fields their handler reads as a small versioned JSON
+string instead of the picked webhook dict, so RQ pickles a short string
+and redis keeps a fraction of the bytes. Large values such as the GitLab
+description are left out and read by the job when it runs.
+
+A worker refuses envelopes of a newer version, their jobs fail and can be
+requeued once every worker runs the new release. Dicts enqueued by older
+releases are still accepted.
+"""
+import json
+
+VERSION = 1
+
+TRELLO_FIELDS = (
+    'action', 'card.id', 'label.name', 'label.color', 'old.name',
+    'checklist.id', 'checkItem.id', 'checkItem.state'
+)
+GITLAB_FIELDS = (
+    'action', 'id', 'project_id', 'type', 'target_url', 'title', 'url',
+    'state', 'milestone_id', 'assignee_id'
+)
+
+
+def pick(data, fields):
+    """
+    Copies the dotted `fields` present in `data`, keeping their nesting.
+    """
+    picked = {}
+    for field in fields:
+        value = data
+        try:
+            for part in field.split('.'):
+                value = value[part]
+        except (KeyError, TypeError):
+            continue
+        parent = picked
+        *path, name = field.split('.')
+        for part in path:
+            parent = parent.setdefault(part, {})
+        parent[name] = value
+    return picked
+
+
+def pack(data, fields):
+    return json.dumps(
+        {'v': VERSION, 'd': pick(data, fields)},
+        separators=(',', ':'), sort_keys=True
+    )
+
+
+def unpack(payload):
+    if isinstance(payload, dict):
+        return payload
+    envelope = json.loads(payload)
+    if envelope['v'] > VERSION:
+        raise ValueError(
+            'payload version {} is newer than {}'.format(
+                envelope['v'], VERSION
+            )
+        )
+    return envelope['d']
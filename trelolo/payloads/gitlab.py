@@ -1,13 +1,33 @@
+import re
+
 from flask import Blueprint, request
-from rq import Queue
 
-from trelolo.config import Config
-from trelolo.extensions import rq
-from trelolo import worker
+from trelolo import fair, metrics, worker
+from trelolo.payloads import envelope, inbox
 
 ALLOWED_WEBHOOK_ACTIONS = ('open', 'update', 'close', 'reopen')
 
 
+# the object attributes `dispatch` reads, the description is left out
+TRIMMED_ATTRIBUTES = (
+    'action', 'id', 'title', 'url', 'milestone_id', 'state', 'assignee_id',
+    'project_id', 'source_project_id'
+)
+
+
+def trim(json):
+    """
+    Returns the parts of a webhook body `dispatch` reads.
+    """
+    data = json['object_attributes']
+    return {
+        'object_kind': json['object_kind'],
+        'object_attributes': {
+            k: data[k] for k in TRIMMED_ATTRIBUTES if k in data
+        }
+    }
+
+
 def pick_data(json):
     data = json['object_attributes']
     picked = {
@@ -16,7 +36,7 @@ def pick_data(json):
         'title': data['title'],
         'url': data['url'],
         'milestone_id': data['milestone_id'],
-        'description': data['description'],
+        'description': data.get('description'),
         'type': 'issue' if json['object_kind'] != 'merge_request' else 'mr',
         'target_url': 'issues'
                       if json['object_kind'] != 'merge_request'
@@ -31,25 +51,43 @@ def pick_data(json):
     return picked
 
 
-q = Queue(
-    connection=rq,
-    default_timeout=Config.QUEUE_TIMEOUT
-)
+def dispatch(json):
+    """
+    Returns the jobs for one webhook body as (function, args, key, tenant)
+    tuples, see `trello.dispatch`.
+    """
+    if json['object_attributes']['action'] not in ALLOWED_WEBHOOK_ACTIONS:
+        return []
+    data = pick_data(json)
+    key = '{}:{}:{}'.format(data['type'], data['project_id'], data['id'])
+    payload = envelope.pack(data, envelope.GITLAB_FIELDS)
+    tenant = fair.gitlab_tenant(data['project_id'])
+    if data['action'] in ('close', 'reopen'):
+        return [(worker.payload_gitlab_state_change, (payload,), key, tenant)]
+    return [(worker.payload_gitlab_generic_event, (payload,), key, tenant)]
+
+
+# matches nested keys too, so it only rules out events without any of the
+# allowed actions
+ACTION_PATTERN = re.compile(br'"action"\s*:\s*"(\w+)"')
+
+
+def prefilter(body):
+    return any(
+        a.decode('utf-8') in ALLOWED_WEBHOOK_ACTIONS
+        for a in ACTION_PATTERN.findall(body)
+    )
+
 
 bp = Blueprint('gitlab', __name__)
 
 
 @bp.route(
     '/callback/gitlab',
-    methods=['GET', 'POST']
+    methods=['GET', 'HEAD', 'POST']
 )
+@metrics.observe_webhook
 def gitlab_webhook():
     if request.method == 'POST':
-        json = request.json
-        if json['object_attributes']['action'] in ALLOWED_WEBHOOK_ACTIONS:
-            data = pick_data(json)
-            if json['object_attributes']['action'] in ('close', 'reopen'):
-                q.enqueue(worker.payload_gitlab_state_change, data)
-            else:
-                q.enqueue(worker.payload_gitlab_generic_event, data)
+        inbox.accept('gitlab', dispatch, prefilter, trim)
     return __name__
@@ -0,0 +1,238 @@
+"""
+Intake of webhooks.
+
+With WEBHOOK_INTAKE=inbox the webhook routes only append the raw body to
+the `webhook_events` table and `manage.py drain` turns the stored events
+into RQ jobs. The table is the source of truth for replays and backfills.
+
+With WEBHOOK_INTAKE=redis only the parts of the body the dispatchers
+read are pushed to a redis list with a single LPUSH and `manage.py
+ingest` turns them into RQ jobs. This is the fastest way to answer, but
+events taken by a crashing consumer are lost.
+"""
+from collections import OrderedDict
+from datetime import datetime
+from json import dumps, loads
+import logging
+
+from flask import request
+from sqlalchemy import or_
+
+from trelolo.config import Config
+from trelolo.extensions import db, rq
+from trelolo import fair, models
+from trelolo.payloads import backpressure
+
+log = logging.getLogger(__name__)
+
+STREAM_KEY = 'trelolo:webhooks'
+
+
+def get_dispatchers():
+    from trelolo.payloads import gitlab, trello
+    return {
+        'teamboard': trello.dispatch_teamboard,
+        'mainboard': trello.dispatch_mainboard,
+        'gitlab': gitlab.dispatch
+    }
+
+
+def enqueue_jobs(jobs):
+    """
+    Enqueues the jobs and returns the number of jobs enqueued, jobs of
+    markers which are set already are left out.
+    """
+    queued = 0
+    for f, args, key, tenant in jobs:
+        if backpressure.is_marker(key):
+            job = backpressure.mark(f, args, key, tenant)
+        else:
+            job = fair.enqueue(f, args, tenant)
+        queued += job is not None
+    return queued
+
+
+def dispatch_body(route, body, dispatchers):
+    return dispatchers[route](loads(body))
+
+
+def accept(route, dispatch, prefilter, trim):
+    """
+    Handles a webhook request of `route` according to WEBHOOK_INTAKE.
+    `prefilter` gets the raw body and rejects events which are ignored
+    anyway, without parsing it. `trim` returns the parts of the body
+    `dispatch` reads.
+    """
+    if Config.WEBHOOK_INTAKE == 'queue':
+        enqueue_jobs(dispatch(request.json))
+        return
+    body = request.get_data()
+    if not prefilter(body):
+        return
+    if Config.WEBHOOK_INTAKE == 'redis':
+        try:
+            trimmed = trim(loads(body.decode('utf-8')))
+        except (KeyError, TypeError, ValueError) as e:
+            log.warning('skipping webhook event: {}: {}'.format(
+                type(e).__name__, str(e)
+            ))
+            return
+        push(route, dumps(trimmed, separators=(',', ':')).encode('utf-8'))
+    else:
+        # the inbox keeps the raw body for replays
+        append(route, body.decode('utf-8'))
+
+
+def append(route, body):
+    db.session.add(models.WebhookEvents(route=route, body=body))
+    db.session.commit()
+
+
+def claim(limit):
+    """
+    Locks up to `limit` unprocessed events, rows locked by another drainer
+    are skipped. The locks are held until the session commits.
+    """
+    return models.WebhookEvents.query.filter(
+        models.WebhookEvents.processed_at.is_(None)
+    ).order_by(
+        models.WebhookEvents.id
+    ).limit(limit).with_for_update(skip_locked=True).all()
+
+
+def coalesce(jobs):
+    """
+    Keeps only the last of the jobs running the same function for the same
+    key, at the position of the last one.
+    """
+    kept = OrderedDict()
+    for i, (f, args, key, tenant) in enumerate(jobs):
+        group = (f.__name__, key) if key is not None else i
+        kept.pop(group, None)
+        kept[group] = (f, args, key, tenant)
+    return list(kept.values())
+
+
+def drain(limit=None):
+    """
+    Dispatches one batch of events and returns the number of events taken.
+    When enqueueing fails the transaction is rolled back and the events
+    stay in the inbox.
+    """
+    events = claim(limit or Config.INBOX_BATCH_SIZE)
+    if not events:
+        db.session.commit()
+        return 0
+    dispatchers = get_dispatchers()
+    jobs = []
+    now = datetime.utcnow()
+    for event in events:
+        event.processed_at = now
+        try:
+            dispatched = dispatch_body(event.route, event.body, dispatchers)
+        except (KeyError, TypeError, ValueError) as e:
+            event.error = '{}: {}'.format(type(e).__name__, str(e))[:400]
+            log.warning(
+                'skipping webhook event {}: {}'.format(event.id, event.error)
+            )
+            continue
+        if dispatched:
+            event.key = dispatched[0][2]
+        jobs.extend(dispatched)
+    try:
+        queued = enqueue_jobs(coalesce(jobs))
+    except Exception:
+        db.session.rollback()
+        raise
+    db.session.commit()
+    log.info(
+        'drained {} webhook events into {} jobs ({} merged)'.format(
+            len(events), queued, len(jobs) - queued
+        )
+    )
+    return len(events)
+
+
+def replay(since, until=None, route=None, key=None):
+    """
+    Marks the matching events unprocessed again so the drainer dispatches
+    them once more. Returns the number of events.
+    """
+    query = models.WebhookEvents.query.filter(
+        models.WebhookEvents.received_at >= since
+    )
+    if until is not None:
+        query = query.filter(models.WebhookEvents.received_at < until)
+    if route is not None:
+        query = query.filter_by(route=route)
+    if key is not None:
+        # card:<id> also matches the check items of the card
+        query = query.filter(or_(
+            models.WebhookEvents.key == key,
+            models.WebhookEvents.key.like('{}:%'.format(key))
+        ))
+    count = query.update(
+        {'processed_at': None, 'error': None}, synchronize_session=False
+    )
+    db.session.commit()
+    log.info('{} webhook events queued for replay'.format(count))
+    return count
+
+
+def push(route, body):
+    rq.lpush(STREAM_KEY, route.encode('utf-8') + b' ' + body)
+
+
+def take(limit, timeout):
+    """
+    Waits up to `timeout` seconds for pushed events and returns up to
+    `limit` of them, oldest first.
+    """
+    first = rq.brpop(STREAM_KEY, int(max(timeout, 1)))
+    if first is None:
+        return []
+    items = [first[1]]
+    if limit > 1:
+        pipe = rq.pipeline()
+        pipe.lrange(STREAM_KEY, -(limit - 1), -1)
+        pipe.ltrim(STREAM_KEY, 0, -limit)
+        items.extend(reversed(pipe.execute()[0]))
+    return items
+
+
+def consume(limit=None, timeout=None):
+    """
+    Dispatches one batch of pushed events and returns the number of events
+    taken. When enqueueing fails the events are pushed back.
+    """
+    items = take(
+        limit or Config.INBOX_BATCH_SIZE,
+        Config.INBOX_POLL_INTERVAL if timeout is None else timeout
+    )
+    if not items:
+        return 0
+    dispatchers = get_dispatchers()
+    jobs = []
+    for item in items:
+        route, body = item.split(b' ', 1)
+        try:
+            jobs.extend(
+                dispatch_body(
+                    route.decode('utf-8'), body.decode('utf-8'), dispatchers
+                )
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            log.warning('skipping pushed webhook event: {}: {}'.format(
+                type(e).__name__, str(e)
+            ))
+    try:
+        queued = enqueue_jobs(coalesce(jobs))
+    except Exception:
+        rq.rpush(STREAM_KEY, *reversed(items))
+        raise
+    log.info(
+        'ingested {} webhook events into {} jobs ({} merged)'.format(
+            len(items), queued, len(jobs) - queued
+        )
+    )
+    return len(items)
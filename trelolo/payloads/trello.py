@@ -1,16 +1,63 @@
+import re
+
 from flask import Blueprint, request
-from rq import Queue
 
 from trelolo.config import Config
 from trelolo.extensions import rq
-from trelolo import worker
+from trelolo import fair, metrics, worker
+from trelolo.payloads import backpressure, envelope, inbox
 
 
+# changes of checklists which only update the completeness of the card
+CHECKLIST_EVENTS = (
+    'createCheckItem', 'deleteCheckItem', 'removeChecklistFromCard'
+)
 ALLOWED_WEBHOOK_ACTIONS = (
     'addChecklistToCard', 'addLabelToCard', 'addMemberToCard',
     'deleteCard', 'removeLabelFromCard',
     'updateCheckItemStateOnCard', 'updateLabel'
-)
+) + CHECKLIST_EVENTS
+
+
+# team board actions dispatched already, reconciliation skips them
+SEEN_KEY = 'trelolo:action:{}'
+# reconciliation only fetches actions since the previous one
+SEEN_RECONCILIATIONS = 3
+
+
+def mark_seen(action_id):
+    rq.set(
+        SEEN_KEY.format(action_id), 1,
+        ex=max(Config.RECONCILE_INTERVAL, 1) * 60 * SEEN_RECONCILIATIONS
+    )
+
+
+def unseen(actions):
+    """
+    Returns the actions which were not dispatched yet.
+    """
+    pipe = rq.pipeline()
+    for action in actions:
+        pipe.exists(SEEN_KEY.format(action['id']))
+    return [a for a, seen in zip(actions, pipe.execute()) if not seen]
+
+
+# the action data `dispatch` reads
+TRIMMED_DATA = ('board', 'card', 'old', 'label', 'checklist', 'checkItem')
+
+
+def trim(json):
+    """
+    Returns the parts of a webhook body `dispatch` reads.
+    """
+    action = json['action']
+    return {'action': {
+        'id': action.get('id'),
+        'type': action['type'],
+        'data': {
+            k: v for k, v in action['data'].items() if k in TRIMMED_DATA
+        }
+    }}
 
 
 def pick_data(json):
@@ -21,7 +68,7 @@ def pick_data(json):
         'old': {},
         'label': {}
     }
-    for i in ('card', 'old', 'label'):
+    for i in ('card', 'old', 'label', 'checklist', 'checkItem'):
         try:
             picked[i] = data[i]
         except KeyError:
@@ -29,72 +76,109 @@ def pick_data(json):
     return picked
 
 
-q = Queue(
-    connection=rq,
-    default_timeout=Config.QUEUE_TIMEOUT
+TEAMBOARD_EVENTS = (
+    'addLabelToCard', 'addChecklistToCard', 'addMemberToCard',
+    'updateCheckItemStateOnCard', 'removeLabelFromCard'
 )
+MAINBOARD_EVENTS = (
+    'addLabelToCard', 'addChecklistToCard',
+    'updateCheckItemStateOnCard', 'removeLabelFromCard'
+)
+LABEL_EVENTS = ('addLabelToCard', 'removeLabelFromCard')
+# label changes of a card may trigger OKR labels, the other generic events
+# only resync the card, so consecutive ones can be merged; check item
+# states are applied one by one, only those of the same item merge
+KEYED_EVENTS = (
+    'addChecklistToCard', 'addMemberToCard', 'updateCheckItemStateOnCard'
+)
+
+
+def dispatch(json, board_id, generic_events):
+    """
+    Returns the jobs for one webhook body as (function, args, key, tenant)
+    tuples, jobs with the same key are redundant when queued together and
+    jobs of a tenant share a fair queue.
+    """
+    action = json['action']['type']
+    if action not in ALLOWED_WEBHOOK_ACTIONS:
+        return []
+    data = pick_data(json)
+    payload = envelope.pack(data, envelope.TRELLO_FIELDS)
+    tenant = fair.board_tenant(
+        json['action']['data'].get('board', {}).get('id')
+    )
+    if action == 'updateLabel':
+        return [
+            (worker.payload_update_label, (board_id, payload), None, tenant)
+        ]
+    if action == 'deleteCard':
+        return [(worker.payload_delete_card, (payload,), None, tenant)]
+    if action in CHECKLIST_EVENTS:
+        return [(worker.payload_checklist_event, (payload,), None, tenant)]
+    if action in generic_events:
+        # OKR labels of the top board need the event, the other generic
+        # events only resync the card
+        if backpressure.is_active() and not (
+            board_id == Config.TRELOLO_TOP_BOARD and action in LABEL_EVENTS
+        ):
+            card_id = data['card']['id']
+            return [(
+                worker.payload_dirty_card, (board_id, card_id),
+                backpressure.marker('card:{}'.format(card_id)), tenant
+            )]
+        key = 'card:{}'.format(data['card']['id']) \
+            if action in KEYED_EVENTS else None
+        if action == 'updateCheckItemStateOnCard' and 'checkItem' in data:
+            key = '{}:{}'.format(key, data['checkItem']['id'])
+        return [
+            (worker.payload_generic_event, (board_id, payload), key, tenant)
+        ]
+    return []
+
+
+def dispatch_teamboard(json):
+    jobs = dispatch(json, Config.TRELOLO_MAIN_BOARD, TEAMBOARD_EVENTS)
+    if jobs and json['action'].get('id'):
+        mark_seen(json['action']['id'])
+    return jobs
+
+
+def dispatch_mainboard(json):
+    return dispatch(json, Config.TRELOLO_TOP_BOARD, MAINBOARD_EVENTS)
+
+
+# matches nested keys too, so it only rules out events without any of the
+# allowed action types
+ACTION_PATTERN = re.compile(br'"type"\s*:\s*"(\w+)"')
+
+
+def prefilter(body):
+    return any(
+        a.decode('utf-8') in ALLOWED_WEBHOOK_ACTIONS
+        for a in ACTION_PATTERN.findall(body)
+    )
+
 
 bp = Blueprint('trello', __name__)
 
 
 @bp.route(
     '/callback/trello/teamboard',
-    methods=['GET', 'POST']
+    methods=['GET', 'HEAD', 'POST']
 )
+@metrics.observe_webhook
 def teamboard_webhook():
     if request.method == 'POST':
-        json = request.json
-        if json['action']['type'] in ALLOWED_WEBHOOK_ACTIONS:
-            data = pick_data(json)
-            if json['action']['type'] == 'updateLabel':
-                q.enqueue(
-                    worker.payload_update_label,
-                    Config.TRELOLO_MAIN_BOARD,
-                    data
-                )
-            if json['action']['type'] == 'deleteCard':
-                q.enqueue(worker.payload_delete_card, data)
-            if json['action']['type'] in (
-                'addLabelToCard',
-                'addChecklistToCard',
-                'addMemberToCard',
-                'updateCheckItemStateOnCard',
-                'removeLabelFromCard'
-            ):
-                q.enqueue(
-                    worker.payload_generic_event,
-                    Config.TRELOLO_MAIN_BOARD,
-                    data
-                )
+        inbox.accept('teamboard', dispatch_teamboard, prefilter, trim)
     return __name__
 
 
 @bp.route(
     '/callback/trello/mainboard',
-    methods=['GET', 'POST']
+    methods=['GET', 'HEAD', 'POST']
 )
+@metrics.observe_webhook
 def mainboard_webhook():
     if request.method == 'POST':
-        json = request.json
-        if json['action']['type'] in ALLOWED_WEBHOOK_ACTIONS:
-            data = pick_data(json)
-            if json['action']['type'] == 'updateLabel':
-                q.enqueue(
-                    worker.payload_update_label,
-                    Config.TRELOLO_TOP_BOARD,
-                    data
-                )
-            if json['action']['type'] == 'deleteCard':
-                q.enqueue(worker.payload_delete_card, data)
-            if json['action']['type'] in (
-                'addLabelToCard',
-                'addChecklistToCard',
-                'updateCheckItemStateOnCard',
-                'removeLabelFromCard'
-            ):
-                q.enqueue(
-                    worker.payload_generic_event,
-                    Config.TRELOLO_TOP_BOARD,
-                    data
-                )
+        inbox.accept('mainboard', dispatch_mainboard, prefilter, trim)
     return __name__
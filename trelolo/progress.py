@@ -0,0 +1,150 @@
+from collections import OrderedDict
+from functools import wraps
+import json
+import logging
+import threading
+import time
+
+from rq import get_current_job
+
+from .config import Config
+from .extensions import rq
+
+log = logging.getLogger(__name__)
+
+CHANNEL = 'trelolo:job:{}'
+HEARTBEAT = 15
+FINAL_STATES = ('finished', 'failed')
+# milliseconds EventSource waits before reconnecting to a closed stream
+RETRY = 2000
+
+_lock = threading.Lock()
+_streams = {'open': 0}
+
+
+def publish(job, state, percent=None, message=None):
+    """
+    Stores the progress of `job` in its meta and announces it on the job
+    channel.
+    """
+    progress = OrderedDict([
+        ('state', state),
+        ('percent', percent),
+        ('message', message),
+        ('time', time.time())
+    ])
+    job.meta['progress'] = progress
+    job.save()
+    rq.publish(CHANNEL.format(job.id), json.dumps(progress))
+    return progress
+
+
+def report(done, total, message=None):
+    """
+    Reports that `done` of `total` steps of the current job are done.
+    Outside of a job it does nothing.
+    """
+    job = get_current_job()
+    if job is None:
+        return None
+    percent = int(done * 100 / total) if total else 100
+    try:
+        return publish(job, 'started', min(percent, 99), message)
+    except Exception as e:
+        log.warning('could not report progress: {}'.format(str(e)))
+
+
+def track_job(f):
+    """
+    Publishes the start, the end and the error of a job.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        job = get_current_job()
+        if job is None:
+            return f(*args, **kwargs)
+        publish(job, 'started', 0)
+        try:
+            result = f(*args, **kwargs)
+        except Exception as e:
+            publish(job, 'failed', message='{}: {}'.format(
+                type(e).__name__, str(e)
+            ))
+            raise
+        publish(job, 'finished', 100)
+        return result
+    return decorated
+
+
+def event(progress):
+    return 'event: progress\ndata: {}\n\n'.format(json.dumps(progress))
+
+
+def stream_slots():
+    """
+    Streams a process keeps open at once, one server thread is always
+    left to the webhooks.
+    """
+    return max(min(Config.PROGRESS_STREAMS, Config.SERVE_THREADS - 1), 0)
+
+
+def acquire_stream():
+    with _lock:
+        if _streams['open'] >= stream_slots():
+            return False
+        _streams['open'] += 1
+        return True
+
+
+def release_stream():
+    with _lock:
+        _streams['open'] -= 1
+
+
+def stream(job):
+    """
+    Yields server-sent events with the progress of `job`, starting with
+    its current state. A stream holds a server thread, so it ends with
+    the job or after PROGRESS_STREAM_TIMEOUT seconds and EventSource
+    reconnects. Beyond PROGRESS_STREAMS open streams, it only yields the
+    current state, which makes the browser poll.
+    """
+    yield 'retry: {}\n\n'.format(RETRY)
+    if not acquire_stream():
+        job.refresh()
+        yield event(
+            job.meta.get('progress') or {'state': job.get_status()}
+        )
+        return
+    pubsub = rq.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(CHANNEL.format(job.id))
+    try:
+        # subscribed first, so no update gets lost in between
+        job.refresh()
+        progress = job.meta.get('progress') or {'state': job.get_status()}
+        yield event(progress)
+        if progress['state'] in FINAL_STATES or job.is_finished or \
+                job.is_failed:
+            return
+        last = time.time()
+        deadline = last + Config.PROGRESS_STREAM_TIMEOUT
+        while time.time() < deadline:
+            message = pubsub.get_message(timeout=1)
+            if message is None:
+                if time.time() - last >= HEARTBEAT:
+                    last = time.time()
+                    # a killed work horse publishes nothing
+                    job.refresh()
+                    if job.is_finished or job.is_failed:
+                        yield event({'state': job.get_status()})
+                        return
+                    yield ': heartbeat\n\n'
+                continue
+            progress = json.loads(message['data'].decode('utf-8'))
+            last = time.time()
+            yield event(progress)
+            if progress['state'] in FINAL_STATES:
+                return
+    finally:
+        pubsub.close()
+        release_stream()
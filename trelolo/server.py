@@ -0,0 +1,65 @@
+import logging
+import multiprocessing
+
+from gunicorn.app.base import BaseApplication
+
+from . import metrics
+from .extensions import db
+
+log = logging.getLogger(__name__)
+
+
+def post_fork(server, worker):
+    # connections opened by the preloaded app must not be shared
+    from .worker import client
+    db.get_engine(server.app.application).dispose()
+    client.reset_sessions()
+
+
+def child_exit(server, worker):
+    metrics.mark_process_dead(worker.pid)
+
+
+def get_options(config):
+    workers = config['SERVE_WORKERS'] or multiprocessing.cpu_count() * 2 + 1
+    return {
+        'bind': '{}:{}'.format(config['FLASK_HOST'], config['FLASK_PORT']),
+        'workers': workers,
+        'threads': config['SERVE_THREADS'],
+        'worker_class': 'gthread' if config['SERVE_THREADS'] > 1 else 'sync',
+        'keepalive': config['SERVE_KEEPALIVE'],
+        'timeout': config['SERVE_TIMEOUT'],
+        'graceful_timeout': config['SERVE_GRACEFUL_TIMEOUT'],
+        # manage.py loads the app before gunicorn starts anyway
+        'preload_app': True,
+        'accesslog': '-' if config['SERVE_ACCESS_LOG'] else None,
+        'post_fork': post_fork,
+        'child_exit': child_exit
+    }
+
+
+class Server(BaseApplication):
+    """
+    Runs the app under gunicorn. SIGHUP restarts the workers gracefully,
+    the app is loaded once in the master so code changes need a new
+    master (SIGUSR2, then SIGQUIT to the old one).
+    """
+
+    def __init__(self, app, options=None):
+        self.application = app
+        self.options = options or get_options(app.config)
+        super(Server, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+    def run(self):
+        log.info(
+            'serving on {bind} with {workers} workers x {threads} '
+            'threads'.format(**self.options)
+        )
+        super(Server, self).run()
@@ -0,0 +1,186 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import cProfile
+from functools import wraps
+import io
+import logging
+import pstats
+import re
+import threading
+import time
+
+from rq import get_current_job
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .config import Config
+
+log = logging.getLogger(__name__)
+
+MAX_SPANS = 2000
+MAX_STATEMENT = 200
+PROFILE_LINES = 40
+FRAME_SEPARATORS = re.compile(r'[ ;]')
+
+_lock = threading.Lock()
+_current = None
+
+
+class Trace(object):
+    """
+    Outbound requests, DB queries and cache lookups done by one job.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.duration = None
+        self.spans = []
+        self.dropped = 0
+
+    def add(self, kind, name, start, duration, **extra):
+        with _lock:
+            if len(self.spans) >= MAX_SPANS:
+                self.dropped += 1
+                return
+            span = OrderedDict([
+                ('kind', kind),
+                ('name', name),
+                ('offset', round((start - self.start) * 1000, 3)),
+                ('duration', round(duration * 1000, 3))
+            ])
+            span.update(extra)
+            self.spans.append(span)
+
+    def finish(self):
+        self.duration = time.time() - self.start
+
+    def summary(self):
+        calls = OrderedDict()
+        for span in self.spans:
+            calls[span['kind']] = calls.get(span['kind'], 0) + 1
+        return calls
+
+    def to_dict(self):
+        return OrderedDict([
+            ('name', self.name),
+            ('duration', round((self.duration or 0) * 1000, 3)),
+            ('calls', self.summary()),
+            ('dropped', self.dropped),
+            ('spans', self.spans)
+        ])
+
+
+def frame(name):
+    """
+    A frame name of the folded format, which separates frames with `;`
+    and the weight with a space.
+    """
+    return FRAME_SEPARATORS.sub('_', ' '.join(name.split()))
+
+
+def to_folded(trace):
+    """
+    Collapses a trace dict into the folded stack format understood by
+    flamegraph.pl and speedscope (one `stack weight` line per frame,
+    weights in milliseconds).
+    """
+    weights = OrderedDict()
+    spent = 0
+    for span in trace['spans']:
+        stack = ';'.join(
+            frame(n) for n in (trace['name'], span['kind'], span['name'])
+        )
+        weights[stack] = weights.get(stack, 0) + span['duration']
+        spent += span['duration']
+    weights[frame(trace['name'])] = max(trace['duration'] - spent, 0)
+    return '\n'.join(
+        '{} {}'.format(stack, int(round(weight)))
+        for stack, weight in weights.items()
+    ) + '\n'
+
+
+def record(kind, name, start, duration, **extra):
+    trace = _current
+    if trace is not None:
+        trace.add(kind, name, start, duration, **extra)
+
+
+@contextmanager
+def span(kind, name, **extra):
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(kind, name, start, time.time() - start, **extra)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('trelolo_query_start', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = conn.info['trelolo_query_start'].pop()
+    record('db', statement[:MAX_STATEMENT], start, time.time() - start)
+
+
+def _profile_stats(profile):
+    stream = io.StringIO()
+    stats = pstats.Stats(profile, stream=stream)
+    stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+    return stream.getvalue()
+
+
+def trace_job(f):
+    """
+    Records a trace of the job and attaches it to the RQ job meta when the
+    job took at least JOB_TRACE_THRESHOLD seconds. With JOB_PROFILE_THRESHOLD
+    set, the job also runs under cProfile and the stats are kept for jobs
+    slower than the threshold.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        global _current
+        if Config.JOB_TRACE_THRESHOLD < 0:
+            return f(*args, **kwargs)
+        trace = Trace(f.__name__)
+        profile = cProfile.Profile() \
+            if Config.JOB_PROFILE_THRESHOLD > 0 else None
+        _current = trace
+        try:
+            if profile is not None:
+                return profile.runcall(f, *args, **kwargs)
+            return f(*args, **kwargs)
+        finally:
+            _current = None
+            trace.finish()
+            try:
+                save_trace(trace, profile)
+            except Exception as e:
+                log.warning(
+                    'could not save trace of {}: {}'.format(trace.name, str(e))
+                )
+    return decorated
+
+
+def save_trace(trace, profile=None):
+    job = get_current_job()
+    if job is None or trace.duration < Config.JOB_TRACE_THRESHOLD:
+        return False
+    job.meta['trace'] = trace.to_dict()
+    if profile is not None and trace.duration >= Config.JOB_PROFILE_THRESHOLD:
+        job.meta['profile'] = _profile_stats(profile)
+    job.save()
+    log.info(
+        'trace of {} ({:0.0f}ms): {}'.format(
+            trace.name, trace.duration * 1000,
+            ', '.join(
+                '{} {}'.format(n, k) for k, n in trace.summary().items()
+            )
+        )
+    )
+    return True
@@ -0,0 +1,240 @@
+"""
+Asyncio client for the fan-outs of the handlers.
+
+py-trello and the GitLab mixin send one blocking request at a time. The
+reads a handler needs from many cards, boards or GitLab resources at once
+go through `AsyncClient` instead: coroutines sharing one pooled aiohttp
+session, run to completion on the event loop of the process with
+`run()`. The handlers stay synchronous around them (SQLAlchemy sessions
+and RQ jobs are), only their fan-outs are coroutines.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+import aiohttp
+from trello import Board, Card, ResourceUnavailable, Unauthorized
+
+from trelolo import metrics, tracing
+
+log = logging.getLogger(__name__)
+
+
+class Status(object):
+    """
+    What ResourceUnavailable reads from a response.
+    """
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def make_card(client, json_obj):
+    """
+    Builds a py-trello card from the full card json, with the attributes
+    `Card.fetch(eager=False)` would set.
+    """
+    card = Card.from_json(Board(client, json_obj['idBoard']), json_obj)
+    card.idBoard = json_obj['idBoard']
+    card.shortUrl = json_obj.get('shortUrl')
+    card.idShort = json_obj.get('idShort')
+    card.badges = json_obj.get('badges')
+    card.pos = json_obj.get('pos')
+    card.checked = json_obj.get('checkItemStates')
+    card._checklists = None
+    return card
+
+
+class AsyncClient(object):
+
+    def __init__(self, trello_api_url, api_key, token, gitlab_url=None,
+                 gitlab_token=None, connections=32):
+        self.trello_api_url = trello_api_url.rstrip('/')
+        self.api_key = api_key
+        self.token = token
+        self.gitlab_url = gitlab_url
+        self.gitlab_token = gitlab_token
+        self.connections = connections
+        self.loop = None
+        self.session = None
+        self.pid = None
+
+    def get_loop(self):
+        # RQ forks a work horse per job, which must not reuse the loop and
+        # the connections of its parent
+        if self.loop is None or self.pid != os.getpid():
+            self.loop = asyncio.new_event_loop()
+            self.session = None
+            self.pid = os.getpid()
+        return self.loop
+
+    def run(self, coro):
+        return self.get_loop().run_until_complete(coro)
+
+    def gather(self, coros):
+        """
+        Runs the coroutines concurrently and returns their results.
+        """
+        async def gather():
+            return await asyncio.gather(*coros)
+        return self.run(gather())
+
+    def get_session(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connections)
+            )
+        return self.session
+
+    def close(self):
+        if self.session is not None:
+            self.run(self.session.close())
+            self.session = None
+
+    async def request(self, upstream, method, url, path, **kwargs):
+        start = time.time()
+        status = 'error'
+        try:
+            async with self.get_session().request(
+                method, url, **kwargs
+            ) as response:
+                status = response.status
+                return status, await response.text()
+        finally:
+            metrics.observe_upstream(
+                upstream, method, path, status, time.time() - start
+            )
+            tracing.record(
+                upstream, '{} {}'.format(
+                    method, metrics.endpoint_template(path)
+                ),
+                start, time.time() - start, status=status
+            )
+
+    async def trello(self, method, path, params=None, data=None):
+        params = dict(params or {}, key=self.api_key, token=self.token)
+        status, text = await self.request(
+            'trello', method, '{}/{}'.format(
+                self.trello_api_url, path.lstrip('/')
+            ), path, params=params, json=data
+        )
+        if status == 401:
+            raise Unauthorized(
+                '{} at {}'.format(text, path), Status(status)
+            )
+        if status != 200:
+            raise ResourceUnavailable(
+                '{} at {}'.format(text, path), Status(status)
+            )
+        return json.loads(text)
+
+    async def gitlab(self, method, path, data=None):
+        """
+        Returns the json of a GitLab API v3 resource, None when it cannot
+        be read.
+        """
+        status, result = await self.gitlab_status(method, path, data)
+        return result
+
+    async def gitlab_status(self, method, path, data=None):
+        """
+        Returns the status and the json of a GitLab API v3 resource, the
+        json is None when it cannot be read.
+        """
+        url = '{}/api/v3/{}'.format(self.gitlab_url, path.lstrip('/'))
+        status = None
+        try:
+            status, text = await self.request(
+                'gitlab', method, url, '/api/v3/{}'.format(path.lstrip('/')),
+                params={'access_token': self.gitlab_token}, data=data
+            )
+            return status, json.loads(text)
+        except (aiohttp.ClientError, ValueError) as e:
+            log.warning('error fetching gitlab {}: {}'.format(path, str(e)))
+            return status, None
+
+    # Trello
+
+    async def fetch_card(self, card_id, fields=None):
+        return await self.trello(
+            'GET', '/cards/{}'.format(card_id),
+            params={'fields': fields} if fields else None
+        )
+
+    async def fetch_cards(self, card_ids):
+        return await asyncio.gather(*[
+            self.fetch_card(card_id) for card_id in card_ids
+        ])
+
+    async def fetch_board(self, board_id, fields='name,closed'):
+        return await self.trello(
+            'GET', '/boards/{}'.format(board_id), params={'fields': fields}
+        )
+
+    async def fetch_board_cards(self, board_id, card_filter='open',
+                                fields='all'):
+        return await self.trello(
+            'GET', '/boards/{}/cards'.format(board_id),
+            params={'filter': card_filter, 'fields': fields}
+        )
+
+    async def fetch_boards_cards(self, board_ids, card_filter='open'):
+        return await asyncio.gather(*[
+            self.fetch_board_cards(board_id, card_filter)
+            for board_id in board_ids
+        ])
+
+    async def fetch_board_labels(self, board_id):
+        return await self.trello(
+            'GET', '/boards/{}/labels'.format(board_id),
+            params={'fields': 'all', 'limit': 1000}
+        )
+
+    async def fetch_checklists(self, card_id):
+        return await self.trello(
+            'GET', '/cards/{}/checklists'.format(card_id)
+        )
+
+    async def put_checklist_item(self, card_id, item_id, fields):
+        return await self.trello(
+            'PUT', '/cards/{}/checkItem/{}'.format(card_id, item_id),
+            data=fields
+        )
+
+    async def fetch_hooks(self):
+        return await self.trello(
+            'GET', '/tokens/{}/webhooks'.format(self.token)
+        )
+
+    async def delete_hook(self, hook_id):
+        return await self.trello('DELETE', '/webhooks/{}'.format(hook_id))
+
+    # GitLab
+
+    async def fetch_gl_target(self, project_id, target_url, id):
+        return await self.gitlab('GET', 'projects/{}/{}/{}'.format(
+            project_id, target_url, id
+        ))
+
+    async def fetch_gl_target_status(self, project_id, target_url, id):
+        return await self.gitlab_status('GET', 'projects/{}/{}/{}'.format(
+            project_id, target_url, id
+        ))
+
+    async def fetch_gl_milestone(self, project_id, milestone_id):
+        return await self.gitlab('GET', 'projects/{}/milestones/{}'.format(
+            project_id, milestone_id
+        ))
+
+    async def fetch_gl_project(self, project_id):
+        return await self.gitlab('GET', 'projects/{}'.format(project_id))
+
+    async def fetch_gl_user(self, user_id):
+        return await self.gitlab('GET', 'users/{}/'.format(user_id))
+
+    async def fetch_gl_labels(self, project_id):
+        return await self.gitlab(
+            'GET', 'projects/{}/labels'.format(project_id)
+        )
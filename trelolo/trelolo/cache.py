@@ -0,0 +1,198 @@
+import json
+import logging
+
+from trelolo import models, tracing
+
+log = logging.getLogger(__name__)
+
+
+class EmailCache(object):
+    """
+    Trello member -> email lookups in redis. The username of every member
+    id is a key of its own expiring after a day, the username -> email map
+    is replaced after every import of the emails table.
+    """
+
+    USERNAME_KEY = 'trelolo:username:{}'
+    USERNAMES_TTL = 86400
+    EMAILS_KEY = 'trelolo:emails'
+    REFRESH_CHUNK = 1000
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    @staticmethod
+    def decode(value):
+        return value.decode('utf-8') if value is not None else None
+
+    def get_username(self, member_id):
+        with tracing.span('cache', 'usernames'):
+            return self.decode(
+                self.connection.get(self.USERNAME_KEY.format(member_id))
+            )
+
+    def set_username(self, member_id, username):
+        # renamed members are picked up once their entry expires
+        self.connection.set(
+            self.USERNAME_KEY.format(member_id), username,
+            ex=self.USERNAMES_TTL
+        )
+
+    def get_email(self, username):
+        with tracing.span('cache', 'emails'):
+            email = self.decode(
+                self.connection.hget(self.EMAILS_KEY, username)
+            )
+        if email is None:
+            stored = models.Emails.query.filter_by(username=username).first()
+            if stored is None:
+                return None
+            email = stored.email
+            self.connection.hset(self.EMAILS_KEY, username, email)
+        return email
+
+    def refresh(self):
+        """
+        Rebuilds the username -> email map from the emails table and swaps
+        it in with a single RENAME.
+        """
+        staging = '{}:refresh'.format(self.EMAILS_KEY)
+        self.connection.delete(staging)
+        count = 0
+        chunk = {}
+        query = models.Emails.query.with_entities(
+            models.Emails.username, models.Emails.email
+        ).yield_per(self.REFRESH_CHUNK)
+        for username, email in query:
+            chunk[username] = email
+            if len(chunk) >= self.REFRESH_CHUNK:
+                self.connection.hmset(staging, chunk)
+                count += len(chunk)
+                chunk = {}
+        if chunk:
+            self.connection.hmset(staging, chunk)
+            count += len(chunk)
+        if count:
+            self.connection.rename(staging, self.EMAILS_KEY)
+        else:
+            self.connection.delete(self.EMAILS_KEY)
+        log.info('refreshed {} cached emails'.format(count))
+        return count
+
+
+class BoardCatalogue(object):
+    """
+    Trello boards offered on the /config page, cached in redis for `ttl`
+    seconds or until hooking or unhooking a board invalidates them.
+    """
+
+    KEY = 'trelolo:boards'
+
+    def __init__(self, connection, client, ttl):
+        self.connection = connection
+        self.client = client
+        self.ttl = ttl
+
+    def fetch(self):
+        boards = self.client.fetch_json(
+            '/members/me/boards',
+            query_params={'filter': 'all', 'fields': 'name'}
+        )
+        return json.dumps([
+            {'id': b['id'], 'name': b['name']} for b in boards
+        ])
+
+    def get(self, refresh=False):
+        """
+        Returns the boards as a JSON string, which doubles as the cache
+        validator of the page.
+        """
+        data = None if refresh else self.connection.get(self.KEY)
+        if data is not None:
+            return data.decode('utf-8')
+        data = self.fetch()
+        self.connection.set(self.KEY, data, ex=self.ttl)
+        log.info('refreshed board catalogue')
+        return data
+
+    def invalidate(self):
+        self.connection.delete(self.KEY)
+
+
+class ChecklistCounters(object):
+    """
+    Item ids and checked item ids of the first checklist of every card the
+    workers have read, so that check item events update the completeness
+    of a card from their payload instead of reading its checklists. Any
+    event taking the full path counts the card again.
+    """
+
+    KEY = 'trelolo:checklist:{}'
+    ITEMS_KEY = 'trelolo:checklist:{}:items'
+    CHECKED_KEY = 'trelolo:checklist:{}:checked'
+    TTL = 7 * 86400
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def keys(self, card_id):
+        return (
+            self.KEY.format(card_id), self.ITEMS_KEY.format(card_id),
+            self.CHECKED_KEY.format(card_id)
+        )
+
+    def count(self, card_id, checklist_id, items, checked):
+        key, items_key, checked_key = self.keys(card_id)
+        pipe = self.connection.pipeline()
+        pipe.delete(items_key, checked_key)
+        pipe.set(key, checklist_id, ex=self.TTL)
+        if items:
+            pipe.sadd(items_key, *items)
+            pipe.expire(items_key, self.TTL)
+        if checked:
+            pipe.sadd(checked_key, *checked)
+            pipe.expire(checked_key, self.TTL)
+        pipe.execute()
+
+    def forget(self, card_id):
+        self.connection.delete(*self.keys(card_id))
+
+    def completeness(self, card_id):
+        key, items_key, checked_key = self.keys(card_id)
+        pipe = self.connection.pipeline()
+        pipe.scard(items_key)
+        pipe.scard(checked_key)
+        for k in (key, items_key, checked_key):
+            pipe.expire(k, self.TTL)
+        total, checked = pipe.execute()[:2]
+        return checked / total * 100 if total else -1
+
+    def update(self, card_id, checklist_id, item_id, state, created=False):
+        """
+        Applies the new `state` of a check item (`complete`, `incomplete`
+        or `deleted`) and returns the completeness of the card, None when
+        the card is not counted or the item of a state change is unknown.
+        """
+        key, items_key, checked_key = self.keys(card_id)
+        with tracing.span('cache', 'checklist'):
+            counted = self.connection.get(key)
+            if counted is None:
+                return None
+            if counted.decode('utf-8') != checklist_id:
+                # other checklists do not count
+                return self.completeness(card_id)
+            if not created and state != 'deleted' and \
+                    not self.connection.sismember(items_key, item_id):
+                return None
+            pipe = self.connection.pipeline()
+            if state == 'deleted':
+                pipe.srem(items_key, item_id)
+                pipe.srem(checked_key, item_id)
+            else:
+                pipe.sadd(items_key, item_id)
+                if state == 'complete':
+                    pipe.sadd(checked_key, item_id)
+                else:
+                    pipe.srem(checked_key, item_id)
+            pipe.execute()
+            return self.completeness(card_id)
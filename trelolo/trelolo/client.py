@@ -1,13 +1,21 @@
-import copy
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
 import logging
+import os
 import re
-from trello import TrelloClient, ResourceUnavailable
+import time
+import requests
+from trello import Board, Label, TrelloClient, ResourceUnavailable, \
+    Unauthorized
+from trello.webhook import WebHook
 from trelolo.trelolo import helpers
 from trelolo.extensions import db
-from trelolo import models
+from trelolo import metrics, models, tracing
 
+from .aio import AsyncClient, make_card
 from .mixins import GitLabMixin
+from .plan import Executor, Plan
 
 log = logging.getLogger(__name__)
 
@@ -15,11 +23,151 @@ log = logging.getLogger(__name__)
 class Trelolo(TrelloClient, GitLabMixin):
 
     CHECKLIST_TITLE = "Issues"
+    MEMBERS_WRITE_RETRIES = 3
+    ACTIONS_PAGE_SIZE = 1000
+    RATE_LIMIT_RETRIES = 3
+
+    trello_api_url = 'https://api.trello.com/1'
+    http_session = None
+    http_session_pid = None
+    members_writer = None
+    email_cache = None
+    checklist_counters = None
+    executor = None
+    aio = None
+    async_connections = 32
+
+    def trello_request(self, http_method, uri_path, **kwargs):
+        """
+        Sends a request to the Trello API through a pooled session.
+        """
+        url = '{}/{}'.format(self.trello_api_url, uri_path.lstrip('/'))
+        start = time.time()
+        status = 'error'
+        try:
+            response = self.get_http_session().request(
+                http_method, url, auth=self.oauth, **kwargs
+            )
+            status = response.status_code
+            return response
+        finally:
+            metrics.observe_upstream(
+                'trello', http_method, uri_path, status, time.time() - start
+            )
+            tracing.record(
+                'trello', '{} {}'.format(
+                    http_method, metrics.endpoint_template(uri_path)
+                ),
+                start, time.time() - start, status=status
+            )
+
+    def get_http_session(self):
+        # a forked gunicorn worker or RQ work horse must not reuse the
+        # keep-alive connections of its parent
+        if self.http_session is None or \
+                self.http_session_pid != os.getpid():
+            self.http_session = requests.Session()
+            self.http_session_pid = os.getpid()
+        return self.http_session
+
+    def reset_sessions(self):
+        """
+        Drops the sessions inherited from the parent process, without
+        closing the sockets it still uses.
+        """
+        self.http_session = None
+        self.gitlab_session = None
+
+    def fetch_json(self, uri_path, http_method='GET', headers=None,
+                   query_params=None, post_args=None, files=None):
+        """
+        Same as TrelloClient.fetch_json, sent through trello_request.
+        """
+        headers = headers or {}
+        data = None
+        if files is None:
+            data = json.dumps(post_args or {})
+        if http_method in ('POST', 'PUT', 'DELETE') and not files:
+            headers['Content-Type'] = 'application/json; charset=utf-8'
+        headers['Accept'] = 'application/json'
+        response = self.trello_request(
+            http_method, uri_path, params=query_params or {},
+            headers=headers, data=data, files=files
+        )
+        if response.status_code == 401:
+            raise Unauthorized(
+                '{} at {}'.format(response.text, uri_path), response
+            )
+        if response.status_code != 200:
+            raise ResourceUnavailable(
+                '{} at {}'.format(response.text, uri_path), response
+            )
+        return response.json()
+
+    def create_hook(self, callback_url, id_model, desc=None, token=None):
+        token = token or self.resource_owner_key
+        response = self.trello_request(
+            'POST', '/tokens/{}/webhooks/'.format(token), data={
+                'callbackURL': callback_url,
+                'idModel': id_model,
+                'description': desc
+            }
+        )
+        if response.status_code == 200:
+            return WebHook(
+                self, token, response.json()['id'], desc,
+                id_model, callback_url, True
+            )
+        return False
+
+    def setup_trello_api(self, trello_api_url):
+        self.trello_api_url = trello_api_url.rstrip('/')
 
     def setup_gitlab(self, gitlab_url, gitlab_token):
         self.gitlab_url = gitlab_url
         self.gitlab_token = gitlab_token
 
+    def setup_members_writer(self, members_writer):
+        self.members_writer = members_writer
+
+    def setup_email_cache(self, email_cache):
+        self.email_cache = email_cache
+
+    def setup_checklist_counters(self, checklist_counters):
+        self.checklist_counters = checklist_counters
+
+    def setup_executor(self, executor):
+        self.executor = executor
+
+    def setup_async(self, connections):
+        self.async_connections = connections
+
+    def get_aio(self):
+        if self.aio is None:
+            self.aio = AsyncClient(
+                self.trello_api_url, self.api_key, self.resource_owner_key,
+                self.gitlab_url, self.gitlab_token, self.async_connections
+            )
+        return self.aio
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = Executor(self)
+        return self.executor
+
+    def apply_plan(self, plan):
+        """
+        Runs the planned writes and commits the session. A dry run only
+        logs the plan and rolls the session back.
+        """
+        executor = self.get_executor()
+        failed = executor.run(plan)
+        if executor.dry_run:
+            db.session.rollback()
+        else:
+            db.session.commit()
+        return failed
+
     def setup_trelolo(self, mainboard_id, topboard_id, webhook_url):
         self.webhook_url = webhook_url
         self.board_data = OrderedDict({
@@ -60,11 +208,51 @@ class Trelolo(TrelloClient, GitLabMixin):
             log.error('invalid board {}'.format(board_id))
             return False
 
+    def index_hooks(self, token=None):
+        """
+        Lists the hooks of the token once and returns them by model id.
+        """
+        index = {}
+        for hook in self.list_hooks(token=token or self.resource_owner_key):
+            index.setdefault(hook.id_model, []).append(hook)
+        return index
+
     def does_webhook_exist(self, model_id):
-        return any(
-            i for i in self.list_hooks(token=self.resource_owner_key)
-            if i.id_model == model_id
-        )
+        return model_id in self.index_hooks()
+
+    def delete_hook(self, hook, limiter):
+        """
+        Deletes the hook, backing off when Trello answers 429. A hook which
+        is already gone counts as deleted.
+        """
+        for attempt in range(self.RATE_LIMIT_RETRIES + 1):
+            limiter.wait()
+            try:
+                hook.delete()
+                return True
+            except ResourceUnavailable as e:
+                if self.is_stale_resource(e):
+                    return True
+                if getattr(e, '_status', None) != 429 or \
+                        attempt == self.RATE_LIMIT_RETRIES:
+                    log.error('could not delete hook {}: {}'.format(
+                        hook.desc, str(e)
+                    ))
+                    return False
+                time.sleep(2 ** attempt)
+
+    def delete_hooks(self, hooks, workers, limiter):
+        """
+        Deletes the hooks concurrently and yields (hook, deleted) as they
+        complete, in the thread of the caller.
+        """
+        with ThreadPoolExecutor(workers) as pool:
+            futures = dict(
+                (pool.submit(self.delete_hook, hook, limiter), hook)
+                for hook in hooks
+            )
+            for future in as_completed(futures):
+                yield futures[future], future.result()
 
     def remove_webhook(self, hook_id, model_id):
         for hook in self.list_hooks(token=self.resource_owner_key):
@@ -72,24 +260,155 @@ class Trelolo(TrelloClient, GitLabMixin):
              hook.id_model == model_id:
                 hook.delete()
 
-    def list_team_boards(self):
-        boards = []
-        team_boards = models.Boards.query.filter_by(type=3).all()
-        for b in team_boards:
-            board = self.get_board(b.trello_id)
-            boards.append(board)
-        return boards
+    @staticmethod
+    def set_card_description(card, description):
+        """
+        Writes the card description only if it differs from the known one.
+        """
+        if (getattr(card, 'desc', None) or '') == description:
+            log.info(
+                'description of card {} is up to date'.format(card.id)
+            )
+            return False
+        card.set_description(description)
+        return True
+
+    @staticmethod
+    def add_card_label(card, label):
+        """
+        Adds the label only if the card does not carry it yet.
+        """
+        if label.id in (getattr(card, 'idLabels', None) or []):
+            return False
+        card.add_label(label)
+        return True
+
+    @staticmethod
+    def remove_card_label(card, label):
+        """
+        Removes the label only if the card carries it.
+        """
+        id_labels = getattr(card, 'idLabels', None)
+        if id_labels is not None and label.id not in id_labels:
+            return False
+        card.remove_label(label)
+        return True
+
+    def add_card_members(self, card_id, members):
+        """
+        Adds members to the card description, buffered per card
+        when a members writer is set up.
+        """
+        if self.members_writer is not None:
+            return self.members_writer.add(card_id, members)
+        return self.merge_card_members(card_id, members)
+
+    def fetch_card_description(self, card_id):
+        return self.fetch_json(
+            '/cards/{}'.format(card_id),
+            query_params={'fields': 'desc'}
+        ).get('desc', '')
+
+    def merge_card_members(self, card_id, members):
+        """
+        Merges members into the card description and re-reads it after
+        the write, retrying when a concurrent writer dropped them.
+        A dry run only logs the members.
+        """
+        members = [m for m in members if m]
+        if self.get_executor().dry_run:
+            log.info('dry run: merge members {} into card {}'.format(
+                ','.join(members), card_id
+            ))
+            return False
+        for attempt in range(self.MEMBERS_WRITE_RETRIES):
+            desc = self.fetch_card_description(card_id)
+            cd = helpers.CardDescription(desc)
+            cd.set_list_value('members', members)
+            new_desc = cd.get_description()
+            if new_desc == desc:
+                return False
+            self.fetch_json(
+                '/cards/{}/desc'.format(card_id),
+                http_method='PUT',
+                post_args={'value': new_desc}
+            )
+            stored = helpers.CardDescription(
+                self.fetch_card_description(card_id)
+            ).get_list_value('members')
+            if all(m in stored for m in members):
+                log.info(
+                    'merged members {} into card {}'.format(
+                        ','.join(members), card_id
+                    )
+                )
+                return True
+            log.warning(
+                'members of card {} were overwritten, retrying'.format(
+                    card_id
+                )
+            )
+        log.error('could not merge members into card {}'.format(card_id))
+        return False
+
+    def fetch_board_actions(self, board_id, since, action_types):
+        """
+        Returns the actions of a board newer than the action `since`,
+        oldest first, paging back from the newest one.
+        """
+        actions = []
+        query = {
+            'filter': ','.join(action_types),
+            'since': since,
+            'limit': self.ACTIONS_PAGE_SIZE
+        }
+        while True:
+            page = self.fetch_json(
+                '/boards/{}/actions'.format(board_id), query_params=query
+            )
+            actions.extend(page)
+            if len(page) < self.ACTIONS_PAGE_SIZE:
+                break
+            query['before'] = page[-1]['id']
+        return list(reversed(actions))
+
+    def fetch_latest_board_action(self, board_id):
+        actions = self.fetch_json(
+            '/boards/{}/actions'.format(board_id),
+            query_params={'limit': 1, 'fields': 'id'}
+        )
+        if actions:
+            return actions[0]['id']
+        # ids start with their creation time, so `since` takes one of now
+        return '{:08x}{}'.format(int(time.time()), '0' * 16)
+
+    @staticmethod
+    def list_team_board_ids():
+        return [
+            b.trello_id for b in models.Boards.query.filter_by(type=3).all()
+        ]
+
+    def list_team_labels(self):
+        """
+        Returns the team boards with their labels, read concurrently.
+        """
+        boards = [Board(self, id) for id in self.list_team_board_ids()]
+        aio = self.get_aio()
+        labels = aio.gather([aio.fetch_board_labels(b.id) for b in boards])
+        return [
+            (board, Label.from_json_list(board, board_labels))
+            for board, board_labels in zip(boards, labels)
+        ]
 
     def list_sub_cards(self, parent_card):
-        cards = []
         sub_cards = models.Cards.query.filter_by(
             parent_card_id=parent_card.id
         ).all()
-        for card in sub_cards:
-            card = self.get_card(card.card_id)
-            card.fetch(eager=False)
-            cards.append(card)
-        return cards
+        aio = self.get_aio()
+        return [
+            make_card(self, card) for card in
+            aio.run(aio.fetch_cards([c.card_id for c in sub_cards]))
+        ]
 
     def get_members(self, card):
         members = []
@@ -109,58 +428,55 @@ class Trelolo(TrelloClient, GitLabMixin):
 
     def get_member_email(self, member_id):
         try:
-            member = self.get_member(member_id)
-            stored_member = models.Emails.query.filter_by(
-                username=member.username
-            ).first()
-            return stored_member.email
+            if self.email_cache is None:
+                member = self.get_member(member_id)
+                stored_member = models.Emails.query.filter_by(
+                    username=member.username
+                ).first()
+                return stored_member.email
+            username = self.email_cache.get_username(member_id)
+            if username is None:
+                username = self.get_member(member_id).username
+                self.email_cache.set_username(member_id, username)
+            return self.email_cache.get_email(username)
         except ResourceUnavailable:
             log.error(
                 'could not fetch trello member {}'.format(member_id)
             )
 
-    def add_label_to_gitlab_issues(self, parent_card, label):
+    def set_label_of_gitlab_issues(self, parent_card, label, add, plan):
         """
-        Adds the OKR label to gitlab issues
+        Plans adding the OKR label to gitlab issues, or removing it.
         """
         issues = models.Issues.query.filter_by(
             parent_card_id=parent_card.id
         ).all()
         for issue in issues:
             project_id = issue.project_id
-            log.info(
-                'adding label to issue {}/{}'.format(project_id, issue.id)
+            log.info('{} label of issue {}/{}'.format(
+                'adding' if add else 'removing', project_id, issue.id
+            ))
+            if add:
+                plan.create_gl_label(project_id, label)
+            plan.set_gl_label(
+                project_id,
+                'issues' if issue.target_type == 'issue'
+                else 'merge_requests',
+                issue.issue_id,
+                label,
+                add
             )
-            try:
-                self.create_gl_label(project_id, label)
-            except Exception as e:
-                log.error(
-                    'error creating gitlab label {}: {}'.format(label, str(e))
-                )
-            try:
-                self.add_gl_label(
-                    project_id,
-                    issue.issue_id,
-                    'issues' if issue.target_type == 'issue'
-                    else 'merge_requests',
-                    label
-                )
-            except Exception as e:
-                log.error(
-                    'error adding gitlab label {} to issue {}: {}'.format(
-                        label, issue.issue_id, str(e)
-                    )
-                )
 
     def add_okr_label(self, card, label, color):
         """
         Adds an OKR label to team cards and gitlab issues.
         """
+        plan = Plan()
         try:
             # load team labels
             team_labels = {}
-            for tboard in self.list_team_boards():
-                tlabel = self.find_label(tboard.get_labels(), label)
+            for tboard, labels in self.list_team_labels():
+                tlabel = self.find_label(labels, label)
                 # create label if does not exist on board
                 if not tlabel:
                     tlabel = tboard.add_label(label, color)
@@ -169,97 +485,63 @@ class Trelolo(TrelloClient, GitLabMixin):
             # add label to teamboard cards
             team_board_cards = self.list_sub_cards(card)
             for tcard in team_board_cards:
-                try:
-                    tlabel = team_labels[tcard.board_id]
-                    if tlabel:
-                        tcard.add_label(tlabel)
-                except Exception as e:
-                    log.error(
-                        'error adding OKR label to card {}: {}'.format(
-                            tcard.name, str(e)
-                        )
-                    )
+                tlabel = team_labels.get(tcard.board_id)
+                if tlabel:
+                    plan.set_label(tcard, tlabel)
                 # add label to gitlab issues
-                self.add_label_to_gitlab_issues(tcard, label)
+                self.set_label_of_gitlab_issues(tcard, label, True, plan)
         except Exception as e:
             log.error('error adding OKR label: {}'.format(str(e)))
+        self.apply_plan(plan)
 
-    def add_okr_label_to_card(self, card, okr_label):
+    def add_okr_label_to_card(self, card, okr_label, plan):
         tboard = card.board
         label, color = (okr_label.name, okr_label.color)
         tlabel = self.find_label(tboard.get_labels(), label)
         if not tlabel:
             tlabel = tboard.add_label(label, color)
         if tlabel:
-            try:
-                card.add_label(tlabel)
-            except Exception as e:
-                log.error(
-                    'error adding OKR label to card {}: {}'.format(
-                        card.name, str(e)
-                    )
-                )
-            self.add_label_to_gitlab_issues(card, label)
-
-    def remove_label_from_gitlab_issues(self, parent_card, label):
-        issues = models.Issues.query.filter_by(
-            parent_card_id=parent_card.id
-        ).all()
-        for issue in issues:
-            project_id = issue.project_id
-            log.info(
-                'removing label from issue {}/{}'.format(
-                    project_id, issue.id
-                )
-            )
-            try:
-                self.remove_gl_label(
-                    project_id,
-                    issue.issue_id,
-                    'issues' if issue.target_type == 'issue'
-                    else 'merge_requests',
-                    label
-                )
-            except Exception as e:
-                log.error(
-                    'error removing label {} from issue {}: {}'.format(
-                        label, issue.issue_id, str(e)
-                    )
-                )
+            plan.set_label(card, tlabel)
+            self.set_label_of_gitlab_issues(card, label, True, plan)
 
     def remove_okr_label(self, card, label):
         """
         Removes the OKR label from team cards and gitlab issues.
         """
+        plan = Plan()
         try:
             team_labels = {}
-            for tboard in self.list_team_boards():
-                tlabel = self.find_label(tboard.get_labels(), label)
+            for tboard, labels in self.list_team_labels():
+                tlabel = self.find_label(labels, label)
                 if tlabel:
                     team_labels[tboard.id] = tlabel
             team_board_cards = self.list_sub_cards(card)
             for tcard in team_board_cards:
-                try:
-                    tlabel = team_labels[tcard.board_id]
-                    if tlabel:
-                        tcard.remove_label(tlabel)
-                except Exception as e:
-                    log.error(
-                        'error removing OKR label from card {}: {}'.format(
-                            tcard.name, str(e)
-                        )
-                    )
-                self.remove_label_from_gitlab_issues(tcard, label)
+                tlabel = team_labels.get(tcard.board_id)
+                if tlabel:
+                    plan.set_label(tcard, tlabel, add=False)
+                self.set_label_of_gitlab_issues(tcard, label, False, plan)
         except Exception as e:
             log.error('error removing OKR label: {}'.format(str(e)))
+        self.apply_plan(plan)
 
-    @staticmethod
-    def get_completeness(card):
+    def get_completeness(self, card):
+        counters = self.checklist_counters
         try:
             cl = card.fetch_checklists()[0]
+        except IndexError:
+            if counters is not None:
+                counters.forget(card.id)
+            return -1
+        if counters is not None:
+            counters.count(
+                card.id, cl.id, [item['id'] for item in cl.items],
+                [item['id'] for item in cl.items if item['checked']]
+            )
+        try:
             completed_tasks = sum([item['checked'] for item in cl.items])
             return completed_tasks / len(cl.items) * 100
-        except (IndexError, ZeroDivisionError):
+        except ZeroDivisionError:
             return -1
 
     @staticmethod
@@ -300,12 +582,16 @@ class Trelolo(TrelloClient, GitLabMixin):
         new_label = self.get_label(
             [{'name': new_tag}], board_data['metadata']
         )
+        if old_label == new_label:
+            return
         card = self.find_card(board_data, old_label)
         if card:
-            card.set_name(new_label)
+            plan = Plan()
+            plan.rename_card(card, new_label)
             models.Cards.query.filter_by(
                 label=old_label
             ).update({models.Cards.label: new_label})
+            self.apply_plan(plan)
             log.info(
                 'changed {} label to {}'.format(
                     old_label, new_label
@@ -314,22 +600,24 @@ class Trelolo(TrelloClient, GitLabMixin):
 
     def handle_generic_event(self, parent_board_id, card_id, stored_card):
         board_data = self.board_data[parent_board_id]
+        plan = Plan()
         card = self.get_card(card_id)
         card.fetch(eager=False)
         label = self.get_label(card.labels, board_data['metadata'])
         try:
             if label != stored_card.label:
-                self.remove_checklist_item(stored_card)
-                card.set_description('')
+                self.remove_checklist_item(stored_card, plan)
+                plan.set_description(card, '')
                 db.session.delete(stored_card)
                 stored_card = {}
-                db.session.commit()
+                # the new row of the card must not be inserted first
+                db.session.flush()
         except (AttributeError, TypeError):
             pass
         # useful dict for later
         completeness = self.get_completeness(card)
         child = {
-            'card': copy.deepcopy(card),
+            'card': card,
             'title': helpers.format_itemname(
                 completeness, card.url, card.get_list().name
             ),
@@ -347,57 +635,52 @@ class Trelolo(TrelloClient, GitLabMixin):
                     )
                 card.fetch(eager=False)
                 log.info('found card {}'.format(card.name))
-                # new item (the whole sub card)
-                item = self.add_checklist_item(
-                    card, child['title'], child['state']
-                )
+
+                def link(item):
+                    self.store_item(models.Cards, {
+                        'card_id': child['card'].id,
+                        'board_id': child['card'].board_id,
+                        'parent_card_id': card.id,
+                        'item_id': item['id'],
+                        'item_name': child['title'],
+                        'label': label,
+                        'checked': child['state'],
+                        'hook_id': item['hook_id'],
+                        'hook_url': item['hook_url']
+                    }, ['card_id'], item)
+                # new item (the whole sub card), stored once it exists
+                plan.add_item(card, child['title'], child['state'], link)
                 # update child card description
-                child['card'].set_description(
+                plan.set_description(
+                    child['card'],
                     helpers.format_teamboard_card_descritpion(
                         board_data['metadata']['desc_title'],
-                        child['card'].desc,
+                        plan.description(child['card']),
                         card.url
                     )
                 )
-                # insert into db
-                new_card = models.Cards(
-                    card_id=child['card'].id,
-                    board_id=child['card'].board_id,
-                    parent_card_id=card.id,
-                    item_id=item['id'],
-                    item_name=child['title'],
-                    label=label,
-                    checked=child['state'],
-                    hook_id=item['hook_id'],
-                    hook_url=item['hook_url']
-                )
-                db.session.add(new_card)
                 okr_label = next(
                     (label for label in card.labels
                      if label.name.startswith('OKR:')), None
                 )
                 if okr_label:
-                    self.add_okr_label_to_card(child['card'], okr_label)
+                    self.add_okr_label_to_card(
+                        child['card'], okr_label, plan
+                    )
             else:
-                upd = self.update_checklist_item(
-                    child['title'], child['state'], stored_card
+                self.update_checklist_item(
+                    child['title'], child['state'], stored_card, plan
                 )
-                if upd and stored_card:
-                    stored_card.item_name = child['title']
-                    stored_card.checked = child['state']
         try:
             parent_card_id = stored_card.parent_card_id \
                 if stored_card else card.id
-            parent_card = self.get_card(parent_card_id)
-            cd = helpers.CardDescription(parent_card.desc)
-            cd.set_list_value('members', child['members'])
-            parent_card.set_description(cd.get_description())
+            self.add_card_members(parent_card_id, child['members'])
         except Exception as e:
             log.warning(
                 'failed to update parent card: {}'.format(str(e))
             )
         # save changes
-        db.session.commit()
+        self.apply_plan(plan)
         try:
             pass
         except Exception as e:
@@ -405,6 +688,57 @@ class Trelolo(TrelloClient, GitLabMixin):
                 'Error updating card description: {}'.format(str(e))
             )
 
+    def handle_check_item(self, stored_card, checklist_id, item_id, state,
+                          created=False):
+        """
+        Updates the item of a sub card from a check item event of the card
+        alone, see `ChecklistCounters.update`. Returns False when the
+        event needs the full `handle_generic_event`.
+        """
+        counters = self.checklist_counters
+        if counters is None or not stored_card:
+            return False
+        parsed = helpers.parse_itemname(stored_card.item_name)
+        if parsed is None:
+            return False
+        completeness = counters.update(
+            stored_card.card_id, checklist_id, item_id, state, created
+        )
+        if completeness is None:
+            return False
+        plan = Plan()
+        self.update_checklist_item(
+            helpers.format_itemname(completeness, *parsed),
+            completeness == 100, stored_card, plan
+        )
+        self.apply_plan(plan)
+        return True
+
+    def store_item(self, model, row, keys, item):
+        """
+        Stores the row of a new check item. When another job stored one
+        for the same keys meanwhile, the new item and its hook are deleted
+        again, no row would point to them.
+        """
+        if models.upsert(model, [row], keys, update=False):
+            return True
+        log.warning('{} {} was linked meanwhile, deleting item {}'.format(
+            model.__table__.name, ' '.join(str(row[k]) for k in keys),
+            item['id']
+        ))
+        try:
+            self.delete_checklist_item(row['parent_card_id'], item['id'])
+            if item['hook_id']:
+                self.fetch_json(
+                    '/webhooks/{}'.format(item['hook_id']),
+                    http_method='DELETE'
+                )
+        except ResourceUnavailable as e:
+            log.error('could not delete item {}: {}'.format(
+                item['id'], str(e)
+            ))
+        return False
+
     def add_checklist_item(self, card, item_name, checked):
         try:
             cl = card.fetch_checklists()[0]
@@ -423,18 +757,74 @@ class Trelolo(TrelloClient, GitLabMixin):
             'hook_url': hook.callback_url if hook else ''
         }
 
-    def update_checklist_item(self, item_name, checked, stored_card):
+    @staticmethod
+    def is_stale_resource(error):
+        return getattr(error, '_status', None) in (400, 404)
+
+    def put_checklist_item(self, card_id, item_id, fields):
+        return self.fetch_json(
+            '/cards/{}/checkItem/{}'.format(card_id, item_id),
+            http_method='PUT',
+            post_args=fields
+        )
+
+    def delete_checklist_item(self, card_id, item_id):
+        return self.fetch_json(
+            '/cards/{}/checkItem/{}'.format(card_id, item_id),
+            http_method='DELETE'
+        )
+
+    def refetch_checklist_item(self, item):
+        """
+        Looks up a check item on the parent card by its stored name,
+        used only when the stored item id turned out to be stale. `item` is
+        a `plan.Item`, the caller stores the new id.
+        """
+        checklists = self.fetch_json(
+            '/cards/{}/checklists'.format(item.card_id)
+        )
+        for cl in checklists:
+            for found in cl['checkItems']:
+                if found['name'] == item.name:
+                    log.info(
+                        'refreshed stale item id {} to {}'.format(
+                            item.id, found['id']
+                        )
+                    )
+                    return found
+        return None
+
+    def set_checklist_item_fields(self, item, fields):
+        """
+        Writes the fields of a `plan.Item` and returns the id of the item
+        written, None when it is gone.
+        """
+        try:
+            self.put_checklist_item(item.card_id, item.id, fields)
+            return item.id
+        except ResourceUnavailable as e:
+            if not self.is_stale_resource(e):
+                raise
+        found = self.refetch_checklist_item(item)
+        if found is None:
+            log.warning(
+                'item {} not found on card {}'.format(item.name, item.card_id)
+            )
+            return None
+        self.put_checklist_item(item.card_id, found['id'], fields)
+        return found['id']
+
+    def update_checklist_item(self, item_name, checked, stored_card, plan):
         if not stored_card:
             log.warning('card or item not specified')
             return False
-        card = self.get_card(stored_card.parent_card_id)
-        card.fetch(eager=False)
-        cl = card.fetch_checklists()[0]
-        # item = self.get_checklist_item(cl, stored_card.item_id)
         log.info(
-            'updating item {} on card {}'.format(item_name, card.name)
+            'updating item {} on card {}'.format(
+                item_name, stored_card.parent_card_id
+            )
         )
         upd = {}
+        fields = {}
         # check name change
         if item_name != stored_card.item_name:
             log.info(
@@ -442,17 +832,21 @@ class Trelolo(TrelloClient, GitLabMixin):
                     stored_card.item_name, item_name
                 )
             )
-            cl.rename_checklist_item(stored_card.item_name, item_name)
+            fields['name'] = item_name
             upd['item_name'] = item_name
         # check status change
         if checked != stored_card.checked:
             log.info(
                 'set checked status {} to {}'.format(item_name, checked)
             )
-            cl.set_checklist_item(item_name, checked)
+            fields['state'] = 'complete' if checked else 'incomplete'
             upd['checked'] = checked
+        if fields:
+            def updated(result):
+                for k, v in upd.items():
+                    setattr(stored_card, k, v)
+            plan.update_item(stored_card, fields, updated)
         return upd
-        # self.add_members(data)
 
     @staticmethod
     def get_checklist_item(checklist, item_id):
@@ -460,26 +854,28 @@ class Trelolo(TrelloClient, GitLabMixin):
             (item for item in checklist.items if item['id'] == item_id), None
         )
 
-    def remove_checklist_item(self, stored_card):
+    def delete_stored_item(self, item):
+        """
+        Deletes a `plan.Item`, looked up by name when its id is stale.
+        """
         try:
-            card = self.get_card(stored_card.parent_card_id)
-            card.fetch(eager=False)
-            cl = card.fetch_checklists()[0]
-            item = self.get_checklist_item(
-                cl, stored_card.item_id
-            )
-            cl.delete_checklist_item(item['name'])
-        except:
-            log.error('could not remove checklist item')
-        self.remove_webhook(
-            stored_card.hook_id,
-            stored_card.parent_card_id
-        )
+            self.delete_checklist_item(item.card_id, item.id)
+        except ResourceUnavailable as e:
+            if not self.is_stale_resource(e):
+                raise
+            found = self.refetch_checklist_item(item)
+            if found is not None:
+                self.delete_checklist_item(item.card_id, found['id'])
+
+    def remove_checklist_item(self, stored_card, plan):
+        plan.delete_item(stored_card)
+        plan.delete_hook(stored_card.hook_id, stored_card.parent_card_id)
 
     def handle_delete_card(self, stored_card):
-        self.remove_checklist_item(stored_card)
+        plan = Plan()
+        self.remove_checklist_item(stored_card, plan)
         db.session.delete(stored_card)
-        db.session.commit()
+        self.apply_plan(plan)
         log.info('card has been succesfully deleted')
 
     # GITLAB WEBHOOKS
@@ -495,10 +891,15 @@ class Trelolo(TrelloClient, GitLabMixin):
             return False
 
     def get_cards_for_gitlab(self, label, milestone):
+        """
+        Returns the open team cards tagged with the label or the milestone,
+        the boards are read concurrently.
+        """
         gl_cards = []
-        for board in self.list_team_boards():
-            cards = board.open_cards()
-            for card in cards:
+        aio = self.get_aio()
+        boards = aio.run(aio.fetch_boards_cards(self.list_team_board_ids()))
+        for cards in boards:
+            for card in [make_card(self, c) for c in cards]:
                 if self.check_labels(card.labels, label):
                     gl_cards.append(card)
                 if self.check_labels(card.labels, milestone):
@@ -515,10 +916,27 @@ class Trelolo(TrelloClient, GitLabMixin):
         stored_card_ids = [id for id in stored_targets.keys()]
         cards = self.get_cards_for_gitlab(data['label'], data['milestone'])
         trello_links = []
+        plan = Plan()
+
+        def link(card):
+            def done(item):
+                self.store_item(models.Issues, {
+                    'issue_id': str(data['id']),
+                    'project_id': str(data['project_id']),
+                    'parent_card_id': card.id,
+                    'label': data['label'] or '',
+                    'milestone': data['milestone'] or '',
+                    'item_id': item['id'],
+                    'item_name': data['target_title'],
+                    'checked': data['state'],
+                    'target_type': data['type'],
+                    'hook_id': '',
+                    'hook_url': ''
+                }, ['issue_id', 'target_type', 'parent_card_id'], item)
+            return done
         if cards:
             for card in cards:
                 try:
-                    card.fetch(eager=False)
                     stored_card_ids.remove(card.id)
                 except ValueError:
                     pass
@@ -529,12 +947,9 @@ class Trelolo(TrelloClient, GitLabMixin):
                             'updating gitlab item {} on card {}'.format(
                                 target.item_name, card.name)
                         )
-                        upd = self.update_checklist_item(
-                            data['target_title'], data['state'], target
+                        self.update_checklist_item(
+                            data['target_title'], data['state'], target, plan
                         )
-                        if upd and target:
-                            target.item_name = data['target_title']
-                            target.checked = data['state']
                         trello_links.append(
                             helpers.format_trello_link(card.url)
                         )
@@ -543,36 +958,18 @@ class Trelolo(TrelloClient, GitLabMixin):
                             'removing gitlab item {} from card {}'.format(
                                 target.item_name, card.name)
                         )
-                        self.remove_checklist_item(target)
+                        self.remove_checklist_item(target, plan)
                         db.session.delete(target)
                 else:
-                    item = self.add_checklist_item(
-                        card, data['target_title'], data['state']
-                    )
-                    new_item = models.Issues(
-                        issue_id=data['id'],
-                        project_id=data['project_id'],
-                        parent_card_id=card.id,
-                        label=data['label'] or '',
-                        milestone=data['milestone'] or '',
-                        item_id=item['id'],
-                        item_name=data['target_title'],
-                        checked=data['state'],
-                        target_type=data['type'],
-                        hook_id='',
-                        hook_url=''
-                    )
                     log.info(
                         'creating gitlab item {}'.format(data['target_title'])
                     )
-                    db.session.add(new_item)
+                    plan.add_item(
+                        card, data['target_title'], data['state'], link(card)
+                    )
                     trello_links.append(helpers.format_trello_link(card.url))
 
-                cd = helpers.CardDescription(card.desc)
-                cd.set_list_value('members', data['assignee_email'] or '')
-                card.set_description(cd.get_description())
-
-            db.session.commit()
+                self.add_card_members(card.id, [data['assignee_email']])
         else:
             log.warning(
                 'no suitable card found on any team-board \
@@ -586,24 +983,35 @@ class Trelolo(TrelloClient, GitLabMixin):
                 'removing gitlab item {} from card {}'.format(
                     target.item_name, card_id)
             )
-            self.remove_checklist_item(target)
+            self.remove_checklist_item(target, plan)
             db.session.delete(target)
-        db.session.commit()
 
         # update GL target description
-        old_desc = self.parse_gl_target_desc(data['description'])
-        new_desc = self.format_gl_desc([old_desc[0], trello_links])
-
-        log.info(data['description'])
-        log.info(new_desc)
-
-        if new_desc != data['description']:
-            self.update_gl_desc(
-                data['project_id'],
-                data['target_url'],
-                data['id'],
-                [old_desc[0], trello_links]
-            )
+        description = data.get('description')
+        if description is None:
+            log.warning('could not read the description of {} {}'.format(
+                data['type'], data['id']
+            ))
+        else:
+            old_desc = self.parse_gl_target_desc(description)
+            new_desc = self.format_gl_desc([old_desc[0], trello_links])
+            if new_desc != description:
+                log.info('linking {} trello cards to {} {}'.format(
+                    len(trello_links), data['type'], data['id']
+                ))
+                plan.set_gl_description(
+                    data['project_id'],
+                    data['target_url'],
+                    data['id'],
+                    [old_desc[0], trello_links]
+                )
+        self.apply_plan(plan)
+
+    @staticmethod
+    def set_checked(stored_item, checked):
+        def done(result):
+            stored_item.checked = checked
+        return done
 
     def handle_gitlab_state_change(self, project_id, id, type, state):
         stored_targets = models.Issues.query.filter_by(
@@ -611,28 +1019,14 @@ class Trelolo(TrelloClient, GitLabMixin):
             issue_id=str(id),
             target_type=type
         ).all()
+        plan = Plan()
         for target in stored_targets:
-            try:
-                card = self.get_card(target.parent_card_id)
-                card.fetch(eager=False)
-                try:
-                    cl = card.fetch_checklists()[0]
-                    item = self.get_checklist_item(cl, target.item_id)
-                    cl.set_checklist_item(item['name'], state)
-                    target.checked = state
-                except:
-                    log.error(
-                        'could not fetch a checklist for card {}'.format(
-                            card.name
-                        )
-                    )
-            except ResourceUnavailable:
-                log.error(
-                    'could not get trello card {} for GL target {}'.format(
-                        target.parent_card_id, id
-                    )
-                )
-        db.session.commit()
+            if target.checked == state:
+                continue
+            plan.update_item(target, {
+                'state': 'complete' if state else 'incomplete'
+            }, self.set_checked(target, state))
+        self.apply_plan(plan)
         log.info(
             'succesfully synced trello GL items with GL target'
         )
@@ -1,5 +1,7 @@
 import logging
 import re
+import threading
+import time
 from collections import OrderedDict
 
 
@@ -15,6 +17,18 @@ def format_itemname(completeness, url, listname):
         return "{} (#{})".format(url, listname)
 
 
+ITEMNAME = re.compile(r'^(?:\d+% )?(.+?) \(#(.*)\)$')
+
+
+def parse_itemname(item_name):
+    """
+    Returns (url, listname) of an item name made by `format_itemname`,
+    None for other names.
+    """
+    match = ITEMNAME.match(item_name or '')
+    return match.groups() if match else None
+
+
 def format_trello_link(url):
     return '* {}'.format(url)
 
@@ -40,6 +54,51 @@ def parse_listname(lst_name):
         pass
 
 
+class RateLimiter(object):
+    """
+    Token bucket shared by several threads: up to `rate` calls per second
+    on average, bursts of up to `burst` calls (one second worth by
+    default). A rate of 0 does not limit.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def wait(self):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            self.refill()
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+    def acquire(self):
+        """
+        Takes a call without waiting, returns False when none is left.
+        """
+        if self.rate <= 0:
+            return True
+        with self.lock:
+            self.refill()
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
 class CardDescription(object):
 
     INIT_DESCRIPTION = '----\n' \
@@ -73,6 +132,10 @@ class CardDescription(object):
     def set_value(self, key, value):
         self.data[key] = value
 
+    def get_list_value(self, key):
+        val = self.get_value(key, '').strip()
+        return [i.strip() for i in val.split(',')] if val != '' else []
+
     def set_list_value(self, key, values):
         val = self.get_value(key, '').strip()
         l = val.split(',') if val != '' else []
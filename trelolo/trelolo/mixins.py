@@ -1,6 +1,9 @@
 from enum import Enum
 import logging
+import os
+import time
 import requests
+from trelolo import metrics, tracing
 
 log = logging.getLogger(__name__)
 
@@ -10,10 +13,59 @@ class TargetTag(Enum):
     MR = 'GLMR'
 
 
+def pick(picker, obj, what):
+    try:
+        return picker(obj)
+    except Exception as e:
+        log.warning('error fetching {}: {}'.format(what, str(e)))
+
+
+def pick_gl_label(target):
+    labels = [l for l in target['labels'] if l[0] == '$']
+    return labels[0][1:]
+
+
+def pick_gl_milestone(milestone):
+    title = milestone['title']
+    return title[1:] if title[0] == '$' else False
+
+
+def pick_gl_project_name(project):
+    return project['name_with_namespace'] \
+        if project['name_with_namespace'] else project['name']
+
+
 class GitLabMixin(object):
 
     gitlab_url = None
     gitlab_token = None
+    gitlab_session = None
+    gitlab_session_pid = None
+
+    def get_gitlab_session(self):
+        # same as Trelolo.get_http_session
+        if self.gitlab_session is None or \
+                self.gitlab_session_pid != os.getpid():
+            self.gitlab_session = requests.Session()
+            self.gitlab_session_pid = os.getpid()
+        return self.gitlab_session
+
+    def gl_request(self, method, url, data=None):
+        start = time.time()
+        status = 'error'
+        try:
+            r = self.get_gitlab_session().request(method, url, data=data)
+            status = r.status_code
+            return r
+        finally:
+            path = url.replace(self.gitlab_url or '', '', 1).split('?')[0]
+            metrics.observe_upstream(
+                'gitlab', method, path, status, time.time() - start
+            )
+            tracing.record(
+                'gitlab', '{} {}'.format(method, path),
+                start, time.time() - start, status=status
+            )
 
     def urls_into_desc(self, separator, description, urls):
         new_urls = []
@@ -51,7 +103,7 @@ class GitLabMixin(object):
             id,
             self.gitlab_token
         )
-        r = requests.put(url, data)
+        r = self.gl_request('PUT', url, data)
         return [r.json(), url, data]
 
     def fetch_gl_target_desc(self, project_id, target_url, id):
@@ -62,7 +114,7 @@ class GitLabMixin(object):
             id,
             self.gitlab_token
         )
-        r = requests.get(url)
+        r = self.gl_request('GET', url)
         try:
             data = r.json()
             return self.parse_gl_target_desc(
@@ -76,7 +128,7 @@ class GitLabMixin(object):
             self.gitlab_url, project_id, self.gitlab_token
         )
         try:
-            requests.post(url, {
+            self.gl_request('POST', url, {
                 'name': name,
                 'color': '#5843AD'
             })
@@ -85,103 +137,61 @@ class GitLabMixin(object):
                 'error creating gitlab label {}: {}'.format(name, str(e))
             )
 
-    def add_gl_label(self, project_id, id, target_url, name):
+    def update_gl_labels(self, project_id, id, target_url, add, remove):
+        """
+        Adds and removes labels of a target with one read and one write.
+        """
         url = '{}/api/v3/projects/{}/{}/{}?access_token={}'.format(
             self.gitlab_url, project_id, target_url, id, self.gitlab_token
         )
-        try:
-            r = requests.get(url)
-            labels = r.json()['labels']
-            if name not in labels:
-                labels.append(name)
-            r = requests.put(url, {
-                'labels': ','.join(labels)
-            })
-            log.info(
-                'setting labels for target {}: {}'.format(id, labels)
-            )
-        except Exception as e:
-            log.warning(
-                'error adding gitlab label {} to {}: {}'.format(
-                    name, id, str(e)
-                )
-            )
-
-    def remove_gl_label(self, project_id, id, target_url, name):
-        url = '{}/api/v3/projects/{}/{}/{}?access_token={}'.format(
-            self.gitlab_url, project_id, target_url, id, self.gitlab_token
+        r = self.gl_request('GET', url)
+        labels = r.json()['labels']
+        new_labels = [l for l in labels if l not in remove]
+        new_labels.extend(l for l in add if l not in new_labels)
+        if new_labels == labels:
+            return False
+        self.gl_request('PUT', url, {
+            'labels': ','.join(new_labels)
+        })
+        log.info(
+            'setting labels for target {}: {}'.format(id, new_labels)
         )
-        try:
-            r = requests.get(url)
-            labels = r.json()['labels']
-            if name in labels:
-                labels.remove(name)
-            r = requests.put(url, {
-                'labels': ','.join(labels)
-            })
-            log.info(
-                'removing labels from target {}: {}'.format(id, labels)
-            )
-        except Exception as e:
-            log.warning(
-                'error removing label from {}: {}'.format(id, str(e))
-            )
-
-    def fetch_gl_labels(self, project_id, target_url, id):
-        url = '{}/api/v3/projects/{}/{}/{}?access_token={}'.format(
-            self.gitlab_url, project_id, target_url, id, self.gitlab_token
-        )
-        r = requests.get(url)
-        try:
-            labels = [l for l in r.json()['labels'] if l[0] == '$']
-            return labels[0][1:]
-        except Exception as e:
-            log.warning(
-                'error fetching labels from {}({}): {}'.format(
-                    target_url, id, str(e)
-                )
-            )
-
-    def fetch_gl_milestone(self, project_id, milestone_id):
-        url = '{}/api/v3/projects/{}/milestones/{}?access_token={}'.format(
-            self.gitlab_url, project_id, milestone_id, self.gitlab_token
-        )
-        r = requests.get(url)
-        try:
-            milestone = r.json()['title']
-            return milestone[1:] if milestone[0] == '$' else False
-        except Exception as e:
-            log.warning(
-                'error fetching gl milestone {} for project {}: {}'.format(
-                    milestone_id, project_id, str(e)
-                )
-            )
-
-    def fetch_gl_project_name(self, project_id):
-        url = '{}/api/v3/projects/{}?access_token={}'.format(
-            self.gitlab_url, project_id, self.gitlab_token
-        )
-        r = requests.get(url)
-        try:
-            data = r.json()
-            project_name = data['name_with_namespace'] \
-                if data['name_with_namespace'] else data['name']
-            return project_name
-        except Exception as e:
-            log.warning(
-                'error fetching gl project {}: {}'.format(project_id, str(e))
-            )
-
-    def fetch_gl_assignee_email(self, assignee_id):
-        url = '{}/api/v3/users/{}/?access_token={}'.format(
-            self.gitlab_url, assignee_id, self.gitlab_token
-        )
-        r = requests.get(url)
-        try:
-            return r.json()['email']
-        except Exception as e:
-            log.warning(
-                'error fetching email from assignee {}'.format(
-                    assignee_id, str(e)
+        return True
+
+    def fetch_gl_details(self, project_id, target_url, id, milestone_id,
+                         assignee_id):
+        """
+        Fetches the label, the milestone, the project name, the assignee
+        email and the description of a target concurrently. Values which
+        cannot be read are None.
+        """
+        aio = self.get_aio()
+        target, milestone, project, assignee = aio.gather([
+            aio.fetch_gl_target(project_id, target_url, id),
+            aio.fetch_gl_milestone(project_id, milestone_id),
+            aio.fetch_gl_project(project_id),
+            aio.fetch_gl_user(assignee_id)
+        ])
+        return {
+            'label': pick(pick_gl_label, target, 'labels from {}({})'.format(
+                target_url, id
+            )),
+            'milestone': pick(
+                pick_gl_milestone, milestone,
+                'gl milestone {} for project {}'.format(
+                    milestone_id, project_id
                 )
+            ),
+            'project_name': pick(
+                pick_gl_project_name, project,
+                'gl project {}'.format(project_id)
+            ),
+            'assignee_email': pick(
+                lambda user: user['email'], assignee,
+                'email from assignee {}'.format(assignee_id)
+            ),
+            'description': pick(
+                lambda target: target['description'] or '', target,
+                'description of {}({})'.format(target_url, id)
             )
+        }
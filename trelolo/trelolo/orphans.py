@@ -0,0 +1,285 @@
+from collections import OrderedDict, namedtuple
+import logging
+import time
+
+from trello import ResourceUnavailable
+from trelolo.extensions import db
+from trelolo import models
+
+from .plan import Plan
+
+log = logging.getLogger(__name__)
+
+GONE = 'gone'
+CLOSED = 'closed'
+OPEN = 'open'
+TARGET_URLS = {'issue': 'issues', 'mr': 'merge_requests'}
+TABLES = (('cards', models.Cards), ('issues', models.Issues))
+
+# `has_item` when the check item is still on a parent card which exists
+Orphan = namedtuple('Orphan', 'table row reason has_item')
+
+
+def describe(orphan):
+    row = orphan.row
+    name = row.card_id if orphan.table == 'cards' else '{} {}/{}'.format(
+        row.target_type, row.project_id, row.issue_id
+    )
+    return '{:<6} {} on {}: {}'.format(
+        orphan.table, name, row.parent_card_id, orphan.reason
+    )
+
+
+def hook_age(hook_id, now):
+    """
+    Seconds since a hook was created, Trello ids start with the creation
+    time. None when the id is not a Trello id.
+    """
+    try:
+        return now - int(hook_id[:8], 16)
+    except (TypeError, ValueError):
+        return None
+
+
+async def settle(coro):
+    try:
+        return await coro
+    except ResourceUnavailable as e:
+        return e
+
+
+class Collector(object):
+    """
+    Removes the Cards and Issues rows whose card, parent card or GitLab
+    target is gone or archived, or whose board is closed, and the hooks
+    nothing refers to anymore. Boards are read in bulk and the rest in
+    parallel on the asyncio client; a row is only removed on a 404 or a
+    closed card or board, never on another error. The check items of the
+    rows are deleted from their parent cards first, a row whose item
+    could not be deleted is kept for the next run. Hooks younger than
+    `grace` seconds may belong to a link being made and are left alone.
+    """
+
+    CHUNK = 500
+
+    def __init__(self, client, delete_hooks, grace=3600):
+        self.client = client
+        self.delete_hooks = delete_hooks
+        self.grace = grace
+
+    def card_states(self, card_ids, board_ids):
+        aio = self.client.get_aio()
+        board_ids = list(board_ids)
+        boards = aio.gather([
+            settle(aio.fetch_board(board_id)) for board_id in board_ids
+        ])
+        closed_boards = set(
+            board_id for board_id, board in zip(board_ids, boards)
+            if isinstance(board, dict) and board.get('closed')
+        )
+        open_boards = [
+            board_id for board_id, board in zip(board_ids, boards)
+            if isinstance(board, dict) and not board.get('closed')
+        ]
+        states = {}
+        for cards in aio.gather([
+            settle(aio.fetch_board_cards(board_id, 'open', 'closed'))
+            for board_id in open_boards
+        ]):
+            if isinstance(cards, list):
+                states.update((c['id'], OPEN) for c in cards)
+        # archived, deleted, moved or on a closed board
+        unknown = [c for c in card_ids if c not in states]
+        for chunk in models.chunks(unknown, self.CHUNK):
+            cards = aio.gather([
+                settle(aio.fetch_card(card_id, 'closed,idBoard'))
+                for card_id in chunk
+            ])
+            for card_id, card in zip(chunk, cards):
+                if isinstance(card, dict):
+                    states[card_id] = CLOSED if card['closed'] or \
+                        card['idBoard'] in closed_boards else OPEN
+                elif self.client.is_stale_resource(card):
+                    states[card_id] = GONE
+        return states
+
+    def target_states(self, targets):
+        aio = self.client.get_aio()
+        states = {}
+        for chunk in models.chunks(targets, self.CHUNK):
+            results = aio.gather([
+                aio.fetch_gl_target_status(
+                    project_id, TARGET_URLS.get(target_type, 'issues'), id
+                ) for project_id, target_type, id in chunk
+            ])
+            for target, (status, json) in zip(chunk, results):
+                if status == 404:
+                    states[target] = GONE
+                elif status == 200 and json:
+                    # moved to another project
+                    projects = (
+                        str(json.get('project_id')),
+                        str(json.get('source_project_id'))
+                    )
+                    states[target] = OPEN if str(target[0]) in projects \
+                        else GONE
+        return states
+
+    @staticmethod
+    def reason(states, card_id, what):
+        state = states.get(card_id)
+        if state in (GONE, CLOSED):
+            return '{} {}'.format(what, state)
+        return None
+
+    def find(self, card_rows, issue_rows):
+        """
+        Returns the orphan rows.
+        """
+        card_ids = set(r.card_id for r in card_rows) | set(
+            r.parent_card_id for r in card_rows + issue_rows
+        )
+        board_ids = set(r.board_id for r in card_rows) | set(
+            self.client.board_data
+        )
+        states = self.card_states(card_ids, board_ids)
+        targets = self.target_states(sorted(set(
+            (r.project_id, r.target_type, r.issue_id) for r in issue_rows
+        )))
+        orphans = []
+        for row in card_rows:
+            reason = self.reason(states, row.card_id, 'card') or \
+                self.reason(states, row.parent_card_id, 'parent card')
+            if reason:
+                orphans.append(Orphan(
+                    'cards', row, reason,
+                    states.get(row.parent_card_id) != GONE
+                ))
+        for row in issue_rows:
+            reason = self.reason(states, row.parent_card_id, 'parent card')
+            if not reason and targets.get(
+                (row.project_id, row.target_type, row.issue_id)
+            ) == GONE:
+                reason = 'target gone'
+            if reason:
+                orphans.append(Orphan(
+                    'issues', row, reason,
+                    states.get(row.parent_card_id) != GONE
+                ))
+        return orphans
+
+    def delete_items(self, orphans):
+        """
+        Deletes the check items of the orphan rows from their parent
+        cards, as `handle_delete_card` does, and returns the orphans whose
+        item could not be deleted.
+        """
+        plan = Plan()
+        for table, model in TABLES:
+            ids = [
+                o.row.id for o in orphans if o.table == table and o.has_item
+            ]
+            for chunk in models.chunks(ids, self.CHUNK):
+                for row in model.query.filter(model.id.in_(chunk)):
+                    plan.delete_item(row)
+        if not len(plan):
+            return []
+        failed = set(
+            (m.args['row'].__table__.name, m.args['row'].id)
+            for m in self.client.get_executor().run(plan)
+        )
+        return [o for o in orphans if (o.table, o.row.id) in failed]
+
+    def find_hooks(self, orphans, card_rows, issue_rows):
+        """
+        Returns the hooks of the orphan rows and the hooks of trelolo on
+        models no board or row refers to.
+        """
+        removed = set((o.table, o.row.id) for o in orphans)
+        kept = [r for r in card_rows if ('cards', r.id) not in removed] + \
+            [r for r in issue_rows if ('issues', r.id) not in removed]
+        boards = models.Boards.query.with_entities(
+            models.Boards.trello_id, models.Boards.hook_id
+        ).all()
+        keep_hooks = set(b.hook_id for b in boards) | set(
+            r.hook_id for r in kept
+        )
+        keep_models = set(b.trello_id for b in boards) | set(
+            self.client.board_data
+        ) | set(r.parent_card_id for r in kept)
+        orphan_hooks = set(o.row.hook_id for o in orphans)
+        now = time.time()
+        hooks = []
+        for hook in self.client.list_hooks(
+            token=self.client.resource_owner_key
+        ):
+            if hook.id in keep_hooks:
+                continue
+            if hook.id in orphan_hooks:
+                hooks.append(hook)
+                continue
+            age = hook_age(hook.id, now)
+            if hook.id_model not in keep_models and \
+                    '/trello/' in (hook.callback_url or '') and \
+                    age is not None and age >= self.grace:
+                hooks.append(hook)
+        return hooks
+
+    def run(self, dry_run=False):
+        """
+        Deletes the check items of the orphan rows, removes the rows in
+        chunks, then their hooks, and returns what was reclaimed. A dry
+        run, or MUTATIONS_DRY_RUN, only logs it.
+        """
+        card_rows = models.Cards.query.with_entities(
+            models.Cards.id, models.Cards.card_id, models.Cards.board_id,
+            models.Cards.parent_card_id, models.Cards.hook_id
+        ).all()
+        issue_rows = models.Issues.query.with_entities(
+            models.Issues.id, models.Issues.issue_id,
+            models.Issues.project_id, models.Issues.target_type,
+            models.Issues.parent_card_id, models.Issues.hook_id
+        ).all()
+        dry_run = dry_run or self.client.get_executor().dry_run
+        orphans = self.find(card_rows, issue_rows)
+        for orphan in orphans:
+            log.info('{}orphan {}'.format(
+                'dry run: ' if dry_run else '', describe(orphan)
+            ))
+        failed_items = [] if dry_run else self.delete_items(orphans)
+        if failed_items:
+            kept = set((o.table, o.row.id) for o in failed_items)
+            orphans = [o for o in orphans if (o.table, o.row.id) not in kept]
+        hooks = self.find_hooks(orphans, card_rows, issue_rows)
+        report = OrderedDict([
+            ('cards', sum(o.table == 'cards' for o in orphans)),
+            ('issues', sum(o.table == 'issues' for o in orphans)),
+            ('hooks', len(hooks)),
+            ('failed_items', len(failed_items)),
+            ('failed_hooks', 0)
+        ])
+        if dry_run:
+            for hook in hooks:
+                log.info('dry run: orphan hook {} on {}'.format(
+                    hook.id, hook.id_model
+                ))
+            return report
+        for table, model in TABLES:
+            ids = [o.row.id for o in orphans if o.table == table]
+            for chunk in models.chunks(ids, self.CHUNK):
+                models.delete_rows(model, model.id, chunk)
+                db.session.commit()
+        counters = self.client.checklist_counters
+        if counters is not None:
+            for orphan in orphans:
+                if orphan.table == 'cards':
+                    counters.forget(orphan.row.card_id)
+        if hooks:
+            report['failed_hooks'] = self.delete_hooks(hooks)
+        log.info(
+            'collected {cards} cards, {issues} issues and {hooks} hooks, '
+            '{failed_items} items and {failed_hooks} hooks failed'.format(
+                **report
+            )
+        )
+        return report
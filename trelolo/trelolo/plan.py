@@ -0,0 +1,371 @@
+"""
+Planned Trello and GitLab writes.
+
+Handlers do their reads and collect the writes they intend as mutations
+of a `Plan` instead of sending them right away. The plan merges writes to
+the same resource (the last description or label state of a card wins,
+item field updates add up, deleting an item drops its updates) and an
+`Executor` runs it: no-ops are dropped, kinds run in a fixed order, each
+kind concurrently and within the rate limit, hook deletions and GitLab
+label changes batched, and failed writes are retried when doing them
+again is safe. Results reach the handler through the `done` callback of a
+mutation, called in the thread of the handler.
+"""
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+
+import requests
+from trello import ResourceUnavailable
+
+from trelolo.trelolo import helpers
+
+log = logging.getLogger(__name__)
+
+# kinds in the order they run
+ORDER = (
+    'delete-item', 'delete-hook', 'add-item', 'update-item', 'card-label',
+    'rename-card', 'set-description', 'gl-create-label', 'gl-label',
+    'gl-description'
+)
+# kinds which write the same resource
+SLOTS = {'update-item': 'item', 'delete-item': 'item'}
+# kinds which must not be sent twice when the outcome is unknown
+NOT_IDEMPOTENT = ('add-item',)
+
+Mutation = namedtuple('Mutation', 'kind key args done')
+# the stored check item a write needs, the rows stay in the handler thread
+Item = namedtuple('Item', 'card_id id name')
+
+
+def chain(first, second):
+    if first is None or second is None:
+        return first or second
+
+    def done(result):
+        first(result)
+        second(result)
+    return done
+
+
+def merge(old, new):
+    if old.kind == 'delete-item':
+        return old
+    if old.kind == new.kind == 'update-item':
+        fields = dict(old.args['fields'])
+        fields.update(new.args['fields'])
+        return new._replace(
+            args=dict(new.args, fields=fields),
+            done=chain(old.done, new.done)
+        )
+    return new
+
+
+def is_noop(mutation):
+    args = mutation.args
+    if mutation.kind == 'update-item':
+        return not args['fields']
+    if mutation.kind == 'set-description':
+        return (getattr(args['card'], 'desc', None) or '') == args['value']
+    if mutation.kind == 'rename-card':
+        return args['card'].name == args['name']
+    if mutation.kind == 'card-label':
+        id_labels = getattr(args['card'], 'idLabels', None)
+        if id_labels is None:
+            return False
+        return (args['label'].id in id_labels) == args['add']
+    return False
+
+
+def describe(mutation):
+    args = mutation.args
+    if mutation.kind == 'update-item':
+        detail = ', '.join(
+            '{}={}'.format(k, v) for k, v in sorted(args['fields'].items())
+        )
+    elif mutation.kind == 'add-item':
+        detail = '{} checked={}'.format(args['name'], args['checked'])
+    elif mutation.kind == 'set-description':
+        detail = '{} characters'.format(len(args['value']))
+    elif mutation.kind == 'rename-card':
+        detail = args['name']
+    elif mutation.kind in ('card-label', 'gl-label'):
+        name = getattr(args.get('label'), 'name', args.get('name'))
+        detail = '{}{}'.format('+' if args['add'] else '-', name)
+    else:
+        detail = ''
+    return '{:<15} {} {}'.format(
+        mutation.kind, ' '.join(str(k) for k in mutation.key), detail
+    ).rstrip()
+
+
+class Plan(object):
+
+    def __init__(self):
+        self.mutations = OrderedDict()
+
+    def __len__(self):
+        return len(self.mutations)
+
+    def add(self, kind, key, done=None, **args):
+        slot = (SLOTS.get(kind, kind), key)
+        mutation = Mutation(kind, key, args, done)
+        if slot in self.mutations:
+            mutation = merge(self.mutations[slot], mutation)
+        self.mutations[slot] = mutation
+        return mutation
+
+    def pending(self, kind=None):
+        return [
+            m for m in self.mutations.values()
+            if (kind is None or m.kind == kind) and not is_noop(m)
+        ]
+
+    def describe(self):
+        return [
+            describe(m) for kind in ORDER for m in self.pending(kind)
+        ]
+
+    def description(self, card):
+        """
+        The description of `card` once the plan ran.
+        """
+        planned = self.mutations.get(('set-description', (card.id,)))
+        if planned is not None:
+            return planned.args['value']
+        return getattr(card, 'desc', None) or ''
+
+    def add_item(self, card, name, checked, done=None):
+        return self.add(
+            'add-item', (card.id, name), done,
+            card=card, name=name, checked=checked
+        )
+
+    @staticmethod
+    def item(stored_item):
+        return Item(
+            stored_item.parent_card_id, stored_item.item_id,
+            stored_item.item_name
+        )
+
+    @staticmethod
+    def track_id(stored_item):
+        """
+        Stores the item id the write found, when the stored one was stale.
+        """
+        def done(item_id):
+            if item_id is not None and item_id != stored_item.item_id:
+                stored_item.item_id = item_id
+        return done
+
+    def update_item(self, stored_item, fields, done=None):
+        return self.add(
+            'update-item',
+            (stored_item.parent_card_id, stored_item.item_id),
+            chain(self.track_id(stored_item), done),
+            row=stored_item, item=self.item(stored_item), fields=fields
+        )
+
+    def delete_item(self, stored_item, done=None):
+        return self.add(
+            'delete-item',
+            (stored_item.parent_card_id, stored_item.item_id), done,
+            row=stored_item, item=self.item(stored_item)
+        )
+
+    def delete_hook(self, hook_id, model_id):
+        return self.add(
+            'delete-hook', (hook_id, model_id),
+            hook_id=hook_id, model_id=model_id
+        )
+
+    def set_label(self, card, label, add=True):
+        return self.add(
+            'card-label', (card.id, label.id),
+            card=card, label=label, add=add
+        )
+
+    def rename_card(self, card, name):
+        return self.add('rename-card', (card.id,), card=card, name=name)
+
+    def set_description(self, card, value):
+        return self.add(
+            'set-description', (card.id,), card=card, value=value
+        )
+
+    def create_gl_label(self, project_id, name):
+        return self.add(
+            'gl-create-label', (project_id, name),
+            project_id=project_id, name=name
+        )
+
+    def set_gl_label(self, project_id, target_url, id, name, add=True):
+        return self.add(
+            'gl-label', (project_id, target_url, id, name),
+            project_id=project_id, target_url=target_url, id=id,
+            name=name, add=add
+        )
+
+    def set_gl_description(self, project_id, target_url, id, desc):
+        return self.add(
+            'gl-description', (project_id, target_url, id),
+            project_id=project_id, target_url=target_url, id=id, desc=desc
+        )
+
+
+class Executor(object):
+    """
+    Runs plans against the Trello and GitLab clients. With `dry_run` it
+    only logs the plan.
+    """
+
+    RETRIES = 3
+
+    def __init__(self, client, workers=8, limiter=None, dry_run=False):
+        self.client = client
+        self.workers = workers
+        self.limiter = limiter or helpers.RateLimiter(0)
+        self.dry_run = dry_run
+
+    def call(self, kind, f, *args):
+        """
+        Calls `f` within the rate limit. Throttled calls are sent again,
+        failed ones only if the kind is idempotent.
+        """
+        for attempt in range(self.RETRIES + 1):
+            self.limiter.wait()
+            try:
+                return f(*args)
+            except ResourceUnavailable as e:
+                status = getattr(e, '_status', None) or 0
+                retry = status == 429 or (
+                    status >= 500 and kind not in NOT_IDEMPOTENT
+                )
+                if not retry or attempt == self.RETRIES:
+                    raise
+            except requests.ConnectionError:
+                if kind in NOT_IDEMPOTENT or attempt == self.RETRIES:
+                    raise
+            time.sleep(2 ** attempt)
+
+    def attempt(self, mutation, f, *args):
+        try:
+            return mutation, True, self.call(mutation.kind, f, *args)
+        except Exception as e:
+            log.error('could not run {}: {}'.format(
+                describe(mutation), str(e)
+            ))
+            return mutation, False, None
+
+    def map(self, run, items):
+        if len(items) == 1:
+            return [run(items[0])]
+        with ThreadPoolExecutor(min(self.workers, len(items))) as pool:
+            return list(pool.map(run, items))
+
+    def write(self, mutation):
+        """
+        Returns the function and the arguments writing `mutation`.
+        """
+        args = mutation.args
+        client = self.client
+        return {
+            'delete-item': lambda: (client.delete_stored_item, args['item']),
+            'add-item': lambda: (
+                client.add_checklist_item,
+                args['card'], args['name'], args['checked']
+            ),
+            'update-item': lambda: (
+                client.set_checklist_item_fields, args['item'], args['fields']
+            ),
+            'card-label': lambda: (
+                client.add_card_label if args['add']
+                else client.remove_card_label,
+                args['card'], args['label']
+            ),
+            'rename-card': lambda: (args['card'].set_name, args['name']),
+            'set-description': lambda: (
+                client.set_card_description, args['card'], args['value']
+            ),
+            'gl-create-label': lambda: (
+                client.create_gl_label, args['project_id'], args['name']
+            ),
+            'gl-description': lambda: (
+                client.update_gl_desc, args['project_id'],
+                args['target_url'], args['id'], args['desc']
+            )
+        }[mutation.kind]()
+
+    def run_each(self, mutations):
+        results = self.map(
+            lambda m: self.attempt(m, *self.write(m)), mutations
+        )
+        # set_checklist_item_fields returns None when the item is gone
+        return [
+            (m, ok and (r is not None or m.kind != 'update-item'), r)
+            for m, ok, r in results
+        ]
+
+    def run_delete_hook(self, mutations):
+        # a single listing for all the hooks of the plan
+        hooks = self.client.list_hooks(token=self.client.resource_owner_key)
+
+        def run(m):
+            matched = [
+                h for h in hooks if h.id == m.args['hook_id'] or
+                h.id_model == m.args['model_id']
+            ]
+            deleted = [
+                self.client.delete_hook(h, self.limiter) for h in matched
+            ]
+            return m, all(deleted), None
+        return self.map(run, mutations)
+
+    def run_gl_label(self, mutations):
+        # one read and one write per target for all its labels
+        targets = OrderedDict()
+        for m in mutations:
+            target = (m.args['project_id'], m.args['target_url'], m.args['id'])
+            targets.setdefault(target, []).append(m)
+
+        def run(target):
+            project_id, target_url, id = target
+            changes = targets[target]
+            _, ok, result = self.attempt(
+                changes[0], self.client.update_gl_labels,
+                project_id, id, target_url,
+                [m.args['name'] for m in changes if m.args['add']],
+                [m.args['name'] for m in changes if not m.args['add']]
+            )
+            return [(m, ok, result) for m in changes]
+        return [r for rs in self.map(run, list(targets)) for r in rs]
+
+    def run(self, plan):
+        """
+        Runs the plan and returns the mutations which failed.
+        """
+        if self.dry_run:
+            for line in plan.describe():
+                log.info('dry run: {}'.format(line))
+            return []
+        failed = []
+        total = 0
+        for kind in ORDER:
+            mutations = plan.pending(kind)
+            if not mutations:
+                continue
+            total += len(mutations)
+            run = getattr(
+                self, 'run_{}'.format(kind.replace('-', '_')), self.run_each
+            )
+            for mutation, ok, result in run(mutations):
+                if not ok:
+                    failed.append(mutation)
+                elif mutation.done is not None:
+                    mutation.done(result)
+        if total:
+            log.info('ran {} mutations, {} failed'.format(
+                total, len(failed)
+            ))
+        return failed
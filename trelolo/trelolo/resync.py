@@ -0,0 +1,291 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from trello import ResourceUnavailable
+from trelolo.trelolo import helpers
+from trelolo.trelolo.plan import Plan
+from trelolo.extensions import db
+from trelolo import models
+
+log = logging.getLogger(__name__)
+
+CARD_FIELDS = 'name,idBoard,idList,idLabels,labels,url,closed'
+
+Change = namedtuple('Change', 'action table row card_id detail')
+
+
+def describe(change):
+    detail = change.detail
+    if change.action == 'fix-item':
+        detail = 'item id {} -> {}'.format(change.row.item_id, detail['id'])
+    elif change.action == 'update':
+        detail = ', '.join(
+            '{}={}'.format(k, v) for k, v in sorted(detail['fields'].items())
+        ) or 'db only'
+    elif change.action in ('link', 'relabel'):
+        detail = 'parent board {}'.format(detail)
+    return '{:<8} {:<6} {} {}'.format(
+        change.action, change.table, change.card_id, detail
+    )
+
+
+class Resync(object):
+    """
+    Compares the hooked boards with the Cards and Issues tables and fixes
+    the differences. Boards are read in bulk (open cards with their
+    checklists and labels, lists) and in parallel; links which have to be
+    created again are handed to the `payload_generic_event` job, the rest
+    is fixed here with a plan of Trello writes and bulk DB statements.
+    """
+
+    def __init__(self, client, enqueue, workers=8):
+        self.client = client
+        self.enqueue = enqueue
+        self.workers = workers
+        self.boards = {}
+
+    def fetch_board(self, board_id):
+        cards = self.client.fetch_json(
+            '/boards/{}/cards'.format(board_id),
+            query_params={
+                'filter': 'open', 'checklists': 'all',
+                'fields': CARD_FIELDS
+            }
+        )
+        lists = self.client.fetch_json(
+            '/boards/{}/lists'.format(board_id),
+            query_params={'filter': 'all', 'fields': 'name,closed'}
+        )
+        return {
+            'cards': dict((c['id'], c) for c in cards),
+            'lists': dict((l['id'], l) for l in lists)
+        }
+
+    def scan(self, board_ids):
+        with ThreadPoolExecutor(self.workers) as pool:
+            boards = pool.map(self.fetch_board, board_ids)
+            self.boards = dict(zip(board_ids, boards))
+        log.info('scanned {} boards'.format(len(self.boards)))
+
+    def find_card(self, card_id):
+        for board in self.boards.values():
+            if card_id in board['cards']:
+                return board['cards'][card_id], board
+        return None, None
+
+    @staticmethod
+    def find_item(card, item_id, item_name):
+        """
+        Returns the check item of `card` by id, or by name when the id is
+        stale, and whether it was found by id.
+        """
+        items = [
+            i for cl in card.get('checklists', []) for i in cl['checkItems']
+        ]
+        for item in items:
+            if item['id'] == item_id:
+                return item, True
+        for item in items:
+            if item['name'] == item_name:
+                return item, False
+        return None, False
+
+    @staticmethod
+    def get_completeness(card):
+        checklists = sorted(
+            card.get('checklists', []), key=lambda cl: cl.get('pos', 0)
+        )
+        try:
+            items = checklists[0]['checkItems']
+            completed = sum(i['state'] == 'complete' for i in items)
+            return completed / len(items) * 100
+        except (IndexError, ZeroDivisionError):
+            return -1
+
+    def expected_item(self, card, board):
+        completeness = self.get_completeness(card)
+        return (
+            helpers.format_itemname(
+                completeness, card['url'],
+                board['lists'][card['idList']]['name']
+            ),
+            completeness == 100
+        )
+
+    def diff_cards(self, team_board_ids, main_board_id, top_board_id):
+        """
+        Children are the cards of team boards (parents on the main board)
+        and of the main board (parents on the top board).
+        """
+        changes = []
+        stored = dict(
+            (c.card_id, c) for c in models.Cards.query.all()
+        )
+        children = [(b, main_board_id) for b in team_board_ids]
+        children.append((main_board_id, top_board_id))
+        for board_id, parent_board_id in children:
+            board = self.boards[board_id]
+            metadata = self.client.board_data[parent_board_id]['metadata']
+            for card in board['cards'].values():
+                label = self.client.get_label(card['labels'], metadata)
+                row = stored.pop(card['id'], None)
+                closed = board['lists'][card['idList']]['closed']
+                if row is None:
+                    if label and not closed:
+                        changes.append(Change(
+                            'link', 'cards', None, card['id'],
+                            parent_board_id
+                        ))
+                    continue
+                # the handler also resets the description of the child
+                if label != row.label:
+                    changes.append(Change(
+                        'relabel', 'cards', row, card['id'], parent_board_id
+                    ))
+                    continue
+                changes.extend(self.diff_item(
+                    row, card['id'], parent_board_id,
+                    *self.expected_item(card, board)
+                ))
+        missing = [r for r in stored.values() if r.board_id in self.boards]
+        deleted = self.deleted_cards([r.card_id for r in missing])
+        for row in missing:
+            if row.card_id in deleted:
+                changes.append(Change(
+                    'unlink', 'cards', row, row.card_id, 'card deleted'
+                ))
+        return changes
+
+    def diff_item(self, row, card_id, parent_board_id, title, checked):
+        parent, _ = self.find_card(row.parent_card_id)
+        if parent is None:
+            return [Change('link', 'cards', row, card_id, parent_board_id)]
+        item, by_id = self.find_item(parent, row.item_id, row.item_name)
+        if item is None:
+            return [Change('link', 'cards', row, card_id, parent_board_id)]
+        changes = []
+        if not by_id:
+            changes.append(Change('fix-item', 'cards', row, card_id, item))
+        fields = {}
+        if item['name'] != title:
+            fields['name'] = title
+        if (item['state'] == 'complete') != checked:
+            fields['state'] = 'complete' if checked else 'incomplete'
+        if fields or row.item_name != title or row.checked != checked:
+            changes.append(Change('update', 'cards', row, card_id, {
+                'fields': fields, 'item_name': title, 'checked': checked
+            }))
+        return changes
+
+    def diff_issues(self):
+        changes = []
+        orphans = []
+        for row in models.Issues.query.all():
+            parent, _ = self.find_card(row.parent_card_id)
+            if parent is None:
+                orphans.append(row)
+                continue
+            item, by_id = self.find_item(parent, row.item_id, row.item_name)
+            if item is None:
+                changes.append(Change(
+                    'unlink', 'issues', row, row.parent_card_id,
+                    'item not found'
+                ))
+            elif not by_id:
+                changes.append(Change(
+                    'fix-item', 'issues', row, row.parent_card_id, item
+                ))
+        deleted = self.deleted_cards(
+            set(r.parent_card_id for r in orphans)
+        )
+        for row in orphans:
+            if row.parent_card_id in deleted:
+                changes.append(Change(
+                    'unlink', 'issues', row, row.parent_card_id,
+                    'parent card deleted'
+                ))
+        return changes
+
+    def is_deleted(self, card_id):
+        try:
+            self.client.fetch_json(
+                '/cards/{}'.format(card_id), query_params={'fields': 'closed'}
+            )
+        except ResourceUnavailable as e:
+            return self.client.is_stale_resource(e)
+        return False
+
+    def deleted_cards(self, card_ids):
+        """
+        Returns which of the cards missing from the scan were deleted, the
+        others are archived or on boards which are not scanned.
+        """
+        card_ids = list(card_ids)
+        with ThreadPoolExecutor(self.workers) as pool:
+            deleted = pool.map(self.is_deleted, card_ids)
+            return set(c for c, d in zip(card_ids, deleted) if d)
+
+    def diff(self, team_board_ids, main_board_id, top_board_id):
+        self.scan(list(team_board_ids) + [main_board_id, top_board_id])
+        return self.diff_cards(
+            team_board_ids, main_board_id, top_board_id
+        ) + self.diff_issues()
+
+    @staticmethod
+    def store_item(change):
+        def done(result=None):
+            change.row.item_name = change.detail['item_name']
+            change.row.checked = change.detail['checked']
+        return done
+
+    def apply(self, changes):
+        """
+        Applies the changes and returns the number of failed item writes.
+        """
+        by_action = {}
+        for change in changes:
+            by_action.setdefault(change.action, []).append(change)
+        unlinks = by_action.get('unlink', [])
+
+        for change in by_action.get('fix-item', []):
+            change.row.item_id = change.detail['id']
+        plan = Plan()
+        for change in by_action.get('update', []):
+            if change.detail['fields']:
+                plan.update_item(
+                    change.row, change.detail['fields'],
+                    self.store_item(change)
+                )
+            else:
+                self.store_item(change)()
+        for change in unlinks:
+            if change.table == 'cards':
+                self.client.remove_checklist_item(change.row, plan)
+        executor = self.client.get_executor()
+        failed = [m for m in executor.run(plan) if m.kind == 'update-item']
+        if executor.dry_run:
+            db.session.rollback()
+            return 0
+        # recreated by the handler, which takes them for new cards
+        unlinks += [c for c in by_action.get('link', []) if c.row]
+        for table, model in (('cards', models.Cards),
+                             ('issues', models.Issues)):
+            models.delete_rows(
+                model, model.id,
+                [c.row.id for c in unlinks if c.table == table]
+            )
+        db.session.commit()
+
+        for change in by_action.get('link', []) + \
+                by_action.get('relabel', []):
+            self.enqueue(change.detail, {
+                'action': 'resync',
+                'card': {'id': change.card_id},
+                'label': {},
+                'old': {}
+            })
+        log.info('resync applied {} changes, {} item writes failed'.format(
+            len(changes) - len(failed), len(failed)
+        ))
+        return len(failed)
@@ -0,0 +1,105 @@
+import logging
+import time
+from rq import Queue
+from trelolo import metrics
+
+log = logging.getLogger(__name__)
+
+
+class MembersWriter(object):
+    """
+    Buffers `members` additions per parent card in redis, so that a burst
+    of child updates ends up as a single description write per parent.
+    The flush job of a card is only enqueued once its window elapsed, by
+    the workers calling `enqueue_due` between jobs.
+    """
+
+    PENDING_KEY = 'trelolo:members:{}'
+    PROCESSING_KEY = 'trelolo:members:{}:processing'
+    WINDOW_KEY = 'trelolo:members:{}:window'
+    # cards with an open window
+    WINDOWS_KEY = 'trelolo:members:windows'
+    # safety net for windows whose flush job got lost
+    WINDOW_TTL = 300
+    FLUSH_JOB = 'trelolo.worker.flush_card_members'
+
+    def __init__(self, connection, window, queue_name='low'):
+        self.connection = connection
+        self.window = window
+        self.queue = Queue(queue_name, connection=connection)
+
+    def add(self, card_id, members):
+        members = [m for m in members if m]
+        if not members:
+            return False
+        pipe = self.connection.pipeline()
+        pipe.sadd(self.PENDING_KEY.format(card_id), *members)
+        pipe.set(
+            self.WINDOW_KEY.format(card_id), time.time(),
+            ex=self.WINDOW_TTL, nx=True
+        )
+        opened = pipe.execute()[1]
+        if opened:
+            self.connection.sadd(self.WINDOWS_KEY, card_id)
+        log.info(
+            'buffered members {} for card {}'.format(
+                ','.join(members), card_id
+            )
+        )
+        return True
+
+    def enqueue_due(self):
+        """
+        Enqueues the flush jobs of the cards whose window elapsed and
+        returns their number. A card is only taken by one worker.
+        """
+        card_ids = [
+            c.decode('utf-8') for c in self.connection.smembers(
+                self.WINDOWS_KEY
+            )
+        ]
+        if not card_ids:
+            return 0
+        opened = self.connection.mget(
+            [self.WINDOW_KEY.format(c) for c in card_ids]
+        )
+        now = time.time()
+        due = 0
+        for card_id, since in zip(card_ids, opened):
+            # a window without its key expired
+            if since is not None and float(since) + self.window > now:
+                continue
+            if self.connection.srem(self.WINDOWS_KEY, card_id):
+                metrics.enqueue(self.queue, self.FLUSH_JOB, card_id)
+                due += 1
+        return due
+
+    def take(self, card_id):
+        """
+        Returns all buffered members, including the ones left over from a
+        failed flush, and closes the window.
+        """
+        processing = self.PROCESSING_KEY.format(card_id)
+        pipe = self.connection.pipeline()
+        pipe.delete(self.WINDOW_KEY.format(card_id))
+        pipe.sunionstore(
+            processing, processing, self.PENDING_KEY.format(card_id)
+        )
+        pipe.delete(self.PENDING_KEY.format(card_id))
+        pipe.smembers(processing)
+        members = pipe.execute()[-1]
+        return sorted(m.decode('utf-8') for m in members)
+
+    def done(self, card_id):
+        self.connection.delete(self.PROCESSING_KEY.format(card_id))
+
+    def retry(self, card_id):
+        """
+        Puts the members of a failed flush back and schedules a new one.
+        """
+        processing = self.PROCESSING_KEY.format(card_id)
+        members = [
+            m.decode('utf-8') for m in self.connection.smembers(processing)
+        ]
+        self.connection.delete(processing)
+        self.add(card_id, members)
@@ -1,15 +1,26 @@
 import logging
 from ..config import Config
 
+from trello import ResourceUnavailable
+from trelolo.trelolo import helpers
 from trelolo.trelolo.client import Trelolo
-from trelolo import models
-from trelolo.extensions import db
+from trelolo.trelolo.cache import (
+    BoardCatalogue, ChecklistCounters, EmailCache
+)
+from trelolo.trelolo.orphans import Collector
+from trelolo.trelolo.plan import Executor
+from trelolo.trelolo.writer import MembersWriter
+from trelolo import metrics, models, progress, tracing
+from trelolo.payloads import backpressure, envelope
+from trelolo.extensions import db, rq
 
 log = logging.getLogger(__name__)
 
 
 client = Trelolo(api_key=Config.TRELOLO_API_KEY, token=Config.TRELOLO_TOKEN)
 
+client.setup_trello_api(Config.TRELLO_API_URL)
+
 client.setup_trelolo(
     Config.TRELOLO_MAIN_BOARD,
     Config.TRELOLO_TOP_BOARD,
@@ -20,6 +31,23 @@ client.setup_gitlab(
     Config.GITLAB_URL, Config.GITLAB_TOKEN
 )
 
+client.setup_members_writer(
+    MembersWriter(rq, Config.MEMBERS_WRITE_WINDOW)
+)
+
+client.setup_email_cache(EmailCache(rq))
+
+client.setup_checklist_counters(ChecklistCounters(rq))
+
+client.setup_async(Config.ASYNC_CONNECTIONS)
+
+client.setup_executor(Executor(
+    client, Config.MUTATION_WORKERS,
+    helpers.RateLimiter(Config.MUTATION_RATE), Config.MUTATIONS_DRY_RUN
+))
+
+catalogue = BoardCatalogue(rq, client, Config.BOARDS_CACHE_TTL)
+
 
 def get_card_from_db(card_id):
     try:
@@ -28,7 +56,10 @@ def get_card_from_db(card_id):
         return False
 
 
+@metrics.observe_job
+@tracing.trace_job
 def payload_update_label(parent_board_id, data):
+    data = envelope.unpack(data)
     try:
         client.handle_update_label(
             parent_board_id, data['old']['name'], data['label']['name']
@@ -37,7 +68,10 @@ def payload_update_label(parent_board_id, data):
         pass
 
 
+@metrics.observe_job
+@tracing.trace_job
 def payload_delete_card(data):
+    data = envelope.unpack(data)
     card = get_card_from_db(data['card']['id'])
     try:
         if card:
@@ -46,9 +80,19 @@ def payload_delete_card(data):
         pass
 
 
+@metrics.observe_job
+@tracing.trace_job
 def payload_generic_event(parent_board_id, data):
+    data = envelope.unpack(data)
     try:
         stored_card = get_card_from_db(data['card']['id'])
+        if data['action'] == 'updateCheckItemStateOnCard' and \
+                'checkItem' in data and 'checklist' in data and \
+                client.handle_check_item(
+                    stored_card, data['checklist']['id'],
+                    data['checkItem']['id'], data['checkItem']['state']
+                ):
+            return True
         client.handle_generic_event(
             parent_board_id, data['card']['id'], stored_card
         )
@@ -68,27 +112,90 @@ def payload_generic_event(parent_board_id, data):
         pass
 
 
+@metrics.observe_job
+@tracing.trace_job
+def payload_dirty_card(parent_board_id, card_id):
+    """
+    Resyncs a card marked dirty under backpressure, once for all its
+    events since it was marked.
+    """
+    # events arriving from now on mark it again
+    backpressure.clear('card:{}'.format(card_id))
+    client.handle_generic_event(
+        parent_board_id, card_id, get_card_from_db(card_id)
+    )
+
+
+@metrics.observe_job
+@tracing.trace_job
+def payload_checklist_event(data):
+    """
+    Follows check items added to or deleted from a card, and checklists
+    removed from it, in the counters of the card.
+    """
+    data = envelope.unpack(data)
+    try:
+        card_id = data['card']['id']
+        if data['action'] == 'removeChecklistFromCard':
+            client.checklist_counters.forget(card_id)
+            return True
+        return client.handle_check_item(
+            get_card_from_db(card_id), data['checklist']['id'],
+            data['checkItem']['id'],
+            'deleted' if data['action'] == 'deleteCheckItem'
+            else data['checkItem'].get('state', 'incomplete'),
+            created=data['action'] == 'createCheckItem'
+        )
+    except KeyError:
+        pass
+
+
+@metrics.observe_job
+@tracing.trace_job
 def payload_gitlab_generic_event(data):
+    data = envelope.unpack(data)
     # these values are unfortunately not
-    # in a webhook payload yet
-    data['label'] = client.fetch_gl_labels(
-        data['project_id'], data['target_url'], data['id']
-    )
-    data['milestone'] = client.fetch_gl_milestone(
-        data['project_id'], data['milestone_id']
+    # in a webhook payload yet, the description is left out of it
+    details = client.fetch_gl_details(
+        data['project_id'], data['target_url'], data['id'],
+        data['milestone_id'], data['assignee_id']
     )
+    data['label'] = details['label']
+    data['milestone'] = details['milestone']
     data['target_title'] = '[{} / {}]({})'.format(
-        client.fetch_gl_project_name(data['project_id']),
+        details['project_name'],
         data['title'],
         data['url']
     )
-    data['assignee_email'] = client.fetch_gl_assignee_email(
-        data['assignee_id']
-    )
+    data['assignee_email'] = details['assignee_email']
+    data['description'] = details['description']
     client.handle_gitlab_generic_event(data)
 
 
+@metrics.observe_job
+@tracing.trace_job
+def flush_card_members(card_id):
+    writer = client.members_writer
+    members = writer.take(card_id)
+    try:
+        if members:
+            client.merge_card_members(card_id, members)
+    except ResourceUnavailable as e:
+        if not client.is_stale_resource(e):
+            log.error(
+                'failed to flush members of card {}: {}'.format(
+                    card_id, str(e)
+                )
+            )
+            writer.retry(card_id)
+            return
+    writer.done(card_id)
+
+
+@metrics.observe_job
+@tracing.trace_job
 def payload_gitlab_state_change(data):
+    data = envelope.unpack(data)
     try:
         client.handle_gitlab_state_change(
             data['project_id'], data['id'], data['type'], data['state']
@@ -97,19 +204,43 @@ def payload_gitlab_state_change(data):
         pass
 
 
+def delete_hooks(hooks):
+    """
+    Deletes the hooks concurrently within the Trello rate limit, reporting
+    the progress of the current job. Returns the number of failures.
+    """
+    failed = 0
+    limiter = helpers.RateLimiter(Config.HOOKS_DELETE_RATE)
+    deleted = client.delete_hooks(hooks, Config.HOOKS_DELETE_WORKERS, limiter)
+    for i, (hook, ok) in enumerate(deleted):
+        if ok:
+            log.warning('unhooking: {}'.format(hook.desc))
+        else:
+            failed += 1
+        progress.report(i + 1, len(hooks), hook.desc)
+    return failed
+
+
 # these are run only from manage.py (be careful)
+@metrics.observe_job
+@tracing.trace_job
+@progress.track_job
 def unhook_all():
-    for hook in client.list_hooks(client.resource_owner_key):
-        found = models.Boards.query.filter_by(
-            trello_id=hook.id_model
-        ).first()
-        if found:
-            db.session.delete(found)
-            db.session.commit()
-        log.warning('unhooking: {}'.format(hook.desc))
-        hook.delete()
+    hooks = client.list_hooks(client.resource_owner_key)
+    models.delete_rows(
+        models.Boards, models.Boards.trello_id,
+        [hook.id_model for hook in hooks]
+    )
+    db.session.commit()
+    catalogue.invalidate()
+    failed = delete_hooks(hooks)
+    log.info('unhooked {} hooks, {} failed'.format(len(hooks), failed))
+    return failed == 0
 
 
+@metrics.observe_job
+@tracing.trace_job
+@progress.track_job
 def hook_teamboard(board_id):
     exclude = client.board_data.keys()
     for board in client.list_boards():
@@ -123,36 +254,91 @@ def hook_teamboard(board_id):
                 token=client.resource_owner_key
             )
             if webhook:
-                insert_board = models.Boards(
-                    trello_id=board.id,
-                    name=board.name,
-                    type=3,
-                    hook_id=webhook.id,
-                    hook_url=webhook.callback_url
-                )
-                db.session.add(insert_board)
+                models.upsert(models.Boards, [{
+                    'trello_id': board.id,
+                    'name': board.name,
+                    'type': 3,
+                    'hook_id': webhook.id,
+                    'hook_url': webhook.callback_url
+                }], ['trello_id'])
                 db.session.commit()
-            for card in board.open_cards():
+                catalogue.invalidate()
+            cards = board.open_cards()
+            for i, card in enumerate(cards):
                 card_list = card.get_list()
                 # ignore archived lists
                 if not card_list.closed:
                     client.handle_generic_event(
                         Config.TRELOLO_MAIN_BOARD, card.id, None
                     )
+                progress.report(i + 1, len(cards), card.name)
     return True
 
 
+@metrics.observe_job
+@tracing.trace_job
+@progress.track_job
 def unhook_teamboard(board_id):
-    hooks = client.list_hooks(token=client.resource_owner_key)
-    for board in client.list_boards():
-        for hook in hooks:
-            if board.id == board_id:
-                if hook.id_model == board.id:
-                    found = models.Boards.query.filter_by(
-                        trello_id=hook.id_model
-                    ).first()
-                    if found:
-                        db.session.delete(found)
-                        db.session.commit()
-                    log.warning('unhooking: {}').format(hook.desc)
-                    hook.delete()
+    hooks = client.index_hooks().get(board_id, [])
+    models.delete_rows(models.Boards, models.Boards.trello_id, [board_id])
+    db.session.commit()
+    catalogue.invalidate()
+    return delete_hooks(hooks) == 0
+
+
+def reconcile_board(board):
+    """
+    Dispatches the actions of a hooked team board since its watermark
+    whose webhooks did not arrive, as if they arrived now, and moves the
+    watermark. A board without a watermark only gets one.
+    """
+    from trelolo.payloads import inbox, trello
+    if not board.actions_since:
+        board.actions_since = client.fetch_latest_board_action(
+            board.trello_id
+        )
+        db.session.commit()
+        return 0
+    actions = client.fetch_board_actions(
+        board.trello_id, board.actions_since, trello.ALLOWED_WEBHOOK_ACTIONS
+    )
+    if not actions:
+        return 0
+    missed = trello.unseen(actions)
+    jobs = []
+    for action in missed:
+        jobs.extend(trello.dispatch_teamboard({'action': action}))
+    queued = inbox.enqueue_jobs(inbox.coalesce(jobs))
+    board.actions_since = actions[-1]['id']
+    db.session.commit()
+    log.info(
+        'reconciled board {}: {} actions, {} missed, {} jobs'.format(
+            board.name, len(actions), len(missed), queued
+        )
+    )
+    return queued
+
+
+@metrics.observe_job
+@tracing.trace_job
+def reconcile_boards():
+    for board in models.Boards.query.all():
+        try:
+            reconcile_board(board)
+        except Exception as e:
+            # the other boards are reconciled anyway
+            db.session.rollback()
+            log.error(
+                'could not reconcile board {}: {}'.format(board.name, str(e))
+            )
+
+
+@metrics.observe_job
+@tracing.trace_job
+@progress.track_job
+def collect_garbage(dry_run=False):
+    """
+    Removes the rows of archived or deleted cards and GitLab targets and
+    the hooks nothing refers to, see `Collector`.
+    """
+    return Collector(client, delete_hooks, Config.GC_HOOK_GRACE).run(dry_run)